@@ -2,7 +2,8 @@ from dataclasses import dataclass
 import json
 import os
 from abc import ABC
-from typing import List, Tuple, Union
+from typing import List, Optional, Tuple, Union
+from urllib.parse import quote
 
 import requests
 
@@ -515,21 +516,53 @@ class MedCATTrainerSession:
         mct_datasets = [MCTDataset(name=d['name'], dataset_file=d['original_file'], id=d['id']) for d in resp]
         return mct_datasets
 
-    def get_project_annos(self, projects: List[MCTProject]):
+    def get_project_annos(self, projects: List[MCTProject], since: Optional[str] = None):
         """Get the annotations for a list of projects. Schema is documented here: https://github.com/medcat/MedCATtrainer/blob/main/docs/api.md#download-annotations
 
         Args:
             projects (List[MCTProject]): A list of projects to get annotations for
+            since (Optional[str]): the 'cursor' of a previous download. Only documents changed since are returned,
+                and each project lists the annotations, meta annotations, relations and documents 'deleted' since.
 
         Returns:
-            List[MCTProject]: A list of all projects with annotations
+            List[MCTProject]: A list of all projects with annotations, and the 'cursor' to pass as since to the next call
         """
         if any(p.id is None for p in projects):
             raise MCTUtilsException('One or more project.id are None and all are required to download annotations')
 
-        resp = json.loads(requests.get(f'{self.server}/api/download-annos/?project_ids={",".join([str(p.id) for p in projects])}&with_text=1',
-                                       headers=self.headers).text)
-        return resp
+        url = f'{self.server}/api/download-annos/?project_ids={",".join([str(p.id) for p in projects])}&with_text=1'
+        if since is not None:
+            url += f'&since={quote(since)}'
+        resp = requests.get(url, headers=self.headers)
+        annos = json.loads(resp.text)
+        annos['cursor'] = resp.headers.get('X-Export-Cursor')
+        return annos
+
+    def download_project_annos_columnar(self, projects: List[MCTProject], path: str, since: Optional[str] = None):
+        """Download the annotations for a list of projects as a zip of documents, annotations, meta_annotations and
+        relations tables, in Parquet (or Arrow IPC stream) format, i.e. to load with pyarrow / pandas.
+
+        Args:
+            projects (List[MCTProject]): A list of projects to get annotations for
+            path (str): the file to write the zip to
+            since (Optional[str]): the 'cursor' of a previous download, only documents changed since are included.
+
+        Returns:
+            str: the cursor to pass as since to the next call
+        """
+        if any(p.id is None for p in projects):
+            raise MCTUtilsException('One or more project.id are None and all are required to download annotations')
+
+        url = f'{self.server}/api/download-annos/?project_ids={",".join([str(p.id) for p in projects])}&format=parquet'
+        if since is not None:
+            url += f'&since={quote(since)}'
+        resp = requests.get(url, headers=self.headers, stream=True)
+        if resp.status_code != 200:
+            raise MCTUtilsException(f'Failed to download annotations: {resp.text}')
+        with open(path, 'wb') as f:
+            for chunk in resp.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+        return resp.headers.get('X-Export-Cursor')
 
     def __str__(self) -> str:
         return f'{self.server} \t {self.username} \t {self.password}'
@@ -1,4 +1,6 @@
 import json
+import os
+import tempfile
 import unittest
 from unittest.mock import patch, MagicMock
 from mctclient import (
@@ -115,5 +117,32 @@ class TestMCTClient(unittest.TestCase):
         self.assertEqual(project.meta_tasks, [meta_task])
         self.assertEqual(project.rel_tasks, [rel_task])
 
+    @patch('mctclient.requests.post')
+    @patch('mctclient.requests.get')
+    def test_get_project_annos_since_cursor(self, mock_get, mock_post):
+        mock_post.return_value = MagicMock(status_code=200, text='{"token": "abc"}')
+        mock_get.return_value = MagicMock(status_code=200, text=json.dumps({'projects': []}),
+                                          headers={'X-Export-Cursor': '2024-01-02T00:00:00+00:00'})
+        session = MedCATTrainerSession(server='http://localhost', username='u', password='p')
+        annos = session.get_project_annos([MCTProject(id=1)], since='2024-01-01T00:00:00+00:00')
+        self.assertEqual(annos['cursor'], '2024-01-02T00:00:00+00:00')
+        self.assertIn('&since=2024-01-01T00%3A00%3A00%2B00%3A00', mock_get.call_args[0][0])
+
+    @patch('mctclient.requests.post')
+    @patch('mctclient.requests.get')
+    def test_download_project_annos_columnar(self, mock_get, mock_post):
+        mock_post.return_value = MagicMock(status_code=200, text='{"token": "abc"}')
+        mock_get.return_value = MagicMock(status_code=200, headers={'X-Export-Cursor': 'cursor'})
+        mock_get.return_value.iter_content.return_value = [b'PK', b'zip']
+        session = MedCATTrainerSession(server='http://localhost', username='u', password='p')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            path = os.path.join(tmp_dir, 'export.zip')
+            cursor = session.download_project_annos_columnar([MCTProject(id=1)], path)
+            with open(path, 'rb') as f:
+                self.assertEqual(f.read(), b'PKzip')
+        self.assertEqual(cursor, 'cursor')
+        self.assertIn('&format=parquet', mock_get.call_args[0][0])
+
+
 if __name__ == '__main__':
-    unittest.main()
\ No newline at end of file
+    unittest.main()
@@ -1,21 +1,41 @@
 import copy
+import itertools
 import json
 import logging
+import os
+import re
+import tempfile
+import zipfile
+from collections import defaultdict
 from datetime import datetime
-from io import StringIO
-from typing import Dict, List
+from typing import Callable, Dict, Iterator, List, Tuple
 
 from background_task import background
-from django.db.models import QuerySet
-from django.http import HttpResponse
+from django.db.models import Q, QuerySet
+from django.http import FileResponse, StreamingHttpResponse
+from django.utils import timezone
+from django.utils.text import compress_sequence
 from rest_framework.exceptions import PermissionDenied
 
-from api.models import AnnotatedEntity, MetaAnnotation, EntityRelation, Document, ConceptDB
+from api.model_cache import preload_models
+from api.models import AnnotatedEntity, MetaAnnotation, EntityRelation, Document, ConceptDB, ExportTombstone
 from api.solr_utils import drop_collection, import_all_concepts
 
+try:
+    import pyarrow as pa
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        # pyarrow built without parquet support, columnar exports fall back to Arrow IPC streams
+        pq = None
+except ImportError:
+    pa = pq = None
+
 logger = logging.getLogger(__name__)
 
 _dt_fmt = '%Y-%m-%d %H:%M:%S.%f'
+# documents fetched per query when exporting
+_EXPORT_CHUNK_SIZE = 500
 
 
 def reset_project(modeladmin, request, queryset):
@@ -24,7 +44,9 @@ def reset_project(modeladmin, request, queryset):
 
     for project in queryset:
         # Remove all annotations and cascade to meta anns
-        AnnotatedEntity.objects.filter(project=project).delete()
+        annotations = AnnotatedEntity.objects.filter(project=project)
+        ExportTombstone.annotations_deleted(annotations)
+        annotations.delete()
 
         # Clear validated_docuents and prepared_documents
         project.validated_documents.clear()
@@ -32,12 +54,20 @@ def reset_project(modeladmin, request, queryset):
 
 
 
+def preload_project_models(modeladmin, request, queryset):
+    if not request.user.is_staff:
+        raise PermissionDenied
+
+    # loads into this processes model cache, i.e. the one serving the annotation UI
+    preload_models(list(queryset))
+
+
 def download_without_text(modeladmin, request, queryset):
     if not request.user.is_staff:
         raise PermissionDenied
 
     projects = queryset
-    return download_projects_without_text(projects, with_doc_name=False)
+    return download_projects_without_text(projects, with_doc_name=False, gzip=accepts_gzip(request))
 
 
 def download_without_text_with_doc_names(modeladmin, request, queryset):
@@ -45,95 +75,263 @@ def download_without_text_with_doc_names(modeladmin, request, queryset):
         raise PermissionDenied
 
     projects = queryset
-    return download_projects_without_text(projects, with_doc_name=True)
+    return download_projects_without_text(projects, with_doc_name=True, gzip=accepts_gzip(request))
 
 
-def download_projects_without_text(projects, with_doc_name):
+def _project_cuis(project) -> str:
+    cuis = project.cuis
+    if project.cuis_file is not None and project.cuis_file:
+        # Add cuis from json file if it exists
+        cuis_from_file = ",".join(json.load(open(project.cuis_file.path)))
+        cuis = cuis + "," + cuis_from_file if len(cuis) > 0 else cuis_from_file
+    return cuis
 
-    all_projects_out = {'projects': []}
-    for project in projects:
-        out = {}
-        out['name'] = project.name
-        out['id'] = project.id
-        out['cuis'] = project.cuis
-        out['documents'] = []
-
-        if project.cuis_file is not None and project.cuis_file:
-            # Add cuis from json file if it exists
-            cuis_from_file = ",".join(json.load(open(project.cuis_file.path)))
-            all_cuis = out['cuis'] + "," + cuis_from_file if len(out['cuis']) > 0 else cuis_from_file
-            out['cuis'] = all_cuis
-
-        for doc in project.validated_documents.all():
-            out_doc = {}
-            out_doc['id'] = doc.id
-            out_doc['last_modified'] = str(doc.last_modified)
-            out_doc['annotations'] = []
-            if with_doc_name:
-                out_doc['name'] = doc.name
-
-            anns = AnnotatedEntity.objects.filter(project=project, document=doc)
-
-            for ann in anns:
-                out_ann = {}
-                out_ann['id'] = ann.id
-                out_ann['user'] = ann.user.username
-                out_ann['validated'] = ann.validated
-                out_ann['correct'] = ann.correct
-                out_ann['deleted'] = ann.deleted
-                out_ann['alternative'] = ann.alternative
-                out_ann['killed'] = ann.killed
-                out_ann['irrelevant'] = ann.irrelevant
-                out_ann['last_modified'] = str(ann.last_modified)
-                out_ann['manually_created'] = ann.manually_created
-                out_ann['acc'] = ann.acc
-                out_ann['meta_anns'] = {}
-
-                # Get MetaAnnotations
-                meta_anns = MetaAnnotation.objects.filter(annotated_entity=ann)
-                for meta_ann in meta_anns:
-                    o_meta_ann = {}
-                    o_meta_ann['name'] = meta_ann.meta_task.name
-                    o_meta_ann['value'] = meta_ann.meta_task_value.name
-                    o_meta_ann['acc'] = meta_ann.acc
-                    o_meta_ann['validated'] = meta_ann.validated
-
-                    # Add annotation
-                    key = meta_ann.meta_task.name
-                    out_ann['meta_anns'][key] = o_meta_ann
-
-                out_doc['annotations'].append(out_ann)
-            out['documents'].append(out_doc)
-        all_projects_out['projects'].append(out)
-
-    sio = StringIO()
-    json.dump(all_projects_out, sio)
-    sio.seek(0)
 
-    f_name = "MedCAT_Export_No_Text_{}.json".format(datetime.now().strftime('%Y-%m-%d:%H:%M:%S'))
-    response = HttpResponse(sio, content_type='text/json')
+def _validated_documents(project, since: datetime = None) -> Iterator[Document]:
+    docs = project.validated_documents.all()
+    if since is not None:
+        # documents whose text, annotations, meta annotations or relations changed since
+        docs = docs.filter(
+            Q(last_modified__gt=since) |
+            Q(id__in=AnnotatedEntity.objects.filter(project=project, last_modified__gt=since).values('document_id')) |
+            Q(id__in=MetaAnnotation.objects.filter(annotated_entity__project=project, last_modified__gt=since)
+              .values('annotated_entity__document_id')) |
+            Q(id__in=EntityRelation.objects.filter(project=project, last_modified__gt=since).values('document_id')))
+    # chunked, so a large project is never held in memory at once
+    return docs.iterator(chunk_size=_EXPORT_CHUNK_SIZE)
+
+
+def _tombstones(project, since: datetime) -> List[Dict]:
+    return [{'type': t.object_type, 'id': t.object_id, 'document_id': t.document_id,
+             'deleted_at': t.deleted_at.strftime(_dt_fmt)}
+            for t in ExportTombstone.objects.filter(project_id=project.id, deleted_at__gt=since).order_by('id')]
+
+
+def _group_by(objs, key: str) -> Dict[int, List]:
+    grouped = defaultdict(list)
+    for obj in objs:
+        grouped[getattr(obj, key)].append(obj)
+    return grouped
+
+
+def _document_chunks(project, since: datetime = None) -> Iterator[Tuple[List[Document], Dict[int, List], Dict[int, List], Dict[int, List]]]:
+    """
+    Yields the validated documents of project in chunks, each with the annotations of the chunk by document id,
+    meta annotations by annotation id and relations by document id. So an export runs a fixed number of
+    queries per chunk, rather than per document / annotation.
+    """
+    chunk = []
+    for doc in itertools.chain(_validated_documents(project, since), [None]):
+        if doc is not None:
+            chunk.append(doc)
+        if chunk and (doc is None or len(chunk) == _EXPORT_CHUNK_SIZE):
+            doc_ids = [d.id for d in chunk]
+            anns = AnnotatedEntity.objects.filter(project=project, document_id__in=doc_ids) \
+                .select_related('user', 'entity')
+            meta_anns = MetaAnnotation.objects.filter(annotated_entity__project=project,
+                                                      annotated_entity__document_id__in=doc_ids) \
+                .select_related('meta_task', 'meta_task_value').order_by('id')
+            rels = EntityRelation.objects.filter(project=project, document_id__in=doc_ids) \
+                .select_related('user', 'relation', 'start_entity__entity', 'end_entity__entity')
+            yield (chunk, _group_by(anns, 'document_id'), _group_by(meta_anns, 'annotated_entity_id'),
+                   _group_by(rels, 'document_id'))
+            chunk = []
+
+
+def _project_without_text(project, with_doc_name, since: datetime = None) -> Tuple[Dict, Iterator[Dict]]:
+    out = {}
+    out['name'] = project.name
+    out['id'] = project.id
+    out['cuis'] = _project_cuis(project)
+    return out, _documents_without_text(project, with_doc_name, since)
+
+
+def _documents_without_text(project, with_doc_name, since: datetime = None) -> Iterator[Dict]:
+    for docs, doc_anns, ann_meta_anns, _ in _document_chunks(project, since):
+        yield from (_document_without_text(doc, with_doc_name, doc_anns, ann_meta_anns) for doc in docs)
+
+
+def _document_without_text(doc, with_doc_name, doc_anns, ann_meta_anns) -> Dict:
+    out_doc = {}
+    out_doc['id'] = doc.id
+    out_doc['last_modified'] = str(doc.last_modified)
+    out_doc['annotations'] = []
+    if with_doc_name:
+        out_doc['name'] = doc.name
+
+    for ann in doc_anns.get(doc.id, []):
+        out_ann = {}
+        out_ann['id'] = ann.id
+        out_ann['user'] = ann.user.username
+        out_ann['validated'] = ann.validated
+        out_ann['correct'] = ann.correct
+        out_ann['deleted'] = ann.deleted
+        out_ann['alternative'] = ann.alternative
+        out_ann['killed'] = ann.killed
+        out_ann['irrelevant'] = ann.irrelevant
+        out_ann['last_modified'] = str(ann.last_modified)
+        out_ann['manually_created'] = ann.manually_created
+        out_ann['acc'] = ann.acc
+        out_ann['meta_anns'] = {}
+
+        # Get MetaAnnotations
+        for meta_ann in ann_meta_anns.get(ann.id, []):
+            o_meta_ann = {}
+            o_meta_ann['name'] = meta_ann.meta_task.name
+            o_meta_ann['value'] = meta_ann.meta_task_value.name
+            o_meta_ann['acc'] = meta_ann.acc
+            o_meta_ann['validated'] = meta_ann.validated
+
+            # Add annotation
+            key = meta_ann.meta_task.name
+            out_ann['meta_anns'][key] = o_meta_ann
+
+        out_doc['annotations'].append(out_ann)
+    return out_doc
+
+
+def _stream_projects_json(projects, project_data: Callable[..., Tuple[Dict, Iterator[Dict]]],
+                          since: datetime = None) -> Iterator[str]:
+    """
+    Yields the JSON of {'projects': [...]} a document at a time, the same text json.dump writes for the full dict.
+    :param project_data: returns the dict of a project, bar its 'documents', and an iterator of its documents
+    :param since: if set, each project also lists what was 'deleted' since, see ExportTombstone
+    """
+    yield '{"projects": ['
+    for i, project in enumerate(projects):
+        out, docs = project_data(project)
+        # 'documents' is the last key of each project
+        yield (', ' if i else '') + json.dumps(out)[:-1] + ', "documents": ['
+        for j, doc in enumerate(docs):
+            yield (', ' if j else '') + json.dumps(doc)
+        yield ']}' if since is None else '], "deleted": ' + json.dumps(_tombstones(project, since)) + '}'
+    yield ']}'
+
+
+def accepts_gzip(request) -> bool:
+    return bool(re.search(r'\bgzip\b', request.META.get('HTTP_ACCEPT_ENCODING', '')))
+
+
+def _export_response(chunks: Iterator[str], f_name: str, gzip: bool = False) -> StreamingHttpResponse:
+    # taken before any of the export is read, so passing it as the next since never misses a change
+    cursor = timezone.now().isoformat()
+    content = (chunk.encode('utf-8') for chunk in chunks)
+    response = StreamingHttpResponse(compress_sequence(content) if gzip else content, content_type='text/json')
+    response['X-Export-Cursor'] = cursor
+    if gzip:
+        response['Content-Encoding'] = 'gzip'
     response['Content-Disposition'] = 'attachment; filename={}'.format(f_name)
     return response
 
 
+def download_projects_without_text(projects, with_doc_name, gzip: bool = False, since: datetime = None):
+    f_name = "MedCAT_Export_No_Text_{}.json".format(datetime.now().strftime('%Y-%m-%d:%H:%M:%S'))
+    return _export_response(_stream_projects_json(projects, lambda p: _project_without_text(p, with_doc_name, since),
+                                                  since), f_name, gzip)
+
+
 def download(modeladmin, request, queryset):
     if not request.user.is_staff:
         raise PermissionDenied
     projects = queryset
-    return download_projects_with_text(projects)
+    return download_projects_with_text(projects, gzip=accepts_gzip(request))
 
 
-def download_projects_with_text(projects: QuerySet):
-    all_projects = retrieve_project_data(projects)
-
-    sio = StringIO()
-    json.dump(all_projects, sio)
-    sio.seek(0)
+def download_projects_with_text(projects: QuerySet, gzip: bool = False, since: datetime = None):
+    """
+    Streams the retrieve_project_data JSON of projects, optionally gzip encoded.
 
+    The X-Export-Cursor header of the response can be passed as since to a later export, that then only includes
+    documents changed since, and per project the 'deleted' annotations, meta annotations, relations and documents.
+    """
     f_name = "MedCAT_Export_With_Text_{}.json".format(datetime.now().strftime('%Y-%m-%d:%H:%M:%S'))
-    response = HttpResponse(sio, content_type='text/json')
-    response['Content-Disposition'] = 'attachment; filename={}'.format(f_name)
+    return _export_response(_stream_projects_json(projects, lambda p: _project_with_text(p, since), since),
+                            f_name, gzip)
+
+
+def _columnar_schemas() -> Dict[str, 'pa.Schema']:
+    # repeated strings, i.e. CUIs, users and meta task names / values, are dictionary encoded
+    categorical = pa.dictionary(pa.int32(), pa.string())
+    timestamp = pa.timestamp('us', tz='UTC')
+    return {
+        'documents': pa.schema([('project_id', pa.int64()), ('document_id', pa.int64()), ('name', pa.string()),
+                                ('text', pa.string()), ('last_modified', timestamp)]),
+        'annotations': pa.schema([('id', pa.int64()), ('project_id', pa.int64()), ('document_id', pa.int64()),
+                                  ('user', categorical), ('cui', categorical), ('value', pa.string()),
+                                  ('start', pa.int64()), ('end', pa.int64()), ('validated', pa.bool_()),
+                                  ('correct', pa.bool_()), ('deleted', pa.bool_()), ('alternative', pa.bool_()),
+                                  ('killed', pa.bool_()), ('irrelevant', pa.bool_()),
+                                  ('manually_created', pa.bool_()), ('acc', pa.float64()),
+                                  ('comment', pa.string()), ('create_time', timestamp),
+                                  ('last_modified', timestamp)]),
+        'meta_annotations': pa.schema([('id', pa.int64()), ('annotation_id', pa.int64()),
+                                       ('project_id', pa.int64()), ('document_id', pa.int64()),
+                                       ('name', categorical), ('value', categorical), ('acc', pa.float64()),
+                                       ('validated', pa.bool_())]),
+        'relations': pa.schema([('id', pa.int64()), ('project_id', pa.int64()), ('document_id', pa.int64()),
+                                ('start_entity', pa.int64()), ('end_entity', pa.int64()),
+                                ('relation', categorical), ('user', categorical), ('validated', pa.bool_())]),
+    }
+
 
+def _columnar_rows(project, docs, doc_anns, ann_meta_anns, doc_rels) -> Dict[str, List[Dict]]:
+    anns = [ann for doc in docs for ann in doc_anns.get(doc.id, [])]
+    return {
+        'documents': [{'project_id': project.id, 'document_id': doc.id, 'name': doc.name, 'text': doc.text,
+                       'last_modified': doc.last_modified} for doc in docs],
+        'annotations': [{'id': ann.id, 'project_id': project.id, 'document_id': ann.document_id,
+                         'user': ann.user.username, 'cui': ann.entity.label, 'value': ann.value,
+                         'start': ann.start_ind, 'end': ann.end_ind, 'validated': ann.validated,
+                         'correct': ann.correct, 'deleted': ann.deleted, 'alternative': ann.alternative,
+                         'killed': ann.killed, 'irrelevant': ann.irrelevant,
+                         'manually_created': ann.manually_created, 'acc': ann.acc, 'comment': ann.comment,
+                         'create_time': ann.create_time, 'last_modified': ann.last_modified} for ann in anns],
+        'meta_annotations': [{'id': m.id, 'annotation_id': ann.id, 'project_id': project.id,
+                              'document_id': ann.document_id, 'name': m.meta_task.name,
+                              'value': m.meta_task_value.name, 'acc': m.acc, 'validated': m.validated}
+                             for ann in anns for m in ann_meta_anns.get(ann.id, [])],
+        'relations': [{'id': rel.id, 'project_id': project.id, 'document_id': rel.document_id,
+                       'start_entity': rel.start_entity_id, 'end_entity': rel.end_entity_id,
+                       'relation': rel.relation.label, 'user': rel.user.username, 'validated': rel.validated}
+                      for doc in docs for rel in doc_rels.get(doc.id, [])],
+    }
+
+
+def download_projects_columnar(projects: QuerySet, since: datetime = None) -> FileResponse:
+    """
+    Exports projects as a zip of separate documents, annotations, meta_annotations and relations tables, joined
+    on their project / document / annotation ids. Tables are Parquet files, or Arrow IPC streams if pyarrow has no
+    Parquet support, written a chunk of documents at a time.
+    :param since: as download_projects_with_text, only documents changed since. Deletions are not included.
+    """
+    if pa is None:
+        raise ValueError('pyarrow must be installed for columnar exports')
+    cursor = timezone.now().isoformat()
+    schemas = _columnar_schemas()
+    ext = 'parquet' if pq is not None else 'arrows'
+    zip_file = tempfile.TemporaryFile()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = {name: os.path.join(tmp_dir, f'{name}.{ext}') for name in schemas}
+        writers = {name: pq.ParquetWriter(paths[name], schema) if pq is not None else
+                   pa.ipc.new_stream(paths[name], schema) for name, schema in schemas.items()}
+        try:
+            for project in projects:
+                for chunk in _document_chunks(project, since):
+                    for name, rows in _columnar_rows(project, *chunk).items():
+                        if rows:
+                            writers[name].write_table(pa.Table.from_pylist(rows, schema=schemas[name]))
+        finally:
+            for writer in writers.values():
+                writer.close()
+
+        with zipfile.ZipFile(zip_file, 'w', zipfile.ZIP_STORED) as zf:
+            for path in paths.values():
+                zf.write(path, os.path.basename(path))
+    zip_file.seek(0)
+
+    f_name = "MedCAT_Export_Columnar_{}.zip".format(datetime.now().strftime('%Y-%m-%d:%H:%M:%S'))
+    response = FileResponse(zip_file, as_attachment=True, filename=f_name, content_type='application/zip')
+    response['X-Export-Cursor'] = cursor
     return response
 
 
@@ -234,99 +432,99 @@ def retrieve_project_data(projects: QuerySet) -> Dict[str, List]:
     """
     all_projects = {'projects': []}
     for project in projects:
-        out = {}
-        out['name'] = project.name
-        out['id'] = project.id
-        out['cuis'] = project.cuis
-        out['project_group_id'] = project.group.id if project.group else None
-        out['project_group_name'] = project.group.name if project.group else None
-        out['project_status'] = project.project_status
-        out['project_locked'] = project.project_locked
-        out['meta_anno_defs'] = [{'name': t.name, 'values': [v.name for v in t.values.all()]}
-                                 for t in project.tasks.all()]
-        out['relation_anno_defs'] = [r.label for r in project.relations.all()]
-        out['documents'] = []
-
-        if project.cuis_file is not None and project.cuis_file:
-            # Add cuis from json file if it exists
-            cuis_from_file = ",".join(json.load(open(project.cuis_file.path)))
-            all_cuis = out['cuis'] + "," + cuis_from_file if len(out['cuis']) > 0 else cuis_from_file
-            out['cuis'] = all_cuis
-
-        for doc in project.validated_documents.all():
-            out_doc = {}
-            out_doc['id'] = doc.id
-            out_doc['name'] = doc.name
-            out_doc['text'] = doc.text
-            out_doc['last_modified'] = doc.last_modified.strftime(_dt_fmt)
-            out_doc['annotations'] = []
-
-            anns = AnnotatedEntity.objects.filter(project=project, document=doc)
-
-            for ann in anns:
-                out_ann = {}
-                out_ann['id'] = ann.id
-                out_ann['user'] = ann.user.username
-                out_ann['cui'] = ann.entity.label
-                out_ann['value'] = ann.value
-                out_ann['start'] = ann.start_ind
-                out_ann['end'] = ann.end_ind
-                out_ann['validated'] = ann.validated
-                out_ann['correct'] = ann.correct
-                out_ann['deleted'] = ann.deleted
-                out_ann['alternative'] = ann.alternative
-                out_ann['killed'] = ann.killed
-                out_ann['irrelevant'] = ann.irrelevant
-                out_ann['create_time'] = ann.create_time.strftime(_dt_fmt)
-                out_ann['last_modified'] = ann.last_modified.strftime(_dt_fmt)
-                out_ann['comment'] = ann.comment
-                out_ann['manually_created'] = ann.manually_created
-                out_ann['acc'] = ann.acc
-                out_ann['meta_anns'] = {}
-
-                # Get MetaAnnotations
-                meta_anns = MetaAnnotation.objects.filter(annotated_entity=ann)
-                for meta_ann in meta_anns:
-                    o_meta_ann = {}
-                    o_meta_ann['name'] = meta_ann.meta_task.name
-                    o_meta_ann['value'] = meta_ann.meta_task_value.name
-                    o_meta_ann['acc'] = meta_ann.acc
-                    o_meta_ann['validated'] = meta_ann.validated
-
-                    # Add annotation
-                    key = meta_ann.meta_task.name
-                    out_ann['meta_anns'][key] = o_meta_ann
-
-                out_doc['annotations'].append(out_ann)
-
-            # Add relations if they exist
-            rels = EntityRelation.objects.filter(project=project, document=doc)
-            out_rels = []
-            out_rel = {}
-            for rel in rels:
-                out_rel['start_entity'] = rel.start_entity.id
-                out_rel['start_entity_cui'] = rel.start_entity.entity.label
-                out_rel['start_entity_value'] = rel.start_entity.value
-                out_rel['start_entity_start_idx'] = rel.start_entity.start_ind
-                out_rel['start_entity_end_idx'] = rel.start_entity.end_ind
-                out_rel['end_entity'] = rel.end_entity.id
-                out_rel['end_entity_cui'] = rel.end_entity.entity.label
-                out_rel['end_entity_value'] = rel.end_entity.value
-                out_rel['end_entity_start_idx'] = rel.end_entity.start_ind
-                out_rel['end_entity_end_idx'] = rel.end_entity.end_ind
-                out_rel['user'] = rel.user.username
-                out_rel['relation'] = rel.relation.label
-                out_rel['validated'] = rel.validated
-
-                out_rels.append(out_rel)
-                out_rel = {}
-            out_doc['relations'] = out_rels
-
-            out['documents'].append(out_doc)
+        out, docs = _project_with_text(project)
+        out['documents'] = list(docs)
         all_projects['projects'].append(out)
     return all_projects
 
 
+def _project_with_text(project, since: datetime = None) -> Tuple[Dict, Iterator[Dict]]:
+    out = {}
+    out['name'] = project.name
+    out['id'] = project.id
+    out['cuis'] = _project_cuis(project)
+    out['project_group_id'] = project.group.id if project.group else None
+    out['project_group_name'] = project.group.name if project.group else None
+    out['project_status'] = project.project_status
+    out['project_locked'] = project.project_locked
+    out['meta_anno_defs'] = [{'name': t.name, 'values': [v.name for v in t.values.all()]}
+                             for t in project.tasks.prefetch_related('values')]
+    out['relation_anno_defs'] = [r.label for r in project.relations.all()]
+    return out, _documents_with_text(project, since)
+
+
+def _documents_with_text(project, since: datetime = None) -> Iterator[Dict]:
+    for docs, doc_anns, ann_meta_anns, doc_rels in _document_chunks(project, since):
+        yield from (_document_with_text(doc, doc_anns, ann_meta_anns, doc_rels) for doc in docs)
+
+
+def _document_with_text(doc, doc_anns, ann_meta_anns, doc_rels) -> Dict:
+    out_doc = {}
+    out_doc['id'] = doc.id
+    out_doc['name'] = doc.name
+    out_doc['text'] = doc.text
+    out_doc['last_modified'] = doc.last_modified.strftime(_dt_fmt)
+    out_doc['annotations'] = []
+
+    for ann in doc_anns.get(doc.id, []):
+        out_ann = {}
+        out_ann['id'] = ann.id
+        out_ann['user'] = ann.user.username
+        out_ann['cui'] = ann.entity.label
+        out_ann['value'] = ann.value
+        out_ann['start'] = ann.start_ind
+        out_ann['end'] = ann.end_ind
+        out_ann['validated'] = ann.validated
+        out_ann['correct'] = ann.correct
+        out_ann['deleted'] = ann.deleted
+        out_ann['alternative'] = ann.alternative
+        out_ann['killed'] = ann.killed
+        out_ann['irrelevant'] = ann.irrelevant
+        out_ann['create_time'] = ann.create_time.strftime(_dt_fmt)
+        out_ann['last_modified'] = ann.last_modified.strftime(_dt_fmt)
+        out_ann['comment'] = ann.comment
+        out_ann['manually_created'] = ann.manually_created
+        out_ann['acc'] = ann.acc
+        out_ann['meta_anns'] = {}
+
+        # Get MetaAnnotations
+        for meta_ann in ann_meta_anns.get(ann.id, []):
+            o_meta_ann = {}
+            o_meta_ann['name'] = meta_ann.meta_task.name
+            o_meta_ann['value'] = meta_ann.meta_task_value.name
+            o_meta_ann['acc'] = meta_ann.acc
+            o_meta_ann['validated'] = meta_ann.validated
+
+            # Add annotation
+            key = meta_ann.meta_task.name
+            out_ann['meta_anns'][key] = o_meta_ann
+
+        out_doc['annotations'].append(out_ann)
+
+    # Add relations if they exist
+    out_rels = []
+    out_rel = {}
+    for rel in doc_rels.get(doc.id, []):
+        out_rel['start_entity'] = rel.start_entity.id
+        out_rel['start_entity_cui'] = rel.start_entity.entity.label
+        out_rel['start_entity_value'] = rel.start_entity.value
+        out_rel['start_entity_start_idx'] = rel.start_entity.start_ind
+        out_rel['start_entity_end_idx'] = rel.start_entity.end_ind
+        out_rel['end_entity'] = rel.end_entity.id
+        out_rel['end_entity_cui'] = rel.end_entity.entity.label
+        out_rel['end_entity_value'] = rel.end_entity.value
+        out_rel['end_entity_start_idx'] = rel.end_entity.start_ind
+        out_rel['end_entity_end_idx'] = rel.end_entity.end_ind
+        out_rel['user'] = rel.user.username
+        out_rel['relation'] = rel.relation.label
+        out_rel['validated'] = rel.validated
+
+        out_rels.append(out_rel)
+        out_rel = {}
+    out_doc['relations'] = out_rels
+    return out_doc
+
+
 def clone_projects(modeladmin, request, queryset):
     if not request.user.is_staff:
         raise PermissionDenied
@@ -365,10 +563,10 @@ def _reset_cdb_filters(id):
 
 @background(schedule=5)
 def import_concepts_from_cdb(cdb_model_id: int):
-    from medcat.cdb import CDB
+    from api.cdb_delta import load_cdb
 
     cdb_model = ConceptDB.objects.get(id=cdb_model_id)
-    cdb = CDB.load(cdb_model.cdb_file.path)
+    cdb = load_cdb(cdb_model.cdb_file.path)
 
     import_all_concepts(cdb, cdb_model)
 
@@ -390,4 +588,5 @@ def delete_indexed_concepts(modeladmin, request, queryset):
 
 
 def remove_all_documents(modeladmin, request, queryset):
+    ExportTombstone.documents_deleted(Document.objects.all())
     Document.objects.all().delete()
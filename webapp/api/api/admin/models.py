@@ -40,7 +40,8 @@ class DatasetAdmin(ReportErrorModelAdminMixin, admin.ModelAdmin):
 
 class ProjectAnnotateEntitiesAdmin(admin.ModelAdmin):
     model = ProjectAnnotateEntities
-    actions = [download, download_without_text, download_without_text_with_doc_names, reset_project, clone_projects]
+    actions = [download, download_without_text, download_without_text_with_doc_names, reset_project, clone_projects,
+               preload_project_models]
     list_filter = ('members', 'project_status', 'project_locked', 'annotation_classification')
     list_display = ['name']
     fields = (('group', 'name', 'description', 'annotation_guideline_link', 'members',
@@ -13,23 +13,21 @@ class ApiConfig(AppConfig):
         from api.views import _submit_document
         from api.models import ProjectAnnotateEntities
         from . import signals
+        preload = os.environ.get('MEDCAT_PRELOAD_PROJECTS', '').strip()
+        if preload:
+            from api.model_cache import preload_models
+            if preload.lower() == 'all':
+                projects = ProjectAnnotateEntities.objects.filter(project_status='A')
+            else:
+                projects = ProjectAnnotateEntities.objects.filter(
+                    id__in=[int(p) for p in preload.split(',') if p.strip().isdigit()])
+            logger.info('Found env var MEDCAT_PRELOAD_PROJECTS:%s, loading project models in the background', preload)
+            preload_models(projects)
         resubmit_all = os.environ.get('RESUBMIT_ALL_ON_STARTUP', None)
         if resubmit_all is not None and resubmit_all.lower() in ('1', 'y', 'true'):
             logger.info('Found env var RESUBMIT_ALL_ON_STARTUP is True. '
-                        'Attempting to resubmit all currently submitted state documents')
+                        'Resubmitting all currently submitted state documents in the background')
 
-            projects = ProjectAnnotateEntities.objects.all()
-            for project in projects:
-                if project.project_status == 'A':
-                    logger.info('Found project %s - in annotating state - resubmitting all validated documents...',
-                                project.name)
-                    validated_docs = project.validated_documents.all()
-                    if len(validated_docs):
-                        for doc in validated_docs:
-                            try:
-                                _submit_document(project, doc)
-                                logger.info("Submitted doc: %s", doc.name)
-                            except Exception as e:
-                                logger.error("Failed to re-submit doc on startup with exception %s", e)
-                    logger.info("Finished resubmitting Project %s", project.name)
+            from api.training_queue import replay_submissions
+            replay_submissions(_submit_document)
         logger.info("MedCATTrainer App API ready...")
@@ -0,0 +1,68 @@
+import logging
+import os
+from typing import Iterable, Iterator, List
+
+from medcat.cat import CAT
+from spacy.tokens import Doc
+
+from . import doc_cache
+
+"""
+Batched MedCAT inference over many documents, used to prepare documents for annotation.
+"""
+
+logger = logging.getLogger(__name__)
+
+try:
+    _PREP_BATCH_SIZE = max(int(os.getenv('MEDCAT_PREP_BATCH_SIZE', 100)), 1)
+except ValueError:
+    _PREP_BATCH_SIZE = 100
+    logger.warning('MEDCAT_PREP_BATCH_SIZE is not an integer, using default value of 100')
+
+
+def _trimmed(cat: CAT, texts: Iterable[str]) -> List[str]:
+    max_len = cat.config.preprocessing.max_document_length
+    return [str(text)[:max_len] if text else '' for text in texts]
+
+
+def _pipe(cat: CAT, texts: List[str], batch_size: int) -> Iterator[Doc]:
+    # as CAT.__call__, but passes batches of texts through each pipeline component, i.e. MetaCAT / transformer NER
+    # predict a batch at a time.
+    cat.config.linking.train = False
+    for i in range(0, len(texts), batch_size):
+        batch = texts[i:i + batch_size]
+        try:
+            docs = list(cat.pipe.spacy_nlp.pipe(batch, batch_size=batch_size))
+        except Exception as e:
+            # a document failing fails its whole batch, so rerun the batch a document at a time, as CAT.__call__,
+            # so only that document fails. CAT.__call__ returns None for empty texts, where the batch gives a Doc.
+            logger.warning('Failed to annotate a batch of %s documents, annotating each alone: %s', len(batch), e)
+            docs = [cat(text) if text else cat.pipe.spacy_nlp(text) for text in batch]
+        yield from docs
+
+
+def annotate_texts(cat: CAT, texts: Iterable[str], batch_size: int = None) -> Iterator[Doc]:
+    """
+    Run cat over texts in batches. Equivalent to calling cat(text) for each text, including linking with the
+    cui_filter active at the time of the call.
+    :param cat: the, possibly shared, CAT
+    :param texts: the document texts
+    :param batch_size: number of texts per batch, default env var MEDCAT_PREP_BATCH_SIZE
+    :return: a spacy Doc, with entities in doc._.ents, for each text in order
+    """
+    return _pipe(cat, _trimmed(cat, texts), batch_size or _PREP_BATCH_SIZE)
+
+
+def annotate_documents(cat: CAT, documents: List, batch_size: int = None) -> Iterator[Doc]:
+    """
+    As annotate_texts, for the text of each Document, reusing Docs from the doc_cache made by the current model
+    and cui_filter, and caching those made.
+    """
+    cached = [doc_cache.get(cat, document) for document in documents]
+    to_annotate = [document for document, doc in zip(documents, cached) if doc is None]
+    new_docs = annotate_texts(cat, [document.text for document in to_annotate], batch_size)
+    for document, doc in zip(documents, cached):
+        if doc is None:
+            doc = next(new_docs)
+            doc_cache.put(cat, document, doc)
+        yield doc
@@ -0,0 +1,341 @@
+import fcntl
+import logging
+import os
+import pickle
+import threading
+import weakref
+from contextlib import contextmanager
+from typing import Optional, Set
+
+from medcat.cdb import CDB
+
+"""
+Incremental persistence of CDBs. Rather than re-writing the whole CDB on each save, the concepts and names
+changed since the last save are appended to a delta log kept next to the CDB file, <cdb file>.delta. Loading a
+CDB replays its log, and once the log grows past a fraction of the CDB size it is compacted, in a background
+thread, into a new full snapshot of the CDB.
+
+Each log record holds the full current state of each changed concept / name, so replaying records in order
+is idempotent and a record torn by a crash part way through a save is simply ignored.
+
+Enabled with env var MEDCAT_CDB_DELTA_SAVE. Any existing log is replayed on load regardless, and removed by the
+next full save.
+"""
+
+logger = logging.getLogger(__name__)
+
+_ENABLED = os.getenv('MEDCAT_CDB_DELTA_SAVE', '0').lower() in ('1', 'y', 'true')
+
+try:
+    # compact the delta log once it is this fraction of the size of the CDB file
+    _COMPACT_RATIO = float(os.getenv('MEDCAT_CDB_DELTA_COMPACT_RATIO', 0.1))
+except ValueError:
+    _COMPACT_RATIO = 0.1
+    logger.warning('MEDCAT_CDB_DELTA_COMPACT_RATIO is not a number, using default value of 0.1')
+
+_CUI_ATTRS = ('cui2names', 'cui2snames', 'cui2context_vectors', 'cui2count_train', 'cui2tags', 'cui2type_ids',
+              'cui2preferred_name', 'cui2average_confidence')
+_NAME_ATTRS = ('name2cuis', 'name2cuis2status', 'name2count_train', 'name_isupper')
+
+
+class _Changes:
+    """The concepts, names and vocab tokens of a CDB changed since it was last saved."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.cuis: Set[str] = set()
+        self.names: Set[str] = set()
+        self.tokens: Set[str] = set()
+        # set by changes not recorded by concept / name, these are saved with a full snapshot
+        self.full = False
+
+    def take(self):
+        with self.lock:
+            taken = self.cuis, self.names, self.tokens, self.full
+            self.cuis, self.names, self.tokens, self.full = set(), set(), set(), False
+        return taken
+
+    def restore(self, taken):
+        """Merge back changes taken by take, but not saved."""
+        cuis, names, tokens, full = taken
+        with self.lock:
+            self.cuis.update(cuis)
+            self.names.update(names)
+            self.tokens.update(tokens)
+            self.full = self.full or full
+
+
+_changes = weakref.WeakKeyDictionary()
+
+
+def _record(cdb: CDB, cuis=(), names=(), tokens=(), full=False):
+    changes = _changes.get(cdb)
+    if changes is not None:
+        with changes.lock:
+            changes.cuis.update(cuis)
+            changes.names.update(names)
+            changes.tokens.update(tokens)
+            changes.full = changes.full or full
+
+
+class TrackedCDB(CDB):
+    """A CDB recording what its training changes, see track. Only the instance __dict__ is saved, not the class."""
+
+    def _add_concept(self, cui, names, *args, **kwargs):
+        _record(self, cuis=[cui], names=names,
+                tokens=[token for name_info in names.values() for token in name_info['tokens']])
+        super()._add_concept(cui, names, *args, **kwargs)
+
+    def _remove_names(self, cui, names):
+        names = list(names)
+        _record(self, cuis=[cui], names=names)
+        super()._remove_names(cui, names)
+
+    def remove_cui(self, cui):
+        _record(self, cuis=[cui], names=self.cui2names.get(cui, ()))
+        super().remove_cui(cui)
+
+    def update_context_vector(self, cui, *args, **kwargs):
+        _record(self, cuis=[cui])
+        super().update_context_vector(cui, *args, **kwargs)
+
+    def update_cui2average_confidence(self, cui, new_sim):
+        _record(self, cuis=[cui])
+        super().update_cui2average_confidence(cui, new_sim)
+
+    def import_training(self, *args, **kwargs):
+        _record(self, full=True)
+        super().import_training(*args, **kwargs)
+
+    def reset_training(self):
+        _record(self, full=True)
+        super().reset_training()
+
+    def reset_cui_count(self, *args, **kwargs):
+        _record(self, full=True)
+        super().reset_cui_count(*args, **kwargs)
+
+    def filter_by_cui(self, *args, **kwargs):
+        _record(self, full=True)
+        super().filter_by_cui(*args, **kwargs)
+
+    def add_addl_info(self, *args, **kwargs):
+        _record(self, full=True)
+        super().add_addl_info(*args, **kwargs)
+
+    def populate_cui2snames(self, *args, **kwargs):
+        _record(self, full=True)
+        super().populate_cui2snames(*args, **kwargs)
+
+
+def _log_path(cdb_path: str) -> str:
+    return cdb_path + '.delta'
+
+
+@contextmanager
+def _file_lock(cdb_path: str):
+    # appends and compaction can come from any api / background process
+    with open(cdb_path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _read_records(log_path: str, end: Optional[int] = None):
+    """Yield the records of the log, up to byte offset end, stopping at a torn final record."""
+    if not os.path.exists(log_path):
+        return
+    with open(log_path, 'rb') as f:
+        while end is None or f.tell() < end:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                return
+            except (pickle.UnpicklingError, ValueError, AttributeError) as e:
+                logger.warning('Ignoring incomplete record at the end of CDB delta log %s: %s', log_path, e)
+                return
+
+
+def _apply(cdb: CDB, record: dict):
+    for attr in _CUI_ATTRS:
+        values = getattr(cdb, attr)
+        for cui, value in record['cuis'][attr].items():
+            if value is None:
+                values.pop(cui, None)
+            else:
+                values[cui] = value
+    for attr in _NAME_ATTRS:
+        values = getattr(cdb, attr)
+        for name, value in record['names'][attr].items():
+            if value is None:
+                values.pop(name, None)
+            else:
+                values[name] = value
+    cdb.vocab.update(record['vocab'])
+    if isinstance(cdb.snames, set):
+        for snames in record['cuis']['cui2snames'].values():
+            cdb.snames.update(snames or ())
+    cdb.is_dirty = True
+
+
+def _replay(cdb: CDB, cdb_path: str, end: Optional[int] = None) -> int:
+    applied = 0
+    for record in _read_records(_log_path(cdb_path), end):
+        _apply(cdb, record)
+        applied += 1
+    return applied
+
+
+def loading(cdb_path: str):
+    """
+    Hold while loading the CDB at cdb_path and replaying its log, so a compaction can't replace the CDB and its
+    log in between, leaving the CDB loaded from before the compaction and the log from after it.
+    """
+    return _file_lock(cdb_path)
+
+
+def load_cdb(cdb_path: str) -> CDB:
+    """Load the CDB at cdb_path, including changes in its delta log."""
+    with loading(cdb_path):
+        return replay(CDB.load(cdb_path), cdb_path)
+
+
+def replay(cdb: CDB, cdb_path: str) -> CDB:
+    """
+    Apply the delta log, if any, to a CDB just loaded from cdb_path, within loading(cdb_path).
+    :return: the same CDB
+    """
+    applied = _replay(cdb, cdb_path)
+    if applied:
+        logger.info('Replayed %s delta records onto CDB %s', applied, cdb_path)
+    return cdb
+
+
+def track(cdb: CDB) -> CDB:
+    """
+    Start recording the concepts and names training changes in cdb, so save_cdb only saves those.
+    :param cdb: the loaded, and replayed, CDB
+    :return: the same CDB
+    """
+    if not _ENABLED:
+        return cdb
+    if type(cdb) is CDB:
+        cdb.__class__ = TrackedCDB
+    _changes.setdefault(cdb, _Changes())
+    return cdb
+
+
+def _snapshot(cdb: CDB, cdb_path: str):
+    # written aside then renamed, so a failed save never leaves a partial CDB
+    tmp_path = cdb_path + '.tmp'
+    cdb.save(tmp_path)
+    os.replace(tmp_path, cdb_path)
+
+
+def save_cdb(cdb: CDB, cdb_path: str):
+    """
+    Persist cdb to cdb_path. For a tracked CDB only the concepts and names changed since the last save are
+    appended to its delta log, otherwise the whole CDB is written.
+    :param cdb: the CDB
+    :param cdb_path: the CDB file
+    """
+    changes = _changes.get(cdb)
+    taken = changes.take() if changes is not None else (set(), set(), set(), True)
+    try:
+        _save_changes(cdb, cdb_path, *taken)
+    except Exception:
+        if changes is not None:
+            # still unsaved, so saved by the next save_cdb instead
+            changes.restore(taken)
+        raise
+
+
+def _save_changes(cdb: CDB, cdb_path: str, cuis: Set[str], names: Set[str], tokens: Set[str], full: bool):
+    if full or getattr(cdb, '_memory_optimised_parts', None):
+        with _file_lock(cdb_path):
+            _snapshot(cdb, cdb_path)
+            # the snapshot holds the changes of the log, which must not then be replayed over it
+            if os.path.exists(_log_path(cdb_path)):
+                os.remove(_log_path(cdb_path))
+        return
+    if not (cuis or names or tokens):
+        return
+
+    record = {
+        'cuis': {attr: {cui: getattr(cdb, attr).get(cui) for cui in cuis} for attr in _CUI_ATTRS},
+        'names': {attr: {name: getattr(cdb, attr).get(name) for name in names} for attr in _NAME_ATTRS},
+        'vocab': {token: cdb.vocab[token] for token in tokens if token in cdb.vocab},
+    }
+    data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+    with _file_lock(cdb_path):
+        with open(_log_path(cdb_path), 'ab') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        log_size = os.path.getsize(_log_path(cdb_path))
+    logger.info('Saved %s changed concepts and %s changed names of CDB %s', len(cuis), len(names), cdb_path)
+    if log_size > _COMPACT_RATIO * os.path.getsize(cdb_path):
+        compact_in_background(cdb_path)
+
+
+def _file_id(path: str):
+    # replacing a file never gives the new file the inode of the old, as both exist until the replace
+    st = os.stat(path)
+    return st.st_dev, st.st_ino, st.st_mtime_ns
+
+
+_compacting: Set[str] = set()
+_compacting_lock = threading.Lock()
+
+
+def compact(cdb_path: str):
+    """
+    Fold the delta log of the CDB at cdb_path into a new full snapshot. This loads a second copy of the CDB
+    from disk, so never touches CDBs in use, and keeps records appended while compacting.
+    """
+    log_path = _log_path(cdb_path)
+    with _file_lock(cdb_path):
+        end = os.path.getsize(log_path) if os.path.exists(log_path) else 0
+        snapshot = _file_id(cdb_path)
+    if not end:
+        return
+    cdb = CDB.load(cdb_path)
+    applied = _replay(cdb, cdb_path, end)
+    tmp_path = cdb_path + '.compact.tmp'
+    cdb.save(tmp_path)
+    with _file_lock(cdb_path):
+        if _file_id(cdb_path) != snapshot or not os.path.exists(log_path) or os.path.getsize(log_path) < end:
+            # a full snapshot was saved meanwhile, which already holds these changes. The log may have since
+            # regrown past end, so this is told by the CDB file having been replaced.
+            os.remove(tmp_path)
+            return
+        with open(log_path, 'rb') as f:
+            f.seek(end)
+            remaining = f.read()
+        os.replace(tmp_path, cdb_path)
+        with open(log_path + '.tmp', 'wb') as f:
+            f.write(remaining)
+        os.replace(log_path + '.tmp', log_path)
+    logger.info('Compacted %s delta records into CDB %s', applied, cdb_path)
+
+
+def compact_in_background(cdb_path: str) -> Optional[threading.Thread]:
+    with _compacting_lock:
+        if cdb_path in _compacting:
+            return None
+        _compacting.add(cdb_path)
+
+    def _compact():
+        try:
+            compact(cdb_path)
+        except Exception as e:
+            logger.error('Failed to compact delta log of CDB %s: %s', cdb_path, e)
+        finally:
+            with _compacting_lock:
+                _compacting.discard(cdb_path)
+
+    thread = threading.Thread(target=_compact, name='medcat-cdb-compact', daemon=True)
+    thread.start()
+    return thread
@@ -3,73 +3,256 @@ import logging
 import re
 from collections import defaultdict
 from datetime import datetime
-from typing import Dict
+from itertools import islice
+from typing import Callable, Dict, Iterator, List, Optional
 
+import openpyxl
+from background_task import background
 from django.contrib.auth.models import User
-from django.db import transaction
-from django.db.models import Q
+from django.db import models, transaction
 
 from core.settings import MEDIA_ROOT
 from .models import *
 from .utils import env_str_to_bool
 
 _MAX_DATASET_SIZE_DEFAULT = 10000
+_DATASET_IMPORT_CHUNK_SIZE_DEFAULT = 1000
 _dt_fmt = '%Y-%m-%d %H:%M:%S.%f'
 
 logger = logging.getLogger(__name__)
 
 
-def dataset_from_file(dataset: Dataset):
-    if '.csv' in dataset.original_file.path:
-        df = pd.read_csv(dataset.original_file.path, on_bad_lines='error')
-    elif '.xlsx' in dataset.original_file.path:
-        df = pd.read_excel(dataset.original_file.path)
+def _dataset_chunk_size() -> int:
+    try:
+        return max(int(os.environ.get('DATASET_IMPORT_CHUNK_SIZE', _DATASET_IMPORT_CHUNK_SIZE_DEFAULT)), 1)
+    except ValueError:
+        logger.warning('DATASET_IMPORT_CHUNK_SIZE is not an integer, using default value of %s',
+                       _DATASET_IMPORT_CHUNK_SIZE_DEFAULT)
+        return _DATASET_IMPORT_CHUNK_SIZE_DEFAULT
+
+
+def _xlsx_rows(file) -> Iterator[tuple]:
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        for row in wb.worksheets[0].iter_rows(values_only=True):
+            if any(v is not None for v in row):
+                yield row
+    finally:
+        wb.close()
+
+
+def dataset_columns(file, file_name: str) -> List[str]:
+    """
+    The lower cased column names of a .csv or .xlsx dataset file, reading only its header.
+    :param file: path or file object of the dataset
+    :param file_name: name of the file, for its extension
+    :return: the column names
+    """
+    if '.csv' in file_name:
+        columns = pd.read_csv(file, nrows=0).columns
+    elif '.xlsx' in file_name:
+        columns = next(_xlsx_rows(file), ())
     else:
-        raise Exception("Please make sure the file is either a .csv or .xlsx format")
+        raise ValueError("Please make sure the file is either a .csv or .xlsx format")
+    return [str(c).lower() for c in columns]
 
-    df.columns = [c.lower() for c in df.columns]
-    max_dataset_size = int(os.environ.get('MAX_DATASET_SIZE', _MAX_DATASET_SIZE_DEFAULT))
 
-    if df['name'].nunique() != df.shape[0] and env_str_to_bool('UNIQUE_DOC_NAMES_IN_DATASETS', True):
-        raise Exception('name column entries must be unique')
+def _dataset_chunks(path: str, chunk_size: int) -> Iterator[pd.DataFrame]:
+    """The rows of the dataset file at path, in DataFrames of up to chunk_size rows with lower cased columns."""
+    if '.csv' in path:
+        for chunk in pd.read_csv(path, on_bad_lines='error', chunksize=chunk_size):
+            chunk.columns = [str(c).lower() for c in chunk.columns]
+            yield chunk
+    elif '.xlsx' in path:
+        rows = _xlsx_rows(path)
+        columns = [str(c).lower() for c in next(rows, ())]
+        while True:
+            batch = list(islice(rows, chunk_size))
+            if not batch:
+                return
+            yield pd.DataFrame(batch, columns=columns)
+    else:
+        raise Exception("Please make sure the file is either a .csv or .xlsx format")
 
-    if df.shape[0] > int(max_dataset_size):
-        raise Exception(f'Attempting to upload a dataset with {df.shape[0]} rows. The Max dataset size is set to'
-                        f' {max_dataset_size}, please reduce the number of rows or contact the MedCATTrainer'
-                        f' administrator to increase the env var value:MAX_DATASET_SIZE')
 
-    if 'text' not in df.columns or 'name' not in df.columns:
+def dataset_from_file(dataset: Dataset):
+    """
+    Create the documents of a dataset from its uploaded .csv / .xlsx file. The file is read, sanitised and inserted
+    in chunks of env var DATASET_IMPORT_CHUNK_SIZE rows, so memory use does not grow with the size of the dataset.
+    """
+    path = dataset.original_file.path
+    columns = dataset_columns(path, path)
+    if 'text' not in columns or 'name' not in columns:
         raise Exception("Please make sure the uploaded file has a column with two columns:'name', 'text'. "
                         "The 'name' column are document IDs, and the 'text' column is the text you're "
                         "collecting annotations for")
 
+    max_dataset_size = int(os.environ.get('MAX_DATASET_SIZE', _MAX_DATASET_SIZE_DEFAULT))
+    unique_names = env_str_to_bool('UNIQUE_DOC_NAMES_IN_DATASETS', True)
+    chunk_size = _dataset_chunk_size()
+    names = set()
+    n_rows = 0
+
     with transaction.atomic():
-        for i, row in enumerate(df.iterrows()):
-            row = row[1]
-            document = Document()
-            document.name = row['name']
-            document.text = sanitise_input(row['text'])
-            document.dataset = dataset
-            document.save()
+        for chunk in _dataset_chunks(path, chunk_size):
+            n_rows += len(chunk)
+            if n_rows > max_dataset_size:
+                raise Exception(f'Attempting to upload a dataset with more than {max_dataset_size} rows. The Max '
+                                f'dataset size is set to {max_dataset_size}, please reduce the number of rows or '
+                                f'contact the MedCATTrainer administrator to increase the env var '
+                                f'value:MAX_DATASET_SIZE')
+            if unique_names:
+                chunk_names = set(chunk['name'])
+                if len(chunk_names) != len(chunk) or not names.isdisjoint(chunk_names):
+                    raise Exception('name column entries must be unique')
+                names |= chunk_names
 
+            texts = sanitise_texts(chunk['text'].fillna('').astype(str))
+            Document.objects.bulk_create([Document(name=name, text=text, text_hash=Document.hash_text(text),
+                                                   dataset=dataset)
+                                          for name, text in zip(chunk['name'], texts)])
+            logger.info('Imported %s rows of dataset %s', n_rows, dataset.name)
 
-def sanitise_input(text: str):
-    tags = [('<br>', '\n'), ('</?p>', '\n'), ('<span(?:.*?)?>', ''),
-            ('</span>', ''), ('<div (?:.*?)?>', '\n'), ('</div>', '\n'),
-            ('</?html>', ''), ('</?body>', ''), ('</?head>', '')]
-    for tag, repl in tags:
+
+# applied in order by sanitise_input
+_SANITISE_TAGS = [('<br>', '\n'), ('</?p>', '\n'), ('<span(?:.*?)?>', ''),
+                  ('</span>', ''), ('<div (?:.*?)?>', '\n'), ('</div>', '\n'),
+                  ('</?html>', ''), ('</?body>', ''), ('</?head>', '')]
+# the same tags, grouped by replacement and sharing the '<' prefix so each group is one scan of the text
+_NEWLINE_TAGS = re.compile('<(?:br>|/?p>|div (?:.*?)?>|/div>)')
+_DROPPED_TAGS = re.compile('<(?:span(?:.*?)?>|/span>|/?html>|/?body>|/?head>)')
+# a '<' not closed before the next '<'. Without one, tags can't overlap nor be formed by dropping other tags, so
+# replacing all of them at once gives the same text as replacing each kind in turn.
+_UNCLOSED_TAG = re.compile('<[^>]*<')
+
+
+def _sanitise_in_order(text: str) -> str:
+    for tag, repl in _SANITISE_TAGS:
         text = re.sub(tag, repl, text)
     return text
 
 
+def _sanitise_unnested(text: str) -> str:
+    return _DROPPED_TAGS.sub('', _NEWLINE_TAGS.sub('\n', text))
+
+
+def sanitise_input(text: str):
+    if '<' not in text:
+        return text
+    if _UNCLOSED_TAG.search(text):
+        return _sanitise_in_order(text)
+    return _sanitise_unnested(text)
+
+
+def sanitise_texts(texts: pd.Series) -> pd.Series:
+    """sanitise_input over a Series of texts."""
+    texts = texts.copy()
+    tagged = texts.str.contains('<', regex=False)
+    unclosed = tagged & texts.str.contains(_UNCLOSED_TAG, regex=True)
+    unnested = tagged & ~unclosed
+    if unnested.any():
+        texts[unnested] = texts[unnested].str.replace(_NEWLINE_TAGS, '\n', regex=True) \
+            .str.replace(_DROPPED_TAGS, '', regex=True)
+    if unclosed.any():
+        texts[unclosed] = texts[unclosed].map(_sanitise_in_order)
+    return texts
+
+
 def delete_orphan_docs(dataset: Dataset):
-    Document.objects.filter(dataset__id=dataset.id).delete()
+    documents = Document.objects.filter(dataset__id=dataset.id)
+    ExportTombstone.documents_deleted(documents)
+    documents.delete()
 
 
-def upload_projects_export(medcat_export: Dict):
+def _get_or_create_all(model, field: str, values) -> Dict[str, models.Model]:
+    """The instances of model with each of values for its unique field, creating those missing, in two queries."""
+    values = set(values)
+    if not values:
+        return {}
+    model.objects.bulk_create([model(**{field: value}) for value in values], ignore_conflicts=True)
+    return {getattr(obj, field): obj for obj in model.objects.filter(**{f'{field}__in': values})}
+
+
+def _parse_dt(value):
+    try:
+        return datetime.strptime(value, _dt_fmt)
+    except (TypeError, ValueError):
+        return datetime.now()
+
+
+def _import_batch(project, batch, users, entities, meta_tasks, meta_task_values, relations):
+    """
+    Create the annotations, meta annotations and relations of a batch of imported documents, in one insert each.
+    :param batch: (Document, exported document) pairs
+    :return: the numbers of annotations and relations created
+    """
+    anns, doc_anns = [], []
+    for doc_mod, doc in batch:
+        # exported annotation id, or start index for exports without ids -> AnnotatedEntity
+        by_id, by_start = {}, {}
+        for anno in doc['annotations']:
+            a = AnnotatedEntity(user=users[anno['user']], project=project, document=doc_mod,
+                                entity=entities[anno['cui']], value=anno['value'], start_ind=anno['start'],
+                                end_ind=anno['end'], validated=anno['validated'], correct=anno['correct'],
+                                deleted=anno['deleted'], alternative=anno['alternative'], killed=anno['killed'],
+                                # Added later - so False by default for compatibility
+                                irrelevant=anno.get('irrelevant', False), comment=anno.get('comment'),
+                                manually_created=anno['manually_created'], acc=anno['acc'])
+            if anno.get('last_modified') is not None:
+                a.last_modified = _parse_dt(anno['last_modified'])
+            if anno.get('create_time') is not None:
+                a.create_time = _parse_dt(anno['create_time'])
+            anns.append((a, anno))
+            if anno.get('id') is not None:
+                by_id[anno['id']] = a
+            by_start[anno['start']] = a
+        doc_anns.append((doc_mod, doc, by_id, by_start))
+    AnnotatedEntity.objects.bulk_create([a for a, _ in anns])
+
+    MetaAnnotation.objects.bulk_create([
+        MetaAnnotation(annotated_entity=a, meta_task=meta_tasks[task_name],
+                       meta_task_value=meta_task_values[meta_anno['value']], acc=meta_anno.get('acc', 1),
+                       validated=meta_anno['validated'])
+        for a, anno in anns for task_name, meta_anno in anno['meta_anns'].items()])
+
+    rels = []
+    for doc_mod, doc, by_id, by_start in doc_anns:
+        for relation in doc.get('relations', []):
+            start_entity = by_id.get(relation.get('start_entity')) or by_start[relation['start_entity_start_idx']]
+            end_entity = by_id.get(relation.get('end_entity')) or by_start[relation['end_entity_start_idx']]
+            rels.append(EntityRelation(user=users[relation['user']], project=project, document=doc_mod,
+                                       relation=relations[relation['relation']],
+                                       validated=relation.get('validated', False),
+                                       start_entity=start_entity, end_entity=end_entity,
+                                       create_time=_parse_dt(relation.get('create_time')),
+                                       last_modified=_parse_dt(relation.get('last_modified_time'))))
+    EntityRelation.objects.bulk_create(rels)
+    return len(anns), len(rels)
+
+
+def upload_projects_export(medcat_export: Dict, cdb_id: Optional[int] = None, vocab_id: Optional[int] = None,
+                           modelpack_id: Optional[int] = None,
+                           on_progress: Optional[Callable[[Dict], None]] = None) -> Dict:
+    """
+    Create a project, with its dataset and annotations, for each project of a trainer export.
+    Annotations are created in batches of documents. A failing batch, i.e. with annotations by a user not in this
+    deployment, is skipped and reported in the result rather than failing the import.
+    :param medcat_export: the export, as produced by download_projects_with_text
+    :param cdb_id: ConceptDB for the projects, with vocab_id, unless modelpack_id is given
+    :param vocab_id: Vocabulary for the projects
+    :param modelpack_id: ModelPack for the projects
+    :param on_progress: called with the progress so far after each batch
+    :return: the numbers of projects, documents, annotations and relations imported, and any errors
+    """
+    batch_size = _dataset_chunk_size()
+    progress = {'projects_total': len(medcat_export['projects']), 'projects_done': 0,
+                'documents_total': sum(len(proj['documents']) for proj in medcat_export['projects']),
+                'documents_done': 0, 'annotations': 0, 'relations': 0, 'errors': []}
+
     for proj in medcat_export['projects']:
         p = ProjectAnnotateEntities()
         p.name = proj['name'] + ' IMPORTED'
+        p.concept_db_id, p.vocab_id, p.model_pack_id = cdb_id, vocab_id, modelpack_id
         if len(proj['cuis']) > 1000:
             # store large CUI lists in a json file.
             cuis_file_name = MEDIA_ROOT + '/' + re.sub('/|\.', '_', p.name + '_cuis_file') + '.json'
@@ -80,19 +263,16 @@ def upload_projects_export(medcat_export: Dict):
             p.cuis = proj['cuis']
 
         # ensure current deployment has the neccessary - Entity, MetaTak, Relation, and warn on not present User objects.
-        ent_labels, meta_tasks, rels, unavailable_users, available_users = set(), defaultdict(set), set(), set(), dict()
+        ent_labels, meta_task_names, rels, usernames = set(), defaultdict(set), set(), set()
         for doc in proj['documents']:
             for anno in doc['annotations']:
                 ent_labels.add(anno['cui'])
+                usernames.add(anno['user'])
                 for meta_anno in anno['meta_anns'].values():
-                    meta_tasks[meta_anno['name']].add(meta_anno['value'])
-                user_obj = User.objects.filter(username=anno['user']).first()
-                if user_obj is None:
-                    unavailable_users.add(anno['user'])
-                elif anno['user'] not in available_users:
-                    available_users[anno['user']] = user_obj
+                    meta_task_names[meta_anno['name']].add(meta_anno['value'])
             for rel in doc.get('relations', []):
                 rels.add(rel['relation'])
+                usernames.add(rel['user'])
         # escape - filename
         ds_file_name = MEDIA_ROOT + '/' + re.sub('/|\.', '_', p.name + '_dataset') + '.csv'
         names = [doc['name'] for doc in proj['documents']]
@@ -108,102 +288,98 @@ def upload_projects_export(medcat_export: Dict):
         p.save()
 
         # create django ORM model instances that are referenced in the upload if they don't exist.
-        for u in unavailable_users:
+        users = {u.username: u for u in User.objects.filter(username__in=usernames)}
+        for u in usernames - users.keys():
             logger.warning(f'Username: {u} - not present in this trainer deployment.')
-        for ent_lab in ent_labels:
-            ent = Entity.objects.filter(label=ent_lab).first()
-            if ent is None:
-                ent = Entity()
-                ent.label = ent_lab
-                ent.save()
-        for task in meta_tasks:
-            if MetaTask.objects.filter(name=task).first() is None:
-                m_task = MetaTask()
-                m_task.name = task
-                m_task.save()
-                # create the MetaTask Values.
-            for task_val in meta_tasks[task]:
-                if MetaTaskValue.objects.filter(name=task_val).first() is None:
-                    mt_value = MetaTaskValue()
-                    mt_value.name = task_val
-                    mt_value.save()
-            m_task = MetaTask.objects.filter(name=task).first()
-            curr_vals = m_task.values.all()
-            task_vals = [MetaTaskValue.objects.filter(name=m_t).first() for m_t in meta_tasks[task]]
-            m_task.values.set(set(list(curr_vals) + task_vals))
-
-        for rel in rels:
-            if Relation.objects.filter(label=rel).first() is None:
-                r = Relation()
-                r.label = rel
-                r.save()
-
-        p.validated_documents.set(list(Document.objects.filter(dataset=ds_mod)))
+        entities = _get_or_create_all(Entity, 'label', ent_labels)
+        meta_tasks = _get_or_create_all(MetaTask, 'name', meta_task_names)
+        meta_task_values = _get_or_create_all(MetaTaskValue, 'name', set().union(*meta_task_names.values()))
+        for task_name, task_values in meta_task_names.items():
+            meta_tasks[task_name].values.add(*[meta_task_values[v] for v in task_values])
+        relations = _get_or_create_all(Relation, 'label', rels)
 
-        for doc in proj['documents']:
-            doc_mod = Document.objects.filter(Q(dataset=ds_mod) & Q(text=doc['text'])).first()
-            annos = []
-            for anno in doc['annotations']:
-                a = AnnotatedEntity()
-                a.user = available_users[anno['user']]
-                a.project = p
-                a.document = doc_mod
-                e = Entity.objects.get(label=anno['cui'])
-                a.entity = e
-                a.value = anno['value']
-                a.start_ind = anno['start']
-                a.end_ind = anno['end']
-                a.validated = anno['validated']
-                a.correct = anno['correct']
-                a.deleted = anno['deleted']
-                a.alternative = anno['alternative']
-                a.killed = anno['killed']
-                a.irrelevant = anno.get('irrelevant', False)  # Added later - so False by default for compatibility
-                if anno.get('last_modified') is not None:
-                    try:
-                        a.last_modified = datetime.strptime(anno['last_modified'], _dt_fmt)
-                    except ValueError:
-                        a.last_modified = datetime.now()
-                if anno.get('create_time') is not None:
-                    try:
-                        a.create_time = datetime.strptime(anno['create_time'], _dt_fmt)
-                    except ValueError:
-                        a.create_time = datetime.now()
-                a.comment = anno.get('comment')
-                a.manually_created = anno['manually_created']
-
-                a.acc = anno['acc']
-                a.save()
-                annos.append(a)
-                for task_name, meta_anno in anno['meta_anns'].items():
-                    m_a = MetaAnnotation()
-                    m_a.annotated_entity = a
-                    # there will be at least one or more of these available.
-                    m_a = MetaTask.objects.filter(name=task_name).first()
-                    m_a.validated = meta_anno['validated']
-                    m_a.save()
-                    # missing acc on the model
-            anno_to_doc_ind = {a.start_ind: a for a in annos}
-
-            for relation in doc.get('relations', []):
-                er = EntityRelation()
-                er.user = available_users[relation['user']]
-                er.project = p
-                er.document = doc_mod
-                # there will be at least one or more of these available.
-                er.relation = Relation.objects.filter(label=relation['relation']).first()
-                er.validated = er.validated
-                # link relations with start and end anno ents
-                er.start_entity = anno_to_doc_ind[relation['start_entity_start_idx']]
-                er.end_entity = anno_to_doc_ind[relation['end_entity_start_idx']]
-                try:
-                    er.create_time = datetime.strptime(relation['create_time'], _dt_fmt)
-                except ValueError:
-                    er.create_time = datetime.now()
-                try:
-                    er.last_modified = datetime.strptime(relation['last_modified_time'], _dt_fmt)
-                except ValueError:
-                    er.last_modified = datetime.now()
-                er.save()
+        ds_docs = list(Document.objects.filter(dataset=ds_mod))
+        p.validated_documents.set(ds_docs)
+        # the first document of the dataset with each text
+        docs_by_hash = {}
+        for doc_mod in reversed(ds_docs):
+            docs_by_hash[doc_mod.text_hash] = doc_mod
+
+        docs = [(docs_by_hash.get(Document.hash_text(doc['text'])), doc) for doc in proj['documents']]
+        for i in range(0, len(docs), batch_size):
+            batch = docs[i:i + batch_size]
+            try:
+                with transaction.atomic():
+                    n_anns, n_rels = _import_batch(p, batch, users, entities, meta_tasks, meta_task_values,
+                                                   relations)
+                progress['annotations'] += n_anns
+                progress['relations'] += n_rels
+            except Exception as e:
+                logger.warning('Failed to import the annotations of documents %s-%s of project %s: %s',
+                               i, i + len(batch), proj['name'], repr(e))
+                progress['errors'].append({'project': proj['name'], 'documents': [doc['name'] for _, doc in batch],
+                                           'error': repr(e)})
+            progress['documents_done'] += len(batch)
+            if on_progress is not None:
+                on_progress(progress)
+        # bulk_create skips AnnotatedEntity.save, that updates the project last_modified
+        p.save()
+        progress['projects_done'] += 1
         logger.info(f"Finished annotation import for project {proj['name']}")
     logger.info('Finished importing all projects')
+    return progress
+
+
+def _import_status_path(export_path: str) -> str:
+    return export_path + '.status.json'
+
+
+def import_status(export_path: str) -> Dict:
+    """The progress of the background import of the export at export_path, see import_projects_export."""
+    try:
+        with open(_import_status_path(export_path)) as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {'state': 'pending'}
+
+
+def remove_import_status(export_path: str):
+    """Remove the status file of a finished import, once reported."""
+    try:
+        os.remove(_import_status_path(export_path))
+    except FileNotFoundError:
+        pass
+
+
+def _write_import_status(export_path: str, status: Dict):
+    # written aside then renamed, so the status API never reads a partial file
+    tmp_path = _import_status_path(export_path) + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, _import_status_path(export_path))
+
+
+@background(schedule=1, queue='project_import')
+def import_projects_export(export_path: str, cdb_id: Optional[int] = None, vocab_id: Optional[int] = None,
+                           modelpack_id: Optional[int] = None, remove_export: bool = False):
+    """
+    upload_projects_export of the trainer export file at export_path, as a background task. Its progress and any
+    errors are written to a status file alongside the export, read by import_status.
+    :param remove_export: remove the export file once imported, or failed, i.e. an uploaded copy holding
+        document text
+    """
+    _write_import_status(export_path, {'state': 'running'})
+    try:
+        with open(export_path) as f:
+            medcat_export = json.load(f)
+        progress = upload_projects_export(
+            medcat_export, cdb_id, vocab_id, modelpack_id,
+            on_progress=lambda p: _write_import_status(export_path, {'state': 'running', **p}))
+        _write_import_status(export_path, {'state': 'complete', **progress})
+    except Exception as e:
+        # not raised, as the task being retried would import the projects again
+        logger.error('Failed to import trainer export %s: %s', export_path, e)
+        _write_import_status(export_path, {'state': 'failed', 'error': repr(e)})
+    finally:
+        if remove_export and os.path.exists(export_path):
+            os.remove(export_path)
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+import threading
+import weakref
+from collections import OrderedDict
+from typing import Optional
+
+from medcat.cat import CAT
+from spacy.tokens import Doc
+
+from .medcat_utils import active_cui_filter
+
+"""
+Bounded, per CAT, cache of the spaCy Docs produced by running a CAT over a document, so preparing a
+document and then training on it at submit only runs the model over its text once.
+
+Each CAT has a version, bumped (see model_trained) each time it is trained. Cached Docs record the version
+they were made with, callers pass how many versions old a Doc may be: re-preparing a document needs the
+linking of the current model, whereas training only uses the Doc tokens, so accepts older Docs.
+"""
+
+logger = logging.getLogger(__name__)
+
+try:
+    _DOC_CACHE_SIZE = int(os.getenv('MEDCAT_DOC_CACHE_SIZE', 100))
+except ValueError:
+    _DOC_CACHE_SIZE = 100
+    logger.warning('MEDCAT_DOC_CACHE_SIZE is not an integer, using default value of 100')
+
+try:
+    # number of trainings of a model after which its cached Docs are no longer used for training
+    TRAIN_MAX_STALENESS = int(os.getenv('MEDCAT_DOC_CACHE_TRAIN_MAX_STALENESS', 50))
+except ValueError:
+    TRAIN_MAX_STALENESS = 50
+    logger.warning('MEDCAT_DOC_CACHE_TRAIN_MAX_STALENESS is not an integer, using default value of 50')
+
+# CAT -> (doc id, text hash) -> (model version, cui filter, Doc). Entries go with the CAT, i.e. when evicted.
+_docs = weakref.WeakKeyDictionary()
+_versions = weakref.WeakKeyDictionary()
+_lock = threading.Lock()
+
+
+def _key(document, text: str):
+    return document.id, hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def _text(cat: CAT, document) -> str:
+    # as CAT.__call__, that trims texts to the max document length
+    return (document.text or '')[:cat.config.preprocessing.max_document_length]
+
+
+def get(cat: CAT, document, max_staleness: int = 0, match_cui_filter: bool = True) -> Optional[Doc]:
+    """
+    The cached Doc of cat run over document, if any.
+    :param cat: the CAT
+    :param document: the Document, its current text must match that of the cached Doc
+    :param max_staleness: number of times cat can have been trained since the Doc was made
+    :param match_cui_filter: only use a Doc made with the currently active cui_filter, i.e. if using its entities
+    :return: the Doc or None
+    """
+    if _DOC_CACHE_SIZE <= 0:
+        return None
+    with _lock:
+        cat_docs = _docs.get(cat)
+        entry = cat_docs.get(_key(document, _text(cat, document))) if cat_docs is not None else None
+        if entry is None:
+            return None
+        version, cuis, doc = entry
+        if _versions.get(cat, 0) - version > max_staleness:
+            return None
+        if match_cui_filter and cuis != active_cui_filter():
+            return None
+        cat_docs.move_to_end(_key(document, _text(cat, document)))
+        return doc
+
+
+def put(cat: CAT, document, doc: Doc):
+    """Cache doc, the result of cat run over document within the currently active cui_filter."""
+    if _DOC_CACHE_SIZE <= 0 or doc is None:
+        return
+    cuis = active_cui_filter()
+    with _lock:
+        cat_docs = _docs.setdefault(cat, OrderedDict())
+        cat_docs[_key(document, doc.text)] = (_versions.get(cat, 0), set(cuis) if cuis is not None else None, doc)
+        cat_docs.move_to_end(_key(document, doc.text))
+        while len(cat_docs) > _DOC_CACHE_SIZE:
+            cat_docs.popitem(last=False)
+
+
+def get_or_run(cat: CAT, document, max_staleness: int = TRAIN_MAX_STALENESS) -> Doc:
+    """The cached Doc for document, accepting one made with any cui_filter, or cat run over its text."""
+    doc = get(cat, document, max_staleness=max_staleness, match_cui_filter=False)
+    if doc is None:
+        doc = cat(document.text)
+        put(cat, document, doc)
+    return doc
+
+
+def model_trained(cat: CAT):
+    """Bump the version of cat, ageing its cached Docs."""
+    with _lock:
+        _versions[cat] = _versions.get(cat, 0) + 1
@@ -1,8 +1,12 @@
 import logging
 from collections import defaultdict
-from typing import List
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterable, List, Optional, Set
 
+from medcat.cat import CAT
 from medcat.cdb import CDB
+from medcat.config import LinkingFilters
 
 
 logger = logging.getLogger(__name__)
@@ -66,3 +70,52 @@ def snomed_ct_concept_path(cui: str, cdb: CDB):
     except KeyError as e:
         logger.warning(f'Cannot find path concept path:{e}')
         return []
+
+
+# CUIs linking is restricted to by the innermost cui_filter of the current thread / task, None outside of any.
+_cui_filter: ContextVar[Optional[Set[str]]] = ContextVar('cui_filter', default=None)
+
+
+class ContextLinkingFilters(LinkingFilters):
+    """
+    LinkingFilters whose cuis are replaced by those of the active cui_filter, if any. As the override is a
+    ContextVar, threads / tasks sharing a CAT each link with their own project CUI filter.
+    """
+
+    def check_filters(self, cui: str) -> bool:
+        cuis = _cui_filter.get()
+        if cuis is None:
+            return super().check_filters(cui)
+        if cui in cuis or not cuis:
+            return cui not in self.cuis_exclude
+        return False
+
+
+def _install_context_filters(cat: CAT):
+    filters = cat.config.linking.filters
+    # also re-installs after medcat has replaced the filters, i.e. during CAT.get_stats
+    if not isinstance(filters, ContextLinkingFilters):
+        # model_construct keeps the same cuis / cuis_exclude sets, so training updates to these are kept
+        cat.config.linking.filters = ContextLinkingFilters.model_construct(cuis=filters.cuis,
+                                                                           cuis_exclude=filters.cuis_exclude)
+
+
+@contextmanager
+def cui_filter(cat: CAT, cuis: Iterable[str]):
+    """
+    Restricts linking of cat to cuis, or to all CUIs if cuis is empty, within the with block of the current
+    thread / task only. Use instead of setting cat.config.linking['filters']['cuis'] on a shared CAT.
+    :param cat: the, possibly cached and shared, CAT
+    :param cuis: the CUIs to link to
+    """
+    _install_context_filters(cat)
+    token = _cui_filter.set(set(cuis))
+    try:
+        yield
+    finally:
+        _cui_filter.reset(token)
+
+
+def active_cui_filter() -> Optional[Set[str]]:
+    """The CUIs of the innermost cui_filter of the current thread / task, or None if outside of any."""
+    return _cui_filter.get()
@@ -14,16 +14,15 @@ from background_task.models import Task
 from django.contrib.auth.models import User
 from django.db.models import QuerySet
 from medcat.cat import CAT
-from medcat.cdb import CDB
 from medcat.config_meta_cat import ConfigMetaCAT
 from medcat.meta_cat import MetaCAT
 from medcat.tokenizers.meta_cat_tokenizers import TokenizerWrapperBase
 from medcat.utils.meta_cat.data_utils import prepare_from_json, encode_category_values
 from medcat.utils.meta_cat.ml_utils import create_batch_piped_data
-from medcat.vocab import Vocab
 from torch import nn
 
 from api.admin import retrieve_project_data
+from api.model_cache import clear_cached_medcat, get_cached_medcat, get_medcat_view
 from api.models import AnnotatedEntity, ProjectAnnotateEntities, ProjectMetrics as AppProjectMetrics
 from core.settings import MEDIA_ROOT
 
@@ -43,19 +42,18 @@ def calculate_metrics(project_ids: List[int], report_name: str):
     """
     logger.info('Calculating metrics for report: %s', report_name)
     projects = [ProjectAnnotateEntities.objects.filter(id=p_id).first() for p_id in project_ids]
-    loaded_model_pack = False
-    if projects[0].model_pack:
-        # assume the model pack is set.
-        cat = CAT.load_model_pack(projects[0].model_pack.model_pack.path)
-        loaded_model_pack = True
-    else:
-        # assume the cdb / vocab is set in these projects
-        cdb = CDB.load(projects[0].concept_db.cdb_file.path)
-        vocab = Vocab.load(projects[0].vocab.vocab_file.path)
-        cat = CAT(cdb, vocab, config=cdb.config)
-    project_data = retrieve_project_data(projects)
-    metrics = ProjectMetrics(project_data, cat)
-    report = metrics.generate_report(meta_ann=loaded_model_pack)
+    # a view of the model as cached for the annotators, loading it only if not already
+    was_cached = get_cached_medcat(projects[0]) is not None
+    try:
+        cat = get_medcat_view(projects[0])
+        loaded_model_pack = projects[0].model_pack is not None
+        project_data = retrieve_project_data(projects)
+        metrics = ProjectMetrics(project_data, cat)
+        report = metrics.generate_report(meta_ann=loaded_model_pack)
+    finally:
+        # a model loaded just for this report is not kept in the background task process
+        if not was_cached:
+            clear_cached_medcat(projects[0])
     report_file_path = f'{MEDIA_ROOT}/{report_name}.json'
     json.dump(report, open(report_file_path, 'w'))
     apm = AppProjectMetrics()
@@ -171,27 +169,16 @@ class ProjectMetrics(object):
         """
         Add the user prop to the medcat output metrics. Can potentially add more later for each of the categories
         """
-        for tp in [i for e_i in examples['tp'].values() for i in e_i]:
-            try:
-                ann = AnnotatedEntity.objects.get(project_id=tp['project id'], document_id=tp['document id'],
-                                                  start_ind=tp['start'], end_ind=tp['end'])
-                tp['user'] = ann.user.username
-            except:
-                tp['user'] = None
-        for fp in (i for e_i in examples['fp'].values() for i in e_i):
-            try:
-                ann = AnnotatedEntity.objects.get(project_id=fp['project id'], document_id=fp['document id'],
-                                                  start_ind=fp['start'], end_ind=fp['end'])
-                fp['user'] = ann.user.username
-            except:
-                fp['user'] = None
-        for fn in (i for e_i in examples['fn'].values() for i in e_i):
-            try:
-                ann = AnnotatedEntity.objects.get(project_id=fn['project id'], document_id=fn['document id'],
-                                                  start_ind=fn['start'], end_ind=fn['end'])
-                fn['user'] = ann.user.username
-            except:
-                fn['user'] = None
+        examples_list = [ex for kind in ('tp', 'fp', 'fn') for e_i in examples[kind].values() for ex in e_i]
+        # (project id, document id, start, end) -> username, None if more than one annotation has that span
+        users = {}
+        anns = AnnotatedEntity.objects.filter(project_id__in={ex['project id'] for ex in examples_list}) \
+            .values_list('project_id', 'document_id', 'start_ind', 'end_ind', 'user__username')
+        for project_id, document_id, start, end, username in anns.iterator():
+            key = (project_id, document_id, start, end)
+            users[key] = None if key in users else username
+        for ex in examples_list:
+            ex['user'] = users.get((ex['project id'], ex['document id'], ex['start'], ex['end']))
         return examples
 
     def user_stats(self, by_user: bool = True):
@@ -328,49 +315,56 @@ class ProjectMetrics(object):
             meta_model_task = meta_model.name
             meta_results = self._eval(meta_model, self.mct_export)
             meta_values = {v: k for k, v in meta_results['meta_values'].items()}
-            pred_meta_values = []
-            counter = 0
-            for meta_value in meta_df[meta_model_task]:
-                if pd.isnull(meta_value):
-                    pred_meta_values.append(np.nan)
-                else:
-                    pred_meta_values.append(meta_values.get(meta_results['predictions'][counter], np.nan))
-                    counter += 1
-            meta_df.insert(meta_df.columns.get_loc(meta_model_task) + 1, 'predict_' + meta_model_task, pred_meta_values)
+            # predictions are in order of the annotations with a value for the task
+            has_value = meta_df[meta_model_task].notna().to_numpy()
+            pred_meta_values = np.full(len(meta_df), np.nan, dtype=object)
+            pred_meta_values[has_value] = pd.Series(meta_results['predictions'][:has_value.sum()]).map(meta_values)
+            meta_df.insert(meta_df.columns.get_loc(meta_model_task) + 1, 'predict_' + meta_model_task,
+                           pd.Series(pred_meta_values).infer_objects())
 
         return meta_df
 
-    def meta_anns_concept_summary(self) -> List[Dict]:
+    def meta_anns_concept_summary(self, meta_df: pd.DataFrame = None) -> List[Dict]:
         """Calculate performance metrics for meta annotations per concept.
 
+        Args:
+            meta_df (pd.DataFrame): the full_annotation_df, computed if not given
+
         Returns:
             List[Dict]: List of dictionaries containing concept-level meta annotation metrics
         """
-        meta_df = self.full_annotation_df()
-        meta_performance = {}
-
-        for cui in meta_df.cui.unique():
-            concept_df = meta_df[meta_df['cui'] == cui]
-            meta_task_results = {}
-
-            for meta_model_card in self.cat.get_model_card(as_dict=True)['MetaCAT models']:
-                meta_task = meta_model_card['Category Name']
-                meta_classes = meta_model_card['Classes'].keys()
-
+        if meta_df is None:
+            meta_df = self.full_annotation_df()
+        # in order of first appearance, as meta_df.cui.unique()
+        cui_codes, cuis = pd.factorize(meta_df['cui'])
+        meta_task_results = [{} for _ in cuis]
+
+        for meta_model_card in self.cat.get_model_card(as_dict=True)['MetaCAT models']:
+            meta_task = meta_model_card['Category Name']
+            meta_classes = list(meta_model_card['Classes'].keys())
+            n_classes = len(meta_classes)
+
+            # per concept and class counts of predictions, ground truths and both, in one pass over the annotations
+            preds = pd.Categorical(meta_df['predict_' + meta_task], categories=meta_classes).codes
+            truths = pd.Categorical(meta_df[meta_task], categories=meta_classes).codes
+
+            def counts(rows, classes):
+                return np.bincount(cui_codes[rows] * n_classes + classes[rows],
+                                   minlength=len(cuis) * n_classes).reshape(len(cuis), n_classes)
+            pred_counts = counts(preds >= 0, preds)
+            totals = counts(truths >= 0, truths)
+            tps = counts((preds >= 0) & (preds == truths), preds)
+
+            for cui_i in range(len(cuis)):
                 # Calculate per-class metrics
                 class_metrics = {}
                 total_instances = 0
 
-                for meta_value in meta_classes:
-                    # Get predictions and ground truth for this class
-                    preds = concept_df['predict_' + meta_task] == meta_value
-                    truths = concept_df[meta_task] == meta_value
-
-                    # Calculate metrics
-                    tp = int((preds & truths).sum())
-                    fp = int((preds & ~truths).sum())
-                    fn = int((~preds & truths).sum())
-                    total = int(truths.sum())
+                for class_i, meta_value in enumerate(meta_classes):
+                    tp = int(tps[cui_i, class_i])
+                    fp = int(pred_counts[cui_i, class_i]) - tp
+                    fn = int(totals[cui_i, class_i]) - tp
+                    total = int(totals[cui_i, class_i])
                     total_instances += total
 
                     # Store metrics
@@ -383,9 +377,9 @@ class ProjectMetrics(object):
 
                 # Calculate macro averages (unweighted)
                 macro_metrics = {
-                    'f1': float(sum(m['f1'] for m in class_metrics.values()) / len(meta_classes)),
-                    'prec': float(sum(m['prec'] for m in class_metrics.values()) / len(meta_classes)),
-                    'rec': float(sum(m['rec'] for m in class_metrics.values()) / len(meta_classes))
+                    'f1': float(sum(m['f1'] for m in class_metrics.values()) / n_classes),
+                    'prec': float(sum(m['prec'] for m in class_metrics.values()) / n_classes),
+                    'rec': float(sum(m['rec'] for m in class_metrics.values()) / n_classes)
                 }
 
                 # Calculate micro averages (weighted by class size)
@@ -399,34 +393,27 @@ class ProjectMetrics(object):
                     micro_metrics = {'f1': 0.0, 'prec': 0.0, 'rec': 0.0}
 
                 # Store results for this meta task
-                meta_task_results[meta_task] = {
+                meta_task_results[cui_i][meta_task] = {
                     'classes': class_metrics,
                     'macro': macro_metrics,
                     'micro': micro_metrics
                 }
 
-            # Store results for this concept
-            meta_performance[cui] = {
-                'cui': cui,
-                'concept_name': self.cat.cdb.cui2preferred_name[cui],
-                'meta_tasks': meta_task_results
-            }
-
-        return list(meta_performance.values())
+        return [{'cui': cui, 'concept_name': self.cat.cdb.cui2preferred_name[cui], 'meta_tasks': results}
+                for cui, results in zip(cuis, meta_task_results)]
 
     def generate_report(self, meta_ann=False):
+        meta_anns_summary = None
         if meta_ann:
+            # the MetaCAT models are only run over the annotations once, for both of these
             anno_df = self.full_annotation_df()
+            meta_anns_summary = self.meta_anns_concept_summary(anno_df)
         else:
             anno_df = self.annotation_df()
 
         anno_df['last_modified'] = anno_df['last_modified'].dt.strftime(_dt_fmt)
         anno_df.fillna('-', inplace=True)
 
-        meta_anns_summary = None
-        if meta_ann:
-            meta_anns_summary = self.meta_anns_concept_summary()
-
         # assumes all projects have the same meta_anno_defs - this would break further up if not the case.
         meta_anno_task_summary = self.mct_export['projects'][0]['meta_anno_defs']
 
@@ -0,0 +1,27 @@
+# Generated by Django 5.1.15 on 2026-10-18 21:33
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0089_projectannotateentities_deid_model_annotation_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExportTombstone',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('project_id', models.IntegerField()),
+                ('document_id', models.IntegerField()),
+                ('object_type', models.CharField(choices=[('annotation', 'annotation'), ('meta_annotation', 'meta_annotation'), ('relation', 'relation'), ('document', 'document')], max_length=20)),
+                ('object_id', models.IntegerField()),
+                ('deleted_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['project_id', 'deleted_at'], name='api_exportt_project_e705d0_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 5.1.15 on 2026-10-18 21:43
+
+import hashlib
+
+from django.db import migrations, models
+
+
+def backfill_text_hash(apps, schema_editor):
+    Document = apps.get_model('api', 'Document')
+    batch = []
+    for doc in Document.objects.only('id', 'text').iterator(chunk_size=1000):
+        doc.text_hash = hashlib.sha256((doc.text or '').encode('utf-8')).hexdigest()
+        batch.append(doc)
+        if len(batch) == 1000:
+            Document.objects.bulk_update(batch, ['text_hash'])
+            batch = []
+    Document.objects.bulk_update(batch, ['text_hash'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0090_exporttombstone'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='text_hash',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, help_text='sha256 of the text, to look documents up by their text', max_length=64),
+        ),
+        migrations.RunPython(backfill_text_hash, migrations.RunPython.noop),
+    ]
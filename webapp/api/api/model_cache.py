@@ -1,22 +1,27 @@
+import copy
+import itertools
 import logging
 import os
-from typing import Dict
+import threading
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import Future
+from contextlib import nullcontext
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 
 import pkg_resources
+from django.db import connection
 from medcat.cat import CAT
 from medcat.cdb import CDB
 from medcat.vocab import Vocab
 
+from api import cdb_delta
 from api.models import ConceptDB
+from api.shared_model_store import share_cdb, share_vocab
 
 """
 Module level caches for CDBs, Vocabs and CAT instances.
 """
-# Maps between IDs and objects
-CDB_MAP = {}
-VOCAB_MAP = {}
-CAT_MAP = {}
-
 logger = logging.getLogger(__name__)
 
 try:
@@ -25,32 +30,338 @@ except ValueError:
     _MAX_MODELS_LOADED = 1
     logger.warning("MAX_MEDCAT_MODELS is not an integer, using default value of 1")
 
+try:
+    # 0 disables the byte budget, leaving only the MAX_MEDCAT_MODELS count limit.
+    _MAX_MODEL_CACHE_BYTES = int(os.getenv("MEDCAT_MODEL_CACHE_BYTES", 0))
+except ValueError:
+    _MAX_MODEL_CACHE_BYTES = 0
+    logger.warning("MEDCAT_MODEL_CACHE_BYTES is not an integer, no byte budget will be applied to the model cache")
+
+_CACHE_POLICY = os.getenv("MEDCAT_MODEL_CACHE_POLICY", "lru").lower()
+if _CACHE_POLICY not in ('lru', 'lfu'):
+    logger.warning("MEDCAT_MODEL_CACHE_POLICY must be one of 'lru' or 'lfu', using default value of 'lru'")
+    _CACHE_POLICY = 'lru'
+
+# projects whose models are never evicted from the cache
+_PINNED_PROJECTS = {int(p) for p in os.getenv("MEDCAT_PINNED_PROJECTS", "").split(',') if p.strip().isdigit()}
+
+try:
+    # save a trained model after this many trainings, 0 disables
+    _CHECKPOINT_EVERY = int(os.getenv("MEDCAT_CHECKPOINT_EVERY", 0))
+except ValueError:
+    _CHECKPOINT_EVERY = 0
+    logger.warning("MEDCAT_CHECKPOINT_EVERY is not an integer, models will not be saved after a number of trainings")
+
+try:
+    # save a trained model this many seconds after its first unsaved training, 0 disables
+    _CHECKPOINT_SECS = float(os.getenv("MEDCAT_CHECKPOINT_SECS", 0))
+except ValueError:
+    _CHECKPOINT_SECS = 0
+    logger.warning("MEDCAT_CHECKPOINT_SECS is not a number, models will not be saved after a time")
+
+_access_clock = itertools.count()
+# held while reading or changing the model caches, as requests, trainer threads and preloads use them concurrently
+_cache_lock = threading.RLock()
+
+
+class ModelMap(dict):
+    """
+    Maps IDs to loaded model objects, i.e. CDBs, Vocabs or CATs.
+
+    Alongside each entry it records when it was last used, how many times it has been used, its
+    approximate size in bytes, if it is pinned and the entries of other ModelMaps that it was built from.
+    _clear_models uses these to decide what to evict.
+
+    Trainable entries also have a saver, persisting the trained model, and are dirty once trained until saved.
+    """
+
+    def __init__(self, name: str):
+        super().__init__()
+        self.name = name
+        self.last_used = {}
+        self.uses = Counter()
+        self.sizes = {}
+        self.pinned = set()
+        self.deps = {}
+        # key -> [number of trainings, time of the first training] since last saved
+        self.dirty = {}
+        self.savers = {}
+
+    def __getitem__(self, key):
+        with _cache_lock:
+            obj = super().__getitem__(key)
+            self.touch(key)
+            return obj
+
+    def __setitem__(self, key, obj):
+        with _cache_lock:
+            super().__setitem__(key, obj)
+            self.touch(key)
+
+    def __delitem__(self, key):
+        with _cache_lock:
+            super().__delitem__(key)
+            for meta in (self.last_used, self.uses, self.sizes, self.deps, self.dirty, self.savers):
+                meta.pop(key, None)
+            self.pinned.discard(key)
+
+    def get(self, key, default=None):
+        with _cache_lock:
+            return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        with _cache_lock:
+            if key not in self:
+                return super().pop(key, *default)
+            obj = super().__getitem__(key)
+            del self[key]
+            return obj
+
+    def clear(self):
+        with _cache_lock:
+            for key in list(self):
+                del self[key]
+
+    def put(self, key, obj, size: int = 0, pinned: bool = False,
+            deps: Iterable[Tuple['ModelMap', object]] = (), saver: Callable = None):
+        """
+        Add a model to the map.
+        :param key: the id of the model
+        :param obj: the loaded model
+        :param size: approximate size in bytes of the model, excluding the size of any deps
+        :param pinned: if this model should never be evicted
+        :param deps: (ModelMap, key) pairs of the entries this model was built from
+        :param saver: persists the model once trained
+        """
+        with _cache_lock:
+            super().__setitem__(key, obj)
+            self.sizes[key] = size
+            self.deps[key] = tuple(deps)
+            if saver is not None:
+                self.savers[key] = saver
+            if pinned:
+                self.pinned.add(key)
+                for dep_map, dep_key in self.deps[key]:
+                    dep_map.pinned.add(dep_key)
+            self.touch(key)
+
+    def touch(self, key):
+        """Mark key, and the entries it was built from, as just used."""
+        with _cache_lock:
+            self.last_used[key] = next(_access_clock)
+            self.uses[key] += 1
+            for dep_map, dep_key in self.deps.get(key, ()):
+                if dep_key in dep_map:
+                    dep_map.touch(dep_key)
+
+    def nbytes(self) -> int:
+        with _cache_lock:
+            return sum(self.sizes.values())
+
+
+# Maps between IDs and objects
+CDB_MAP = ModelMap('cdb')
+VOCAB_MAP = ModelMap('vocab')
+CAT_MAP = ModelMap('cat')
+
+# CAT id -> {'state': 'loading' | 'ready' | 'failed', 'progress': 0-1, 'error': str}
+LOAD_STATES: Dict[str, Dict] = {}
+# (id of ModelMap, model id) -> Future of an in progress load, so concurrent requests wait on it rather than load
+# the same model again, see _single_flight.
+_loads: Dict[Tuple[int, object], Future] = {}
+_loads_lock = threading.Lock()
+# ModelMap name -> counts of requests that 'loaded' a model, or 'waited' on another requests load.
+LOAD_STATS: Dict[str, Counter] = defaultdict(Counter)
+# CDB -> lock held while training or saving a CAT built from it, see model_lock
+_model_locks: Dict[str, threading.RLock] = {}
+# CAT id -> the CDB it is built from, in _model_locks
+_lock_keys: Dict[str, str] = {}
+_model_locks_lock = threading.Lock()
+
+
+def model_id(project) -> str:
+    """The id of the CAT of project in CAT_MAP."""
+    if project.model_pack is not None:
+        return 'mp' + str(project.model_pack.id)
+    return str(project.concept_db.id) + "-" + str(project.vocab.id)
+
+
+def model_lock(key: str) -> threading.RLock:
+    """
+    The lock held while the CAT key, see model_id, is trained or saved, so it is never saved part way through
+    training. CATs built from the same CDB, i.e. a model pack and a project using the packs ConceptDB, share the
+    lock, as training either trains the one CDB. Evicting a trained model saves it once the caches are unlocked, so
+    this may be held while using them.
+    """
+    with _model_locks_lock:
+        return _model_locks.setdefault(_lock_keys.get(key, key), threading.RLock())
+
+
+def _set_lock_key(cat_id: str, cdb_id):
+    with _model_locks_lock:
+        _lock_keys[cat_id] = f'cdb{cdb_id}'
+
+
+def _set_load_state(cat_id: str, state: str, progress: float, error: str = None):
+    LOAD_STATES[cat_id] = {'state': state, 'progress': progress, 'error': error}
+
+
+def _set_load_progress(cat_id: str, progress: float):
+    if LOAD_STATES.get(cat_id, {}).get('state') == 'loading':
+        LOAD_STATES[cat_id]['progress'] = progress
+
+
+def _single_flight(model_map: ModelMap, key, load):
+    """
+    Returns model_map[key], calling load() to load it if not present. Only one load of a key runs at a time,
+    concurrent callers for the same key wait on and share the result, or exception, of that load.
+    :param load: loads the model, putting it into model_map, and returns it
+    """
+    with _loads_lock:
+        cached = model_map.get(key)
+        if cached is not None:
+            return cached
+        future = _loads.get((id(model_map), key))
+        loading_elsewhere = future is not None
+        if not loading_elsewhere:
+            future = _loads[(id(model_map), key)] = Future()
+    if loading_elsewhere:
+        logger.info('Waiting on in progress load of %s model %s', model_map.name, key)
+        LOAD_STATS[model_map.name]['waited'] += 1
+        return future.result()
+
+    LOAD_STATS[model_map.name]['loaded'] += 1
+    try:
+        obj = load()
+        future.set_result(obj)
+        return obj
+    except BaseException as e:
+        future.set_exception(e)
+        raise
+    finally:
+        with _loads_lock:
+            del _loads[(id(model_map), key)]
+
+
+def _disk_size(path: str) -> int:
+    """
+    Size on disk of a serialised model file or unpacked model dir. Used as the estimate of
+    the memory a model will occupy once loaded, as measuring the object graph of a loaded CDB is too slow.
+    """
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+
+def _is_pinned(project) -> bool:
+    return project.id in _PINNED_PROJECTS
+
+
+def _dependents(model_map: ModelMap, key, model_maps: Tuple[ModelMap, ...]):
+    return [(m, k) for m in model_maps for k, deps in m.deps.items()
+            if any(dep_map is model_map and dep_key == key for dep_map, dep_key in deps)]
 
-def _clear_models(cdb_map: Dict[str, CDB]=CDB_MAP,
-                  vocab_map: Dict[str, Vocab]=VOCAB_MAP,
-                  cat_map: Dict[str, CAT]=CAT_MAP):
-    if len(cat_map) > _MAX_MODELS_LOADED:
-        (k := next(iter(cat_map)), cat_map.pop(k))
-    if len(cdb_map) > _MAX_MODELS_LOADED:
-        (k := next(iter(cdb_map)), cdb_map.pop(k))
-    if len(vocab_map) > _MAX_MODELS_LOADED:
-        (k := next(iter(vocab_map)), vocab_map.pop(k))
+
+def _save_evicted(saves: List[Tuple[str, Callable]]):
+    # run once the caches are unlocked, as a save waits on any training of the model, then writes the whole CDB
+    for key, saver in saves:
+        logger.info('Saving trained model %s evicted from the model cache', key)
+        try:
+            with model_lock(key):
+                saver()
+        except Exception as e:
+            logger.error('Failed to save trained model %s, its training is lost: %s', key, e)
+
+
+def _evict(model_map: ModelMap, key, model_maps: Tuple[ModelMap, ...], saves: List = None):
+    """
+    Evict key from model_map, and the entries built from it.
+    :param saves: collects the (key, saver) pairs of trained models evicted, to save once the caches are unlocked.
+        If None these are saved before returning.
+    """
+    pending = [] if saves is None else saves
+    with _cache_lock:
+        # entries built from this model keep it alive, so must go too.
+        for dep_map, dep_key in _dependents(model_map, key, model_maps):
+            _evict(dep_map, dep_key, model_maps, pending)
+        if key in model_map:
+            if key in model_map.dirty and model_map.savers.get(key) is not None:
+                pending.append((key, model_map.savers[key]))
+            logger.info('Evicting %s model %s from model cache', model_map.name, key)
+            del model_map[key]
+    if saves is None:
+        _save_evicted(pending)
+
+
+def _eviction_order(model_map: ModelMap, key):
+    if _CACHE_POLICY == 'lfu':
+        return model_map.uses[key], model_map.last_used[key]
+    return model_map.last_used[key]
+
+
+def _evict_one(candidate_maps: Iterable[ModelMap], model_maps: Tuple[ModelMap, ...], keep, saves: List,
+               evict_dependents: bool = True) -> bool:
+    with _cache_lock:
+        candidates = []
+        for model_map in candidate_maps:
+            for key in model_map:
+                if key in model_map.pinned or (id(model_map), key) in keep:
+                    continue
+                dependents = _dependents(model_map, key, model_maps)
+                if dependents and not evict_dependents:
+                    continue
+                if any(k in m.pinned or (id(m), k) in keep for m, k in dependents):
+                    continue
+                candidates.append((model_map, key))
+        if not candidates:
+            return False
+        model_map, key = min(candidates, key=lambda c: _eviction_order(*c))
+        _evict(model_map, key, model_maps, saves)
+        return True
+
+
+def _clear_models(cdb_map: ModelMap=CDB_MAP,
+                  vocab_map: ModelMap=VOCAB_MAP,
+                  cat_map: ModelMap=CAT_MAP,
+                  keep: Iterable[Tuple[ModelMap, object]] = (),
+                  evict_dependents: bool = True):
+    """
+    Evicts models until each map holds at most MAX_MEDCAT_MODELS models and, if MEDCAT_MODEL_CACHE_BYTES is set,
+    the cache is within that many bytes. Least recently (or frequently) used models go first, pinned models and
+    those in `keep` are never evicted, and evicting a CDB or Vocab also evicts the CATs built from it.
+    :param evict_dependents: if False, CDBs and Vocabs that CATs are built from are not evicted either
+    """
+    model_maps = (cat_map, cdb_map, vocab_map)
+    keep = {(id(m), k) for m, k in keep}
+    saves = []
+    with _cache_lock:
+        for model_map in model_maps:
+            while len(model_map) > _MAX_MODELS_LOADED and _evict_one([model_map], model_maps, keep, saves,
+                                                                     evict_dependents):
+                pass
+        while _MAX_MODEL_CACHE_BYTES and sum(m.nbytes() for m in model_maps) > _MAX_MODEL_CACHE_BYTES:
+            if not _evict_one(model_maps, model_maps, keep, saves, evict_dependents):
+                logger.warning('Model cache is over MEDCAT_MODEL_CACHE_BYTES:%s, but all remaining models are pinned '
+                               'or in use', _MAX_MODEL_CACHE_BYTES)
+                break
+    _save_evicted(saves)
 
 
 def get_medcat_from_cdb_vocab(project,
-                              cdb_map: Dict[str, CDB]=CDB_MAP,
-                              vocab_map: Dict[str, Vocab]=VOCAB_MAP,
-                              cat_map: Dict[str, CAT]=CAT_MAP) -> CAT:
+                              cdb_map: ModelMap=CDB_MAP,
+                              vocab_map: ModelMap=VOCAB_MAP,
+                              cat_map: ModelMap=CAT_MAP) -> CAT:
     cdb_id = project.concept_db.id
     vocab_id = project.vocab.id
     cat_id = str(cdb_id) + "-" + str(vocab_id)
-    if cat_id in cat_map:
-        cat = cat_map[cat_id]
-    else:
-        if cdb_id in cdb_map:
-            cdb = cdb_map[cdb_id]
-        else:
-            cdb_path = project.concept_db.cdb_file.path
+    pinned = _is_pinned(project)
+    cached = cat_map.get(cat_id)
+    if cached is not None:
+        return cached
+
+    def load_cdb():
+        cdb_path = project.concept_db.cdb_file.path
+        with cdb_delta.loading(cdb_path):
             try:
                 cdb = CDB.load(cdb_path)
             except KeyError as ke:
@@ -61,95 +372,278 @@ def get_medcat_from_cdb_vocab(project,
                                     'Please re-configure this project to use a MedCAT v1.x CDB or consult the '
                                     'MedCATTrainer Dev team if you believe this should work') from ke
                 raise
+            # the log changes apply after sharing, the shared store only ever holds the CDB file
+            cdb = cdb_delta.track(cdb_delta.replay(share_cdb(cdb, cdb_path), cdb_path))
 
-            custom_config = os.getenv("MEDCAT_CONFIG_FILE")
-            if custom_config is not None and os.path.exists(custom_config):
-                cdb.config.parse_config_file(path=custom_config)
-            else:
-                logger.info("No MEDCAT_CONFIG_FILE env var set to valid path, using default config available on CDB")
-            cdb_map[cdb_id] = cdb
-
-        if vocab_id in vocab_map:
-            vocab = vocab_map[vocab_id]
+        custom_config = os.getenv("MEDCAT_CONFIG_FILE")
+        if custom_config is not None and os.path.exists(custom_config):
+            cdb.config.parse_config_file(path=custom_config)
         else:
-            vocab_path = project.vocab.vocab_file.path
-            vocab = Vocab.load(vocab_path)
-            vocab_map[vocab_id] = vocab
-        cat = CAT(cdb=cdb, config=cdb.config, vocab=vocab)
-        cat_map[cat_id] = cat
-        _clear_models(cat_map=cat_map, cdb_map=cdb_map, vocab_map=vocab_map)
+            logger.info("No MEDCAT_CONFIG_FILE env var set to valid path, using default config available on CDB")
+        cdb_map.put(cdb_id, cdb, size=_disk_size(cdb_path), pinned=pinned)
+        return cdb
+
+    def load_vocab():
+        vocab_path = project.vocab.vocab_file.path
+        vocab = share_vocab(Vocab.load(vocab_path), vocab_path)
+        vocab_map.put(vocab_id, vocab, size=_disk_size(vocab_path), pinned=pinned)
+        return vocab
+
+    cdb = _single_flight(cdb_map, cdb_id, load_cdb)
+    _set_load_progress(cat_id, 0.5)
+    vocab = _single_flight(vocab_map, vocab_id, load_vocab)
+    _set_load_progress(cat_id, 0.9)
+    cat = CAT(cdb=cdb, config=cdb.config, vocab=vocab)
+    _set_lock_key(cat_id, cdb_id)
+    cdb_path = project.concept_db.cdb_file.path
+    cat_map.put(cat_id, cat, pinned=pinned, deps=((cdb_map, cdb_id), (vocab_map, vocab_id)),
+                saver=lambda: cdb_delta.save_cdb(cat.cdb, cdb_path))
+    _clear_models(cat_map=cat_map, cdb_map=cdb_map, vocab_map=vocab_map,
+                  keep=((cat_map, cat_id), (cdb_map, cdb_id), (vocab_map, vocab_id)))
     return cat
 
 
-def get_medcat_from_model_pack(project, cat_map: Dict[str, CAT]=CAT_MAP) -> CAT:
+def get_medcat_from_model_pack(project,
+                               cdb_map: ModelMap=CDB_MAP,
+                               vocab_map: ModelMap=VOCAB_MAP,
+                               cat_map: ModelMap=CAT_MAP) -> CAT:
     model_pack_obj = project.model_pack
     cat_id = 'mp' + str(model_pack_obj.id)
-    logger.info('Loading model pack from:%s', model_pack_obj.model_pack.path)
-    cat = CAT.load_model_pack(model_pack_obj.model_pack.path)
-    cat_map[cat_id] = cat
-    _clear_models(cat_map=cat_map)
+    cached = cat_map.get(cat_id)
+    if cached is not None:
+        return cached
+
+    # ModelPack.save has already unpacked the zip, load from that dir rather than checking / unpacking the zip.
+    pack_dir = model_pack_obj.model_pack.path.replace('.zip', '')
+    unpacked = os.path.isdir(pack_dir)
+    model_pack_path = pack_dir if unpacked else model_pack_obj.model_pack.path
+    logger.info('Loading model pack from:%s', model_pack_path)
+    pack_cdb_path = os.path.join(pack_dir, 'cdb.dat')
+    # a pack not yet unpacked has no delta log to replay
+    with cdb_delta.loading(pack_cdb_path) if unpacked else nullcontext():
+        cat = CAT.load_model_pack(model_pack_path)
+        if os.path.isfile(pack_cdb_path):
+            cdb_delta.track(cdb_delta.replay(share_cdb(cat.cdb, pack_cdb_path), pack_cdb_path))
+    _set_load_progress(cat_id, 0.8)
+    # trained packs are saved to the unpacked dir they are loaded from
+    saver = (lambda: cdb_delta.save_cdb(cat.cdb, pack_cdb_path)) if os.path.isfile(pack_cdb_path) else None
+    if cat.vocab is not None and os.path.isfile(os.path.join(pack_dir, 'vocab.dat')):
+        share_vocab(cat.vocab, os.path.join(pack_dir, 'vocab.dat'))
+    pinned = _is_pinned(project)
+
+    # register the packs CDB / Vocab, so lookups of these by id, i.e. concept hierarchy and search,
+    # share this copy rather than loading another. Only if the ConceptDB is the packs CDB file, as CATs built from
+    # the registered CDB save it to the ConceptDB file.
+    deps, keep = [], [(cat_map, cat_id)]
+    size = _disk_size(model_pack_path)
+    if model_pack_obj.concept_db is not None and model_pack_obj.concept_db.cdb_file.path == pack_cdb_path:
+        _set_lock_key(cat_id, model_pack_obj.concept_db.id)
+        cdb_size = _disk_size(model_pack_obj.concept_db.cdb_file.path)
+        _evict(cdb_map, model_pack_obj.concept_db.id, (cat_map, cdb_map, vocab_map))
+        cdb_map.put(model_pack_obj.concept_db.id, cat.cdb, size=cdb_size, pinned=pinned)
+        deps.append((cdb_map, model_pack_obj.concept_db.id))
+        size -= cdb_size
+    if model_pack_obj.vocab is not None and cat.vocab is not None:
+        vocab_size = _disk_size(model_pack_obj.vocab.vocab_file.path)
+        _evict(vocab_map, model_pack_obj.vocab.id, (cat_map, cdb_map, vocab_map))
+        vocab_map.put(model_pack_obj.vocab.id, cat.vocab, size=vocab_size, pinned=pinned)
+        deps.append((vocab_map, model_pack_obj.vocab.id))
+        size -= vocab_size
+    cat_map.put(cat_id, cat, size=max(size, 0), pinned=pinned, deps=deps, saver=saver)
+    _clear_models(cat_map=cat_map, cdb_map=cdb_map, vocab_map=vocab_map, keep=keep + deps)
     return cat
 
 
 def get_medcat(project,
-               cdb_map: Dict[str, CDB]=CDB_MAP,
-               vocab_map: Dict[str, Vocab]=VOCAB_MAP,
-               cat_map: Dict[str, CAT]=CAT_MAP):
+               cdb_map: ModelMap=CDB_MAP,
+               vocab_map: ModelMap=VOCAB_MAP,
+               cat_map: ModelMap=CAT_MAP):
     try:
-        if project.model_pack is None:
-            cat = get_medcat_from_cdb_vocab(project, cdb_map, vocab_map, cat_map)
-        else:
-            cat = get_medcat_from_model_pack(project, cat_map)
-        return cat
+        cat_id = model_id(project)
+
+        def load():
+            _set_load_state(cat_id, 'loading', 0.0)
+            try:
+                if project.model_pack is None:
+                    cat = get_medcat_from_cdb_vocab(project, cdb_map, vocab_map, cat_map)
+                else:
+                    cat = get_medcat_from_model_pack(project, cdb_map, vocab_map, cat_map)
+                _set_load_state(cat_id, 'ready', 1.0)
+                return cat
+            except Exception as e:
+                _set_load_state(cat_id, 'failed', LOAD_STATES[cat_id]['progress'], str(e))
+                raise
+
+        return _single_flight(cat_map, cat_id, load)
     except AttributeError:
         raise Exception('Failure loading Project ConceptDB, Vocab or Model Pack. Are these set correctly?')
 
 
-def get_cached_medcat(project, cat_map: Dict[str, CAT]=CAT_MAP):
-    if project.model_pack is not None:
-        cat_id = 'mp' + str(project.model_pack.id)
-    else:
-        cdb_id = project.concept_db.id
-        vocab_id = project.vocab.id
-        cat_id = str(cdb_id) + "-" + str(vocab_id)
-    return cat_map.get(cat_id)
+def get_load_state(project, cat_map: ModelMap=CAT_MAP) -> Dict:
+    """
+    The state of loading the model of a project, one of 'unloaded', 'loading', 'ready' or 'failed', and the progress
+    of the load from 0 to 1.
+    """
+    try:
+        cat_id = model_id(project)
+    except AttributeError:
+        return {'state': 'unloaded', 'progress': 0.0, 'error': None}
+    if cat_id in cat_map:
+        return {'state': 'ready', 'progress': 1.0, 'error': None}
+    state = LOAD_STATES.get(cat_id)
+    if state is None or state['state'] == 'ready':
+        # never loaded or since evicted
+        return {'state': 'unloaded', 'progress': 0.0, 'error': None}
+    return dict(state)
+
+
+def preload_models(projects) -> threading.Thread:
+    """
+    Load the models of projects in a background thread. Requests for these models while loading wait on that
+    load, see get_medcat.
+    :param projects: iterable of ProjectAnnotateEntities, if a QuerySet it is evaluated in the thread
+    :return: the started thread
+    """
+    def _preload():
+        try:
+            for project in projects:
+                try:
+                    logger.info('Preloading model for project %s', project.id)
+                    get_medcat(project)
+                except Exception as e:
+                    logger.error('Failed to preload model for project %s: %s', project.id, e)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=_preload, name='medcat-model-preload', daemon=True)
+    thread.start()
+    return thread
+
+
+def read_only_view(cat: CAT) -> CAT:
+    """
+    A CAT sharing the CDB, Vocab and MetaCAT / NER models of cat, with its own copy of the config and pipeline, to
+    run over documents, i.e. for metrics, without loading another copy of the model. Changes to the config, such as
+    the linking filters set by CAT._print_stats, don't reach the annotators' CAT. The view must not be trained, as
+    that would update the shared CDB.
+    """
+    view = copy.copy(cat)
+    view.config = copy.deepcopy(cat.config)
+    view._meta_cats = []
+    for meta_cat in cat._meta_cats:
+        meta_cat_view = copy.copy(meta_cat)
+        meta_cat_view.config = copy.deepcopy(meta_cat.config)
+        view._meta_cats.append(meta_cat_view)
+    # not CAT(...), that assigns the config to the shared CDB
+    view._create_pipeline(view.config)
+    return view
+
+
+def get_medcat_view(project, cdb_map: ModelMap=CDB_MAP, vocab_map: ModelMap=VOCAB_MAP,
+                    cat_map: ModelMap=CAT_MAP) -> CAT:
+    """A read_only_view of the model of project, loaded and cached as for the annotators by get_medcat."""
+    return read_only_view(get_medcat(project, cdb_map, vocab_map, cat_map))
+
 
+def get_cached_medcat(project, cat_map: ModelMap=CAT_MAP):
+    return cat_map.get(model_id(project))
 
-def clear_cached_medcat(project, cat_map: Dict[str, CAT]=CAT_MAP):
+
+def clear_cached_medcat(project, cat_map: ModelMap=CAT_MAP):
     if project.model_pack is not None:
         model_pack_obj = project.model_pack
         cat_id = 'mp' + str(model_pack_obj.id)
+        # the model packs CDB / Vocab are registered alongside the CAT, see get_medcat_from_model_pack
+        for dep_map, dep_key in cat_map.deps.get(cat_id, ()):
+            _evict(dep_map, dep_key, (cat_map, CDB_MAP, VOCAB_MAP))
     else:
         cdb_id = project.concept_db.id
         vocab_id = project.vocab.id
-        clear_cached_cdb(cdb_id)
-        clear_cached_vocab(vocab_id)
         cat_id = str(cdb_id) + "-" + str(vocab_id)
-    if cat_id in cat_map:
-        del cat_map[cat_id]
+        # CATs built from this CDB / Vocab hold onto them, so evict these too.
+        _evict(CDB_MAP, cdb_id, (cat_map, CDB_MAP, VOCAB_MAP))
+        _evict(VOCAB_MAP, vocab_id, (cat_map, CDB_MAP, VOCAB_MAP))
+    _evict(cat_map, cat_id, (cat_map, CDB_MAP, VOCAB_MAP))
+
+
+def mark_trained(key: str, cat_map: ModelMap=CAT_MAP, cat: CAT = None) -> bool:
+    """
+    Flag the CAT key, see model_id, as trained since it was last saved.
+    :param cat: if given, only flag key if this is still its cached CAT
+    :return: False if not flagged, as key is not cached
+    """
+    with _cache_lock:
+        if key not in cat_map or (cat is not None and cat_map.get(key) is not cat):
+            return False
+        cat_map.dirty.setdefault(key, [0, time.time()])[0] += 1
+        return True
+
+
+def secs_to_checkpoint(key: str, cat_map: ModelMap=CAT_MAP) -> Optional[float]:
+    """Seconds until the trained CAT key is due saving by MEDCAT_CHECKPOINT_SECS, None if not trained or disabled."""
+    dirty = cat_map.dirty.get(key)
+    if dirty is None or not _CHECKPOINT_SECS:
+        return None
+    return max(dirty[1] + _CHECKPOINT_SECS - time.time(), 0.0)
 
 
-def get_cached_cdb(cdb_id: str, cdb_map: Dict[str, CDB]=CDB_MAP) -> CDB:
-    if cdb_id not in cdb_map:
+def checkpoint_due(key: str, cat_map: ModelMap=CAT_MAP) -> bool:
+    """If the CAT key has been trained MEDCAT_CHECKPOINT_EVERY times, or MEDCAT_CHECKPOINT_SECS ago, since saved."""
+    dirty = cat_map.dirty.get(key)
+    if dirty is None:
+        return False
+    return bool(_CHECKPOINT_EVERY and dirty[0] >= _CHECKPOINT_EVERY) or secs_to_checkpoint(key, cat_map) == 0
+
+
+def save_model(key: str, cat_map: ModelMap=CAT_MAP) -> bool:
+    """
+    Save the CAT key, see model_id, clearing its trained flag.
+    :return: False if the CAT is not loaded, or cannot be saved
+    """
+    saver = cat_map.savers.get(key)
+    dirty = cat_map.dirty.pop(key, None)
+    if saver is None:
+        # never saveable, so never due saving again
+        return False
+    try:
+        with model_lock(key):
+            saver()
+    except Exception:
+        # still unsaved, but not due until another MEDCAT_CHECKPOINT_EVERY trainings or MEDCAT_CHECKPOINT_SECS,
+        # so a failing save is not retried straight away. Trainings since the pop are kept.
+        with _cache_lock:
+            if dirty is not None and key in cat_map:
+                cat_map.dirty.setdefault(key, [0, time.time()])
+        raise
+    logger.info('Saved trained model %s', key)
+    return True
+
+
+def get_cached_cdb(cdb_id: str, cdb_map: ModelMap=CDB_MAP) -> CDB:
+    def load_cdb():
         cdb_obj = ConceptDB.objects.get(id=cdb_id)
-        cdb = CDB.load(cdb_obj.cdb_file.path)
-        cdb_map[cdb_id] = cdb
-    return cdb_map[cdb_id]
+        cdb_path = cdb_obj.cdb_file.path
+        with cdb_delta.loading(cdb_path):
+            cdb = cdb_delta.track(cdb_delta.replay(share_cdb(CDB.load(cdb_path), cdb_path), cdb_path))
+        cdb_map.put(cdb_id, cdb, size=_disk_size(cdb_obj.cdb_file.path))
+        # a CDB lookup, i.e. for search, must never evict the CATs being trained by annotators
+        _clear_models(cdb_map=cdb_map, keep=((cdb_map, cdb_id),), evict_dependents=False)
+        return cdb
+
+    return _single_flight(cdb_map, cdb_id, load_cdb)
 
 
-def clear_cached_cdb(cdb_id, cdb_map: Dict[str, CDB]=CDB_MAP):
-    if cdb_id in cdb_map:
-        del cdb_map[cdb_id]
+def clear_cached_cdb(cdb_id, cdb_map: ModelMap=CDB_MAP):
+    _evict(cdb_map, cdb_id, (CAT_MAP, cdb_map, VOCAB_MAP))
 
 
-def clear_cached_vocab(vocab_id, vocab_map: Dict[str, Vocab]=VOCAB_MAP):
-    if vocab_id in vocab_map:
-        del vocab_map[vocab_id]
+def clear_cached_vocab(vocab_id, vocab_map: ModelMap=VOCAB_MAP):
+    _evict(vocab_map, vocab_id, (CAT_MAP, CDB_MAP, vocab_map))
 
 
 def is_model_loaded(project,
-                    cdb_map: Dict[str, CDB]=CDB_MAP,
-                    cat_map: Dict[str, CAT]=CAT_MAP):
+                    cdb_map: ModelMap=CDB_MAP,
+                    cat_map: ModelMap=CAT_MAP):
     if project.concept_db is None:
         # model pack is used.
         return False if not project.model_pack else f'mp{project.model_pack.id}' in cat_map
@@ -1,6 +1,8 @@
+import hashlib
 import logging
 import os
 import shutil
+from datetime import timedelta
 from zipfile import BadZipFile
 
 import pandas as pd
@@ -8,8 +10,10 @@ from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import RegexValidator
 from django.db import models, transaction
+from django.db.models import Q, QuerySet
 from django.dispatch import receiver
 from django.forms import forms, ModelForm
+from django.utils import timezone
 from medcat.cat import CAT
 from medcat.cdb import CDB
 from medcat.vocab import Vocab
@@ -33,6 +37,13 @@ cdb_name_validator = RegexValidator(r'^[a-zA-Z][a-zA-Z0-9_]*$', 'a-z for first c
 
 logger = logging.getLogger(__name__)
 
+try:
+    # tombstones, see ExportTombstone, are kept this many days, 0 keeps them forever
+    _TOMBSTONE_RETENTION_DAYS = int(os.getenv('MEDCAT_EXPORT_TOMBSTONE_RETENTION_DAYS', 90))
+except ValueError:
+    _TOMBSTONE_RETENTION_DAYS = 90
+    logger.warning('MEDCAT_EXPORT_TOMBSTONE_RETENTION_DAYS is not an integer, using default value of 90')
+
 
 class ModelPack(models.Model):
     name = models.TextField(help_text='', unique=True)
@@ -223,13 +234,13 @@ class Dataset(models.Model):
 class DatasetForm(ModelForm):
     def clean(self):
         original_file = self.cleaned_data['original_file']
-        if '.csv' in original_file.name:
-            df = pd.read_csv(original_file.file, on_bad_lines='error')
-        elif '.xlsx' in original_file.name:
-            df = pd.read_excel(original_file.file)
-        else:
+        if '.csv' not in original_file.name and '.xlsx' not in original_file.name:
             raise forms.ValidationError({'original_file': 'Must be either .csv or .xlsx'})
-        if 'name' not in df.columns or 'text' not in df.columns:
+        # only the header is read here, the rows are read a chunk at a time on import, see dataset_from_file
+        from .data_utils import dataset_columns
+        columns = dataset_columns(original_file.file, original_file.name)
+        original_file.file.seek(0)
+        if 'name' not in columns or 'text' not in columns:
             raise forms.ValidationError({'original_file': 'Must contain at least a "name" and "text" column'})
 
 
@@ -238,11 +249,28 @@ class Document(models.Model):
     create_time = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True)
     text = models.TextField(default="", blank=True)
+    text_hash = models.CharField(max_length=64, default="", blank=True, editable=False, db_index=True,
+                                 help_text='sha256 of the text, to look documents up by their text')
     dataset = models.ForeignKey('Dataset', on_delete=models.CASCADE)
 
     class Meta:
         ordering = ['id']
 
+    @staticmethod
+    def hash_text(text: str) -> str:
+        return hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+
+    def save(self, *args, **kwargs):
+        # set here for instances saved one by one, bulk_create / update callers must set it themselves
+        self.text_hash = Document.hash_text(self.text)
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        # queryset deletes must tombstone their documents themselves, see ExportTombstone.documents_deleted
+        with transaction.atomic():
+            ExportTombstone.documents_deleted(Document.objects.filter(id=self.id))
+            return super().delete(*args, **kwargs)
+
     def __str__(self):
         return f'{self.name} | {self.dataset.name} | {self.dataset.id}'
 
@@ -335,6 +363,11 @@ class EntityRelation(models.Model):
         self.project.last_modified = self.last_modified
         self.project.save()
 
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            ExportTombstone.record('relation', [(self.project_id, self.document_id, self.id)])
+            return super().delete(*args, **kwargs)
+
     def __str__(self):
         return f'{self.start_entity} - {self.relation} - {self.end_entity}'
 
@@ -367,6 +400,12 @@ class AnnotatedEntity(models.Model):
         self.project.last_modified = self.last_modified
         self.project.save()
 
+    def delete(self, *args, **kwargs):
+        # queryset deletes must tombstone their annotations themselves, see ExportTombstone.annotations_deleted
+        with transaction.atomic():
+            ExportTombstone.annotations_deleted(AnnotatedEntity.objects.filter(id=self.id))
+            return super().delete(*args, **kwargs)
+
     def __str__(self):
         return str(self.entity)
 
@@ -507,6 +546,12 @@ class MetaAnnotation(models.Model):
         self.annotated_entity.last_modified = self.last_modified
         self.annotated_entity.save()
 
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            ExportTombstone.record('meta_annotation', AnnotatedEntity.objects.filter(id=self.annotated_entity_id)
+                                   .values_list('project_id', 'document_id', models.Value(self.id)))
+            return super().delete(*args, **kwargs)
+
     def __str__(self):
         return str(self.annotated_entity)
 
@@ -518,6 +563,65 @@ class ExportedProject(models.Model):
         return self.trainer_export_file.name
 
 
+class ExportTombstone(models.Model):
+    """
+    An annotation, meta annotation or relation that was deleted, or a document that is no longer validated, so
+    incremental exports, i.e. download_annos?since=, report these. Ids are kept rather than foreign keys as the
+    rows they refer to are gone.
+    """
+    OBJECT_TYPES = [
+        ('annotation', 'annotation'),
+        ('meta_annotation', 'meta_annotation'),
+        ('relation', 'relation'),
+        ('document', 'document'),
+    ]
+    project_id = models.IntegerField()
+    document_id = models.IntegerField()
+    object_type = models.CharField(max_length=20, choices=OBJECT_TYPES)
+    object_id = models.IntegerField()
+    deleted_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [models.Index(fields=['project_id', 'deleted_at'])]
+
+    def __str__(self):
+        return f'{self.object_type}: {self.object_id} | project: {self.project_id}'
+
+    @classmethod
+    def record(cls, object_type: str, rows):
+        """
+        Tombstone deleted objects in one insert, pruning the tombstones of their projects older than
+        MEDCAT_EXPORT_TOMBSTONE_RETENTION_DAYS.
+        :param object_type: one of OBJECT_TYPES
+        :param rows: (project id, document id, object id) of each deleted object
+        """
+        tombstones = [cls(project_id=p_id, document_id=d_id, object_type=object_type, object_id=o_id)
+                      for p_id, d_id, o_id in rows]
+        if not tombstones:
+            return
+        cls.objects.bulk_create(tombstones)
+        if _TOMBSTONE_RETENTION_DAYS:
+            cutoff = timezone.now() - timedelta(days=_TOMBSTONE_RETENTION_DAYS)
+            cls.objects.filter(project_id__in={t.project_id for t in tombstones}, deleted_at__lt=cutoff).delete()
+
+    @classmethod
+    def annotations_deleted(cls, annotations: QuerySet):
+        """
+        Tombstone the annotations of a queryset about to be deleted, and the relations to them that are deleted along
+        with them. Their meta annotations are covered by the annotations tombstone.
+        """
+        relations = EntityRelation.objects.filter(Q(start_entity__in=annotations) | Q(end_entity__in=annotations))
+        cls.record('relation', relations.values_list('project_id', 'document_id', 'id'))
+        cls.record('annotation', annotations.values_list('project_id', 'document_id', 'id'))
+
+    @classmethod
+    def documents_deleted(cls, documents: QuerySet):
+        """Tombstone the documents of a queryset about to be deleted, for each project they were validated in."""
+        through = Project.validated_documents.through
+        cls.record('document', through.objects.filter(document__in=documents)
+                   .values_list('project_id', 'document_id', 'document_id'))
+
+
 class ProjectMetrics(models.Model):
     report_name_generated = models.TextField(help_text='report name that links this metrics report to a previously '
                                                        'ran bg task')
@@ -0,0 +1,157 @@
+"""
+Optional shared store for the numeric bulk of loaded CDBs and Vocabs, i.e. the CDB context vectors and the Vocab
+word vectors and unigram probabilities.
+
+These are written once to .npy files and every process (uwsgi workers and the background task runner) then
+memory maps them, so the OS page cache holds a single copy. Files are mapped copy-on-write, training in a process
+only changes that processes private pages, never the store or the models of other processes.
+
+Enabled with env var MEDCAT_SHARED_MODEL_STORE.
+"""
+
+import ctypes
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from typing import Dict, List, Tuple
+
+import numpy as np
+from medcat.cdb import CDB
+from medcat.vocab import Vocab
+
+from core.settings import MEDIA_ROOT
+
+logger = logging.getLogger(__name__)
+
+_ENABLED = os.getenv('MEDCAT_SHARED_MODEL_STORE', '0').lower() in ('1', 'y', 'true')
+_STORE_DIR = os.getenv('MEDCAT_SHARED_MODEL_STORE_DIR', os.path.join(MEDIA_ROOT, 'shared_model_store'))
+
+try:
+    _libc = ctypes.CDLL('libc.so.6')
+except OSError:
+    _libc = None
+
+
+def _store_key(model_path: str) -> str:
+    # keyed on the model file, then when it was last written, so saved models are re-shared on the next load.
+    stat = os.stat(model_path)
+    path_key = hashlib.sha1(os.path.abspath(model_path).encode('utf-8')).hexdigest()
+    version_key = hashlib.sha1(f'{stat.st_mtime_ns}:{stat.st_size}'.encode('utf-8')).hexdigest()
+    return f'{path_key}-{version_key}'
+
+
+def _remove_superseded(store_path: str, model_path: str):
+    # the store files of earlier versions of the same model file. Processes still mapping these keep their pages,
+    # the files are only unlinked.
+    store_dir, name = os.path.split(store_path)
+    store_key = name.split('.')[0]
+    if _store_key(model_path) != store_key:
+        return  # the model file has since been saved again, so this version is itself superseded
+    path_key = store_key.split('-')[0]
+    for other in os.listdir(store_dir):
+        if other.startswith(path_key + '-') and other.split('.')[0] != store_key and not other.endswith('.tmp'):
+            try:
+                os.remove(os.path.join(store_dir, other))
+                logger.info('Removed superseded shared model store file %s', other)
+            except FileNotFoundError:
+                pass  # removed by another process
+
+
+def _atomic_write(path: str, write_fn):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_fn(f)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def _mapped_rows(store_path: str, model_path: str, index: List, rows) -> Tuple[List, np.ndarray]:
+    """
+    Returns the index and memory mapped matrix of rows in the store at store_path, writing these if not present.
+    Writing these removes the store files of earlier versions of the model file.
+    :param store_path: path without extension of the .npy matrix and its .json index
+    :param model_path: the model file the rows were loaded from
+    :param index: keys for each of rows
+    :param rows: callable returning the vectors to store, in the order of index
+    """
+    npy_path, index_path = f'{store_path}.npy', f'{store_path}.json'
+    for attempt in range(2):
+        if not (os.path.exists(npy_path) and os.path.exists(index_path)):
+            os.makedirs(os.path.dirname(store_path), exist_ok=True)
+            _atomic_write(npy_path, lambda f: np.save(f, np.stack(rows())))
+            _atomic_write(index_path, lambda f: f.write(json.dumps(index).encode('utf-8')))
+            _remove_superseded(store_path, model_path)
+        try:
+            with open(index_path) as f:
+                stored_index = json.load(f)
+            return stored_index, np.load(npy_path, mmap_mode='c')
+        except FileNotFoundError:
+            # removed as superseded by another process since, as the model file was saved again after it was loaded
+            if attempt:
+                raise
+
+
+def _release_freed_memory():
+    # context / word vectors are small allocations, ask glibc to hand the now unused heap back to the OS
+    if _libc is not None:
+        try:
+            _libc.malloc_trim(0)
+        except AttributeError:
+            pass
+
+
+def share_cdb(cdb: CDB, cdb_path: str) -> CDB:
+    """
+    Swap the context vectors of cdb for rows of a memory mapped matrix in the store.
+    :param cdb: the loaded CDB
+    :param cdb_path: the file cdb was loaded from
+    :return: the same CDB, now reading its context vectors from the store
+    """
+    if not _ENABLED or not cdb.cui2context_vectors:
+        return cdb
+    index = [[cui, ctx_type] for cui, vecs in cdb.cui2context_vectors.items() for ctx_type in vecs]
+    if len({cdb.cui2context_vectors[cui][ctx_type].shape for cui, ctx_type in index}) != 1:
+        logger.warning('Context vectors of CDB %s differ in shape, not using the shared model store', cdb_path)
+        return cdb
+    store_path = os.path.join(_STORE_DIR, f'{_store_key(cdb_path)}.cdb')
+    index, matrix = _mapped_rows(store_path, cdb_path, index,
+                                 lambda: [cdb.cui2context_vectors[cui][ctx_type] for cui, ctx_type in index])
+    for row, (cui, ctx_type) in enumerate(index):
+        cdb.cui2context_vectors[cui][ctx_type] = np.asarray(matrix[row])
+    _release_freed_memory()
+    logger.info('Mapped %s context vectors of CDB %s from the shared model store', len(index), cdb_path)
+    return cdb
+
+
+def share_vocab(vocab: Vocab, vocab_path: str) -> Vocab:
+    """
+    Swap the word vectors and unigram probabilities of vocab for memory mapped arrays in the store.
+    :param vocab: the loaded Vocab
+    :param vocab_path: the file vocab was loaded from
+    :return: the same Vocab, now reading its vectors from the store
+    """
+    if not _ENABLED:
+        return vocab
+    words: Dict[str, dict] = vocab.vocab
+    index = [w for w, item in words.items() if item.get('vec') is not None]
+    if not index or len({words[w]['vec'].shape for w in index}) != 1:
+        logger.warning('Vocab %s has no, or mixed shape, word vectors, not using the shared model store', vocab_path)
+        return vocab
+    store_key = _store_key(vocab_path)
+    index, matrix = _mapped_rows(os.path.join(_STORE_DIR, f'{store_key}.vocab'), vocab_path, index,
+                                 lambda: [words[w]['vec'] for w in index])
+    for row, word in enumerate(index):
+        words[word]['vec'] = np.asarray(matrix[row])
+    if len(getattr(vocab, 'cum_probs', [])):
+        _, cum_probs = _mapped_rows(os.path.join(_STORE_DIR, f'{store_key}.cum_probs'), vocab_path, [],
+                                    lambda: [vocab.cum_probs])
+        vocab.cum_probs = np.asarray(cum_probs[0])
+    _release_freed_memory()
+    logger.info('Mapped %s word vectors of Vocab %s from the shared model store', len(index), vocab_path)
+    return vocab
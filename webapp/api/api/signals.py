@@ -1,4 +1,3 @@
-import json
 import logging
 import os
 import shutil
@@ -8,9 +7,9 @@ from django.db.models.fields.files import FileField
 from django.db.models.signals import post_save, post_delete, pre_save, m2m_changed, pre_delete
 from django.dispatch import receiver
 
-from api.data_utils import dataset_from_file, delete_orphan_docs, upload_projects_export
+from api.data_utils import dataset_from_file, delete_orphan_docs, import_projects_export
 from api.models import Dataset, ExportedProject, ModelPack, ProjectFields, ProjectAnnotateEntitiesFields, MetaTask, \
-    ProjectAnnotateEntities
+    ProjectAnnotateEntities, Document, Project, ExportTombstone
 from core.settings import MEDIA_ROOT
 
 
@@ -43,7 +42,7 @@ def remove_dataset_file(sender, instance, **kwargs):
 def save_exported_projects(sender, instance, **kwargs):
     if not instance.trainer_export_file.path.endswith('.json'):
         raise Exception("Please make sure the file is a .json file")
-    upload_projects_export(json.load(open(instance.trainer_export_file.path)))
+    import_projects_export(instance.trainer_export_file.path)
 
 
 @receiver(pre_delete, sender=ModelPack)
@@ -83,3 +82,28 @@ def project_tasks_changed(sender, instance, action, **kwargs):
 
 
 m2m_changed.connect(project_tasks_changed, sender=ProjectAnnotateEntitiesFields.tasks.through)
+
+
+def _documents_unvalidated(project_ids, document_ids):
+    ExportTombstone.record('document', [(p_id, d_id, d_id) for p_id in project_ids for d_id in document_ids])
+
+
+def validated_documents_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'post_remove':
+        if reverse:
+            _documents_unvalidated(pk_set, [instance.id])
+        else:
+            _documents_unvalidated([instance.id], pk_set)
+    elif action == 'pre_clear':
+        if reverse:
+            _documents_unvalidated(list(instance.project_set.values_list('id', flat=True)), [instance.id])
+        else:
+            _documents_unvalidated([instance.id], list(instance.validated_documents.values_list('id', flat=True)))
+
+
+m2m_changed.connect(validated_documents_changed, sender=Project.validated_documents.through)
+
+
+@receiver(pre_delete, sender=Dataset)
+def dataset_documents_deleted(sender, instance, **kwargs):
+    ExportTombstone.documents_deleted(Document.objects.filter(dataset=instance))
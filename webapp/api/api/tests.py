@@ -1,3 +1,1023 @@
-from django.test import TestCase
+import gzip
+import io
+import json
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+import timeit
+import zipfile
+from datetime import timedelta
+from types import SimpleNamespace
+from unittest import skipUnless
+from unittest.mock import patch
 
-# Create your tests here.
+import numpy as np
+import pandas as pd
+import spacy
+from background_task.models import Task
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from medcat.cat import CAT
+from medcat.cdb import CDB
+from medcat.config import Config
+from medcat.vocab import Vocab
+from rest_framework.test import APIClient
+
+from api import cdb_delta, doc_cache, model_cache, shared_model_store, training_queue
+from api.admin import download_projects_columnar, download_projects_with_text, download_projects_without_text, \
+    retrieve_project_data
+from api.batch_inference import annotate_documents, annotate_texts
+from api.data_utils import dataset_from_file, import_projects_export, import_status, sanitise_input, \
+    sanitise_texts
+from api.medcat_utils import cui_filter
+from api.metrics import ProjectMetrics, calculate_metrics
+from api.models import AnnotatedEntity, ConceptDB, Dataset, Document, Entity, EntityRelation, ExportTombstone, \
+    MetaAnnotation, MetaTask, MetaTaskValue, ProjectAnnotateEntities, Relation, Vocabulary
+from api.utils import add_annotations, _delete_annotations, _IntervalIndex, _remove_overlap
+from api.model_cache import ModelMap, _clear_models
+
+# benchmarks print the run times of optimised code against the code it replaced. Skipped unless set, as they
+# take a while and timings vary by machine.
+_RUN_BENCHMARKS = os.getenv('MEDCAT_RUN_BENCHMARKS', '0').lower() in ('1', 'y', 'true')
+
+
+def _benchmark(name: str, repeat: int = 3, **fns):
+    """Print the best of repeat run times of each of fns, by label."""
+    times = {label: min(timeit.repeat(fn, number=1, repeat=repeat)) for label, fn in fns.items()}
+    print(f'\n{name}: ' + ', '.join(f'{label} {t * 1000:.1f}ms' for label, t in times.items()))
+    return times
+
+
+class ModelCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.cdb_map, self.vocab_map, self.cat_map = ModelMap('cdb'), ModelMap('vocab'), ModelMap('cat')
+
+    def _load(self, cdb_id, vocab_id, size, pinned=False):
+        self.cdb_map.put(cdb_id, object(), size=size, pinned=pinned)
+        self.vocab_map.put(vocab_id, object(), size=size, pinned=pinned)
+        cat_id = f'{cdb_id}-{vocab_id}'
+        self.cat_map.put(cat_id, object(), pinned=pinned,
+                         deps=((self.cdb_map, cdb_id), (self.vocab_map, vocab_id)))
+        _clear_models(cdb_map=self.cdb_map, vocab_map=self.vocab_map, cat_map=self.cat_map,
+                      keep=((self.cat_map, cat_id), (self.cdb_map, cdb_id), (self.vocab_map, vocab_id)))
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 2)
+    def test_evicts_least_recently_used(self):
+        self._load(1, 1, 10)
+        self._load(2, 2, 10)
+        self.cat_map['1-1']  # using the CAT also marks its CDB / Vocab as used
+        self._load(3, 3, 10)
+        self.assertEqual(set(self.cat_map), {'1-1', '3-3'})
+        self.assertEqual(set(self.cdb_map), {1, 3})
+        self.assertEqual(set(self.vocab_map), {1, 3})
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 1)
+    @patch.object(model_cache, '_CHECKPOINT_EVERY', 2)
+    def test_trained_models_are_saved_when_due_and_before_eviction(self):
+        saved = []
+        self._load(1, 1, 10)
+        self.cat_map.savers['1-1'] = lambda: saved.append('1-1')
+        model_cache.mark_trained('1-1', self.cat_map)
+        self.assertFalse(model_cache.checkpoint_due('1-1', self.cat_map))
+        model_cache.mark_trained('1-1', self.cat_map)
+        self.assertTrue(model_cache.checkpoint_due('1-1', self.cat_map))
+        self.assertTrue(model_cache.save_model('1-1', self.cat_map))
+        self.assertEqual((saved, self.cat_map.dirty), (['1-1'], {}))
+
+        model_cache.mark_trained('1-1', self.cat_map)
+        self._load(2, 2, 10)
+        self.assertEqual(saved, ['1-1', '1-1'])
+        self.assertNotIn('1-1', self.cat_map)
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 1)
+    def test_evicted_models_are_saved_with_the_caches_unlocked(self):
+        saving, release = threading.Event(), threading.Event()
+
+        def slow_save():
+            saving.set()
+            release.wait(5)
+        self._load(1, 1, 10)
+        self.cat_map.savers['1-1'] = slow_save
+        model_cache.mark_trained('1-1', self.cat_map)
+        loader = threading.Thread(target=self._load, args=(2, 2, 10))
+        loader.start()
+        self.assertTrue(saving.wait(5))
+        # other requests use the caches while the evicted model saves
+        acquired = model_cache._cache_lock.acquire(timeout=1)
+        if acquired:
+            model_cache._cache_lock.release()
+        release.set()
+        loader.join(5)
+        self.assertTrue(acquired)
+        self.assertEqual(set(self.cat_map), {'2-2'})
+
+    @patch.object(model_cache, '_CHECKPOINT_EVERY', 2)
+    @patch.object(model_cache, '_CHECKPOINT_SECS', 60)
+    def test_failed_save_is_not_due_again_straight_away(self):
+        self._load(1, 1, 10)
+
+        def fail():
+            raise IOError('disk full')
+        self.cat_map.savers['1-1'] = fail
+        model_cache.mark_trained('1-1', self.cat_map)
+        model_cache.mark_trained('1-1', self.cat_map)
+        self.assertTrue(model_cache.checkpoint_due('1-1', self.cat_map))
+        with self.assertRaises(IOError):
+            model_cache.save_model('1-1', self.cat_map)
+        # still unsaved, but due after further trainings or MEDCAT_CHECKPOINT_SECS, not on the next check
+        self.assertIn('1-1', self.cat_map.dirty)
+        self.assertFalse(model_cache.checkpoint_due('1-1', self.cat_map))
+        self.assertGreater(model_cache.secs_to_checkpoint('1-1', self.cat_map), 0)
+        model_cache.mark_trained('1-1', self.cat_map)
+        model_cache.mark_trained('1-1', self.cat_map)
+        self.assertTrue(model_cache.checkpoint_due('1-1', self.cat_map))
+
+        # without a saver the model is never due again
+        del self.cat_map.savers['1-1']
+        self.assertFalse(model_cache.save_model('1-1', self.cat_map))
+        self.assertFalse(model_cache.checkpoint_due('1-1', self.cat_map))
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 10)
+    @patch.object(model_cache, '_MAX_MODEL_CACHE_BYTES', 50)
+    def test_byte_budget_evicts_dependent_cats(self):
+        self._load(1, 1, 20)
+        self._load(2, 2, 20)
+        self.assertEqual(set(self.cdb_map), {2})
+        self.assertEqual(set(self.cat_map), {'2-2'})
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 1)
+    def test_pinned_models_are_not_evicted(self):
+        self._load(1, 1, 10, pinned=True)
+        self._load(2, 2, 10)
+        self._load(3, 3, 10)
+        self.assertEqual(set(self.cat_map), {'1-1', '3-3'})
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 1)
+    def test_cdb_lookups_do_not_evict_cats(self):
+        self._load(1, 1, 10)
+        self.cdb_map.put(2, object())
+        _clear_models(cdb_map=self.cdb_map, vocab_map=self.vocab_map, cat_map=self.cat_map,
+                      keep=((self.cdb_map, 2),), evict_dependents=False)
+        self.assertEqual(set(self.cat_map), {'1-1'})
+        self.assertEqual(set(self.cdb_map), {1, 2})
+        # CDBs no CAT is built from are still evicted
+        self.cdb_map.put(3, object())
+        _clear_models(cdb_map=self.cdb_map, vocab_map=self.vocab_map, cat_map=self.cat_map,
+                      keep=((self.cdb_map, 3),), evict_dependents=False)
+        self.assertEqual(set(self.cdb_map), {1, 3})
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 2)
+    def test_concurrent_use_and_eviction(self):
+        errors = []
+
+        def use(offset):
+            try:
+                for i in range(200):
+                    self._load(offset + i % 5, offset + i % 5, 10)
+                    self.cat_map.get(f'{offset}-{offset}')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use, args=(offset,)) for offset in (0, 10, 20, 30)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(len(self.cat_map), 2)
+        # every CAT still has the CDB and Vocab it was built from
+        for cat_id in self.cat_map:
+            cdb_id, vocab_id = (int(i) for i in cat_id.split('-'))
+            self.assertIn(cdb_id, self.cdb_map)
+            self.assertIn(vocab_id, self.vocab_map)
+
+    def test_concurrent_loads_wait_on_the_first(self):
+        project = SimpleNamespace(id=1, model_pack=None, concept_db=SimpleNamespace(id=1), vocab=SimpleNamespace(id=1))
+        loads = []
+        self.addCleanup(model_cache.CAT_MAP.clear)
+
+        def slow_load(project, cdb_map, vocab_map, cat_map):
+            loads.append(project.id)
+            time.sleep(0.2)
+            cat_map.put('1-1', object())
+            return cat_map['1-1']
+
+        with patch.object(model_cache, 'get_medcat_from_cdb_vocab', side_effect=slow_load):
+            preload = model_cache.preload_models([project])
+            time.sleep(0.05)
+            self.assertEqual(model_cache.get_load_state(project)['state'], 'loading')
+            cat = model_cache.get_medcat(project)
+            preload.join()
+        self.assertEqual(loads, [1])
+        self.assertIs(cat, model_cache.CAT_MAP['1-1'])
+        self.assertEqual(model_cache.get_load_state(project)['state'], 'ready')
+
+    def test_model_pack_is_loaded_once(self):
+        pack_dir = tempfile.mkdtemp()
+        project = SimpleNamespace(id=1, model_pack=SimpleNamespace(
+            id=96, model_pack=SimpleNamespace(path=os.path.join(pack_dir, 'pack.zip')), concept_db=None, vocab=None))
+        cat = SimpleNamespace(cdb=CDB(config=Config()), vocab=None)
+
+        with patch.object(model_cache.CAT, 'load_model_pack', return_value=cat) as load_model_pack:
+            first = model_cache.get_medcat(project, self.cdb_map, self.vocab_map, self.cat_map)
+            second = model_cache.get_medcat(project, self.cdb_map, self.vocab_map, self.cat_map)
+        self.assertEqual(load_model_pack.call_count, 1)
+        # the zip has not been unpacked, so is loaded directly
+        load_model_pack.assert_called_with(os.path.join(pack_dir, 'pack.zip'))
+        self.assertIs(first, cat)
+        self.assertIs(second, first)
+
+    @patch.object(model_cache, '_MAX_MODELS_LOADED', 2)
+    def test_model_pack_cdb_shares_the_model_lock(self):
+        pack_dir = os.path.join(tempfile.mkdtemp(), 'pack')
+        os.makedirs(pack_dir)
+        open(os.path.join(pack_dir, 'cdb.dat'), 'wb').close()
+        concept_db = SimpleNamespace(id=7, cdb_file=SimpleNamespace(path=os.path.join(pack_dir, 'cdb.dat')))
+        pack_project = SimpleNamespace(id=1, model_pack=SimpleNamespace(
+            id=95, model_pack=SimpleNamespace(path=pack_dir + '.zip'), concept_db=concept_db, vocab=None))
+        project = SimpleNamespace(id=2, model_pack=None, concept_db=concept_db, vocab=SimpleNamespace(id=1))
+        pack_cdb = CDB(config=Config())
+        self.vocab_map.put(1, object())
+
+        with patch.object(model_cache, 'CAT') as cat_cls:
+            cat_cls.load_model_pack.return_value = SimpleNamespace(cdb=pack_cdb, vocab=None)
+            model_cache.get_medcat(pack_project, self.cdb_map, self.vocab_map, self.cat_map)
+            model_cache.get_medcat(project, self.cdb_map, self.vocab_map, self.cat_map)
+        # the project using the packs ConceptDB builds its CAT from the packs CDB, so trains under the same lock
+        self.assertIs(cat_cls.call_args.kwargs['cdb'], pack_cdb)
+        self.assertEqual(set(self.cat_map), {'mp95', '7-1'})
+        self.assertIs(model_cache.model_lock('mp95'), model_cache.model_lock('7-1'))
+        self.assertIsNot(model_cache.model_lock('mp95'), model_cache.model_lock('8-1'))
+
+    def test_single_flight_shares_one_load(self):
+        loads = []
+        waited = model_cache.LOAD_STATS['cdb']['waited']
+
+        def slow_load():
+            loads.append(1)
+            time.sleep(0.2)
+            self.cdb_map.put(1, object())
+            return self.cdb_map[1]
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(
+            model_cache._single_flight(self.cdb_map, 1, slow_load))) for _ in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(r is results[0] for r in results))
+        self.assertEqual(model_cache.LOAD_STATS['cdb']['waited'] - waited, 2)
+
+
+class SharedModelStoreTestCase(TestCase):
+
+    def test_cdb_context_vectors_are_memory_mapped(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                patch.object(shared_model_store, '_ENABLED', True), \
+                patch.object(shared_model_store, '_STORE_DIR', tmp_dir):
+            cdb_path = os.path.join(tmp_dir, 'cdb.dat')
+            open(cdb_path, 'wb').close()
+            cdbs = []
+            for _ in range(2):
+                cdb = CDB()
+                cdb.cui2context_vectors = {'C1': {'long': np.arange(3.0)}, 'C2': {'short': np.ones(3)}}
+                cdbs.append(shared_model_store.share_cdb(cdb, cdb_path))
+            vec = cdbs[0].cui2context_vectors['C1']['long']
+            self.assertTrue(np.array_equal(vec, np.arange(3.0)))
+            self.assertIsInstance(vec.base, np.memmap)
+            # copy-on-write, in place updates stay local to that model
+            vec += 1
+            self.assertTrue(np.array_equal(cdbs[1].cui2context_vectors['C1']['long'], np.arange(3.0)))
+
+    def test_superseded_store_files_are_removed(self):
+        with tempfile.TemporaryDirectory() as tmp_dir, \
+                patch.object(shared_model_store, '_ENABLED', True), \
+                patch.object(shared_model_store, '_STORE_DIR', os.path.join(tmp_dir, 'store')):
+            cdb_path = os.path.join(tmp_dir, 'cdb.dat')
+            shared = []
+            for version in range(2):
+                with open(cdb_path, 'wb') as f:
+                    f.write(b'0' * (version + 1))
+                cdb = CDB()
+                cdb.cui2context_vectors = {'C1': {'long': np.full(3, float(version))}}
+                shared.append(shared_model_store.share_cdb(cdb, cdb_path))
+            store_files = os.listdir(os.path.join(tmp_dir, 'store'))
+            self.assertEqual(len(store_files), 2)
+            self.assertTrue(all(f.startswith(shared_model_store._store_key(cdb_path)) for f in store_files))
+            # still mapped by the CDB shared before the model file was saved again
+            self.assertTrue(np.array_equal(shared[0].cui2context_vectors['C1']['long'], np.zeros(3)))
+
+
+class CdbDeltaTestCase(TestCase):
+
+    def _name(self, name):
+        return {name.replace(' ', '~'): {'tokens': name.split(), 'snames': {name.split()[0]}, 'raw_name': name,
+                                         'is_upper': False}}
+
+    def test_save_appends_changes_and_compacts(self):
+        cdb_path = os.path.join(tempfile.mkdtemp(), 'cdb.dat')
+        cdb = CDB()
+        cdb.add_names('C1', self._name('kidney failure'), name_status='P')
+        cdb.save(cdb_path)
+
+        with patch.object(cdb_delta, '_ENABLED', True), patch.object(cdb_delta, '_COMPACT_RATIO', 100):
+            cdb = cdb_delta.track(cdb_delta.load_cdb(cdb_path))
+            cdb.add_names('C2', self._name('fever'), name_status='P')
+            cdb.update_context_vector('C1', vectors={'long': np.ones(3)})
+            snapshot_mtime = os.stat(cdb_path).st_mtime_ns
+            cdb_delta.save_cdb(cdb, cdb_path)
+            self.assertEqual(os.stat(cdb_path).st_mtime_ns, snapshot_mtime)
+
+            for loaded in (cdb_delta.load_cdb(cdb_path), (cdb_delta.compact(cdb_path), CDB.load(cdb_path))[1]):
+                self.assertEqual(loaded.name2cuis['fever'], ['C2'])
+                self.assertEqual(loaded.cui2names['C1'], {'kidney~failure'})
+                self.assertTrue(np.array_equal(loaded.cui2context_vectors['C1']['long'], np.ones(3)))
+                self.assertEqual(loaded.cui2count_train['C1'], 1)
+            self.assertEqual(os.path.getsize(cdb_path + '.delta'), 0)
+
+    def test_torn_record_is_ignored(self):
+        cdb_path = os.path.join(tempfile.mkdtemp(), 'cdb.dat')
+        CDB().save(cdb_path)
+        with patch.object(cdb_delta, '_ENABLED', True):
+            cdb = cdb_delta.track(cdb_delta.load_cdb(cdb_path))
+            cdb.add_names('C1', self._name('fever'), name_status='P')
+            cdb_delta.save_cdb(cdb, cdb_path)
+            with open(cdb_path + '.delta', 'ab') as f:
+                f.write(b'\x80\x05\x95partial')
+            self.assertEqual(cdb_delta.load_cdb(cdb_path).cui2names['C1'], {'fever'})
+
+    def test_failed_save_keeps_changes(self):
+        cdb_path = os.path.join(tempfile.mkdtemp(), 'cdb.dat')
+        CDB().save(cdb_path)
+        with patch.object(cdb_delta, '_ENABLED', True):
+            cdb = cdb_delta.track(cdb_delta.load_cdb(cdb_path))
+            cdb.add_names('C1', self._name('fever'), name_status='P')
+            with patch.object(cdb_delta.os, 'fsync', side_effect=OSError('disk full')), \
+                    self.assertRaises(OSError):
+                cdb_delta.save_cdb(cdb, cdb_path)
+            os.remove(cdb_path + '.delta')
+            cdb_delta.save_cdb(cdb, cdb_path)
+            self.assertEqual(cdb_delta.load_cdb(cdb_path).cui2names['C1'], {'fever'})
+
+    def test_compact_keeps_snapshot_saved_meanwhile(self):
+        cdb_path = os.path.join(tempfile.mkdtemp(), 'cdb.dat')
+        CDB().save(cdb_path)
+        replay, snapshotted = cdb_delta._replay, []
+
+        def replay_then_snapshot(cdb, path, end=None):
+            applied = replay(cdb, path, end)
+            if snapshotted:
+                return applied
+            snapshotted.append(True)
+            # another save writes a full snapshot, then enough changes to regrow the log past end
+            other = cdb_delta.track(cdb_delta.load_cdb(cdb_path))
+            other.add_names('C2', self._name('rash'), name_status='P')
+            cdb_delta._save_changes(other, cdb_path, set(), set(), set(), True)
+            for i in range(3):
+                other.add_names(f'C{3 + i}', self._name(f'pain {i}'), name_status='P')
+                cdb_delta.save_cdb(other, cdb_path)
+            return applied
+
+        with patch.object(cdb_delta, '_ENABLED', True), patch.object(cdb_delta, '_COMPACT_RATIO', 100):
+            cdb = cdb_delta.track(cdb_delta.load_cdb(cdb_path))
+            cdb.add_names('C1', self._name('fever'), name_status='P')
+            cdb_delta.save_cdb(cdb, cdb_path)
+            with patch.object(cdb_delta, '_replay', side_effect=replay_then_snapshot):
+                cdb_delta.compact(cdb_path)
+            loaded = cdb_delta.load_cdb(cdb_path)
+        self.assertEqual(set(loaded.cui2names), {'C1', 'C2', 'C3', 'C4', 'C5'})
+
+
+class CuiFilterTestCase(TestCase):
+
+    def test_filters_are_per_thread(self):
+        cat = SimpleNamespace(config=Config())
+        cat.config.linking.filters.cuis_exclude.add('C3')
+        barrier = threading.Barrier(2)
+        results = {}
+
+        def link(name, cuis):
+            with cui_filter(cat, cuis):
+                barrier.wait()
+                results[name] = [c for c in ('C1', 'C2', 'C3') if cat.config.linking.filters.check_filters(c)]
+                barrier.wait()
+
+        threads = [threading.Thread(target=link, args=('p1', {'C1'})),
+                   threading.Thread(target=link, args=('p2', set()))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, {'p1': ['C1'], 'p2': ['C1', 'C2']})
+        # outside of any cui_filter the models own filters apply
+        self.assertTrue(cat.config.linking.filters.check_filters('C2'))
+        self.assertFalse(cat.config.linking.filters.check_filters('C3'))
+
+
+class BatchInferenceTestCase(TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.tmp_dir = tempfile.TemporaryDirectory()
+        spacy.blank('en').to_disk(cls.tmp_dir.name)
+        config = Config()
+        config.general.spacy_model = cls.tmp_dir.name
+        cdb = CDB(config=config)
+        cdb.add_names('C1', {'kidney~failure': {'tokens': ['kidney', 'failure'], 'snames': ['kidney', 'kidney~failure'],
+                                                'raw_name': 'kidney failure', 'is_upper': False}}, name_status='P')
+        cdb.add_names('C2', {'fever': {'tokens': ['fever'], 'snames': ['fever'], 'raw_name': 'fever',
+                                       'is_upper': False}}, name_status='P')
+        vocab = Vocab()
+        for word in ('the', 'patient', 'has', 'kidney', 'failure', 'and', 'fever'):
+            vocab.add_word(word, cnt=10, vec=np.random.rand(5))
+        vocab.make_unigram_table()
+        cls.cat = CAT(cdb=cdb, config=cdb.config, vocab=vocab)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tmp_dir.cleanup()
+        super().tearDownClass()
+
+    def test_read_only_view_shares_model_not_config(self):
+        view = model_cache.read_only_view(self.cat)
+        self.assertIs(view.cdb, self.cat.cdb)
+        self.assertIs(view.vocab, self.cat.vocab)
+        self.assertIs(self.cat.cdb.config, self.cat.config)
+        view.config.linking.filters.cuis = {'C2'}
+        self.assertEqual(self.cat.config.linking.filters.cuis, set())
+        self.assertEqual([ent._.cui for ent in view('kidney failure and fever')._.ents], ['C2'])
+        self.assertEqual([ent._.cui for ent in self.cat('kidney failure and fever')._.ents], ['C1', 'C2'])
+
+    @staticmethod
+    def _ents(docs):
+        return [[(ent.start_char, ent.end_char, ent._.cui) for ent in doc._.ents] for doc in docs]
+
+    def test_batches_match_single_doc_inference(self):
+        texts = ['The patient has kidney failure and fever', 'fever', '', 'nothing to find'] * 3
+        expected = [[(ent.start_char, ent.end_char, ent._.cui) for ent in self.cat(text)._.ents] if text else []
+                    for text in texts]
+        self.assertEqual(self._ents(annotate_texts(self.cat, texts, batch_size=2)), expected)
+        with cui_filter(self.cat, {'C2'}):
+            self.assertEqual(self._ents(annotate_texts(self.cat, texts[:2], batch_size=1)),
+                             [[(35, 40, 'C2')], [(0, 5, 'C2')]])
+
+    def test_failed_batch_falls_back_to_single_doc_inference(self):
+        texts = ['The patient has kidney failure and fever', '', 'fever']
+        expected = self._ents(annotate_texts(self.cat, texts, batch_size=2))
+        with patch.object(self.cat.pipe.spacy_nlp, 'pipe', side_effect=RuntimeError('batch failed')):
+            self.assertEqual(self._ents(annotate_texts(self.cat, texts, batch_size=2)), expected)
+        # a document failing alone still fails, after the documents before it
+        with patch.object(self.cat.pipe.spacy_nlp, 'pipe', side_effect=RuntimeError('batch failed')), \
+                patch.object(CAT, '__call__', side_effect=RuntimeError('doc failed')):
+            docs = annotate_texts(self.cat, ['', 'fever'], batch_size=1)
+            self.assertEqual(self._ents([next(docs)]), [[]])
+            with self.assertRaisesMessage(RuntimeError, 'doc failed'):
+                next(docs)
+
+    def test_prepared_docs_are_reused(self):
+        document = SimpleNamespace(id=1, text='The patient has kidney failure and fever')
+        with cui_filter(self.cat, {'C1'}):
+            doc, = annotate_documents(self.cat, [document])
+            self.assertIs(next(annotate_documents(self.cat, [document])), doc)
+        # other CUI filters need re-linking, training only needs the tokens
+        with cui_filter(self.cat, {'C2'}):
+            relinked_doc, = annotate_documents(self.cat, [document])
+            self.assertIsNot(relinked_doc, doc)
+        self.assertIs(doc_cache.get_or_run(self.cat, document), relinked_doc)
+        doc_cache.model_trained(self.cat)
+        self.assertIsNone(doc_cache.get(self.cat, document, max_staleness=0, match_cui_filter=False))
+        document.text = 'fever'
+        self.assertIsNone(doc_cache.get(self.cat, document, max_staleness=1, match_cui_filter=False))
+
+
+def _create_project(name='project'):
+    """A user, annotation project and a document, without the model / dataset files these usually load on save."""
+    user = User.objects.create(username=f'{name}_user')
+    dataset, = Dataset.objects.bulk_create([Dataset(name=f'{name}_dataset', original_file='dataset.csv')])
+    cdb, = ConceptDB.objects.bulk_create([ConceptDB(name=f'{name}_cdb', cdb_file='cdb.dat')])
+    vocab, = Vocabulary.objects.bulk_create([Vocabulary(name=f'{name}_vocab', vocab_file='vocab.dat')])
+    project = ProjectAnnotateEntities.objects.create(name=name, dataset=dataset, concept_db=cdb, vocab=vocab, cuis='')
+    document = Document.objects.create(name=f'{name}_doc', text='', dataset=dataset)
+    return user, project, document
+
+
+def _sanitise_sequential(text):
+    # sanitise_input as it was, one re.sub per tag
+    for tag, repl in [('<br>', '\n'), ('</?p>', '\n'), ('<span(?:.*?)?>', ''), ('</span>', ''),
+                      ('<div (?:.*?)?>', '\n'), ('</div>', '\n'), ('</?html>', ''), ('</?body>', ''),
+                      ('</?head>', '')]:
+        text = re.sub(tag, repl, text)
+    return text
+
+
+class DatasetImportTestCase(TestCase):
+
+    def setUp(self):
+        self.media_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.media_dir.cleanup)
+
+    def _dataset(self, file_name, rows):
+        with open(os.path.join(self.media_dir.name, file_name), 'w') as f:
+            f.write('Name,Text\n' + ''.join(f'{name},{text}\n' for name, text in rows))
+        dataset, = Dataset.objects.bulk_create([Dataset(name=file_name, original_file=file_name)])
+        return dataset
+
+    def test_import_in_chunks(self):
+        rows = [(f'doc {i}', f'<p>text {i}</p>') for i in range(25)] + [('empty', '')]
+        with override_settings(MEDIA_ROOT=self.media_dir.name), \
+                patch.dict(os.environ, {'DATASET_IMPORT_CHUNK_SIZE': '10'}):
+            dataset = self._dataset('dataset.csv', rows)
+            with self.assertNumQueries(3 + 2):  # a bulk insert per chunk, within a savepoint
+                dataset_from_file(dataset)
+        docs = Document.objects.filter(dataset=dataset)
+        self.assertEqual([(d.name, d.text) for d in docs],
+                         [(f'doc {i}', f'\ntext {i}\n') for i in range(25)] + [('empty', '')])
+        self.assertEqual(docs.get(text_hash=Document.hash_text('\ntext 3\n')).name, 'doc 3')
+        document = docs.get(name='empty')
+        document.text = 'edited'
+        document.save()
+        self.assertEqual(docs.filter(text_hash=Document.hash_text('edited')).get(), document)
+
+    def test_duplicate_names_across_chunks(self):
+        with override_settings(MEDIA_ROOT=self.media_dir.name), \
+                patch.dict(os.environ, {'DATASET_IMPORT_CHUNK_SIZE': '2'}):
+            dataset = self._dataset('dataset.csv', [('a', 'x'), ('b', 'y'), ('a', 'z')])
+            with self.assertRaisesMessage(Exception, 'must be unique'):
+                dataset_from_file(dataset)
+        self.assertFalse(Document.objects.filter(dataset=dataset).exists())
+
+    def test_sanitise_matches_sequential_substitution(self):
+        rng = random.Random(0)
+        pieces = ['<', '>', '/', '\n', 'x', '<br>', '<p>', '</p>', '<span', '<span class="a">', '</span>', 'sp',
+                  'an>', '<div ', '<div id="b">', '</div>', '<html>', '</html>', 'ht', 'ml>', '<body>', '</head>']
+        texts = [''.join(rng.choice(pieces) for _ in range(rng.randint(0, 12))) for _ in range(20000)]
+        self.assertEqual([sanitise_input(t) for t in texts], [_sanitise_sequential(t) for t in texts])
+        self.assertEqual(list(sanitise_texts(pd.Series(texts))), [_sanitise_sequential(t) for t in texts])
+
+        # notes with some markup, as exported from EHRs
+        note = ('<div class="note"><p>Patient presented with <span class="hl">fever</span> and cough. ' +
+                'Observations stable, plan to review in clinic. ' * 40 + '</p><br></div>') * 5
+        notes = [note + str(i) for i in range(50)] + ['no markup', '', '<span unclosed']
+        expected = [_sanitise_sequential(n) for n in notes]
+        self.assertEqual([sanitise_input(n) for n in notes], expected)
+        self.assertEqual(list(sanitise_texts(pd.Series(notes))), expected)
+
+    @skipUnless(_RUN_BENCHMARKS, 'set MEDCAT_RUN_BENCHMARKS to run benchmarks')
+    def test_sanitise_benchmark(self):
+        rng = random.Random(0)
+        sentences = ['Patient presented with fever and cough.', 'Observations stable, plan to review in clinic.',
+                     'Chest x-ray showed no consolidation.', 'Started on oral antibiotics for 5 days.']
+
+        def note(markup):
+            paragraphs = [' '.join(rng.choice(sentences) for _ in range(rng.randint(5, 40)))
+                          for _ in range(rng.randint(1, 8))]
+            if markup == 'none':
+                return '\n'.join(paragraphs)
+            if markup == 'light':
+                return '<br>'.join(paragraphs)
+            return '<html><body><div class="note">' + ''.join(
+                f'<p><span class="hl">{p}</span></p><br>' for p in paragraphs) + '</div></body></html>'
+        # most notes have no markup, those exported from EHR letters have some to a lot
+        notes = [note(rng.choices(['none', 'light', 'heavy'], weights=[70, 20, 10])[0]) for _ in range(5000)]
+        self.assertEqual([sanitise_input(n) for n in notes], [_sanitise_sequential(n) for n in notes])
+        _benchmark('sanitise 5000 notes',
+                   sequential=lambda: [_sanitise_sequential(n) for n in notes],
+                   sanitise_input=lambda: [sanitise_input(n) for n in notes],
+                   sanitise_texts=lambda: sanitise_texts(pd.Series(notes)))
+
+
+class _Ent:
+    """Stand in for a spacy entity Span, as produced by the MedCAT pipeline."""
+
+    def __init__(self, start, end, cui, meta_anns=None):
+        self.start, self.end = start, end
+        self.start_char, self.end_char = start * 10, end * 10 - 1
+        self.text = f'ent {start}'
+        self._ = SimpleNamespace(cui=cui, context_similarity=0.9, meta_anns=meta_anns or {})
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+
+class AddAnnotationsTestCase(TestCase):
+
+    def setUp(self):
+        self.user, self.project, self.document = _create_project()
+        self.cat = SimpleNamespace(config=Config())
+        presence = MetaTask.objects.create(name='Presence')
+        presence.values.add(MetaTaskValue.objects.create(name='True'), MetaTaskValue.objects.create(name='False'))
+        Entity.objects.create(label='C0')
+
+    def _add(self, ents):
+        add_annotations(spacy_doc=SimpleNamespace(_=SimpleNamespace(ents=ents)), user=self.user, project=self.project,
+                        document=self.document, cat=self.cat,
+                        existing_annotations=AnnotatedEntity.objects.filter(document=self.document))
+
+    def test_queries_do_not_scale_with_entities(self):
+        meta_anns = {'Presence': {'value': 'True', 'confidence': 0.8}}
+        query_counts = []
+        for offset, n_ents in ((0, 3), (100, 30)):
+            ents = [_Ent(offset + i, offset + i + 1, f'C{i % 5}', meta_anns) for i in range(n_ents)]
+            with CaptureQueriesContext(connection) as queries:
+                self._add(ents)
+            query_counts.append(len(queries))
+        self.assertEqual(query_counts[0], query_counts[1])
+        self.assertEqual(AnnotatedEntity.objects.count(), 33)
+        self.assertEqual(MetaAnnotation.objects.count(), 33)
+        self.assertEqual(Entity.objects.count(), 5)
+
+    def test_skips_overlapping_and_existing_spans(self):
+        self._add([_Ent(0, 2, 'C1'), _Ent(1, 2, 'C2'), _Ent(3, 4, 'C3')])
+        self._add([_Ent(3, 4, 'C4')])
+        self.assertEqual(sorted(AnnotatedEntity.objects.values_list('start_ind', 'entity__label')),
+                         [(0, 'C1'), (30, 'C3')])
+
+    def test_interval_index_matches_linear_scan(self):
+        rng = random.Random(0)
+        intervals = [(start, start + rng.randint(0, 20)) for start in (rng.randint(0, 200) for _ in range(50))]
+        index = _IntervalIndex(intervals)
+        for point in range(-5, 230):
+            self.assertEqual(index.inside(point), any(s < point < e for s, e in intervals))
+
+    def test_remove_overlap(self):
+        self._add([_Ent(0, 2, 'C1'), _Ent(3, 4, 'C2'), _Ent(6, 8, 'C3')])
+        _remove_overlap(self.project, self.document, 25, 45)
+        self.assertEqual(list(AnnotatedEntity.objects.values_list('start_ind', flat=True)), [0, 60])
+
+
+class TrainingQueueTestCase(TestCase):
+
+    def test_jobs_run_in_order_and_coalesce(self):
+        trained, release = [], threading.Event()
+
+        def train(project_id, document_id):
+            release.wait()
+            trained.append(document_id)
+
+        project = SimpleNamespace(id=1, model_pack=SimpleNamespace(id=99))
+        with patch.object(training_queue, 'train_submitted_document', side_effect=train):
+            for doc_id in (1, 2, 3, 2):
+                training_queue.submit(project, SimpleNamespace(id=doc_id))
+            stats = training_queue.queue_stats()['mp99']
+            self.assertEqual((stats['depth'], stats['coalesced']), (3, 1))
+            release.set()
+            self.assertTrue(training_queue.wait_until_idle(project, timeout=5))
+        self.assertEqual(trained, [1, 2, 3])
+        self.assertEqual(training_queue.queue_stats()['mp99']['processed'], 3)
+
+    def test_save_is_queued_after_submitted_training(self):
+        done, release = [], threading.Event()
+
+        def train(project_id, document_id):
+            release.wait()
+            done.append(document_id)
+
+        project = SimpleNamespace(id=3, model_pack=SimpleNamespace(id=97))
+        self.assertFalse(training_queue.save(project))
+        model_cache.CAT_MAP.savers['mp97'] = None
+        try:
+            with patch.object(training_queue, 'train_submitted_document', side_effect=train), \
+                    patch.object(training_queue, 'save_model',
+                                 side_effect=lambda key: done.append(threading.current_thread().name)):
+                training_queue.submit(project, SimpleNamespace(id=1))
+                # returns without waiting on the training
+                self.assertTrue(training_queue.save(project))
+                self.assertEqual(done, [])
+                release.set()
+                self.assertTrue(training_queue.wait_until_idle(project, timeout=5))
+                for _ in range(50):
+                    if len(done) == 2:
+                        break
+                    time.sleep(0.1)
+        finally:
+            del model_cache.CAT_MAP.savers['mp97']
+        self.assertEqual(done, [1, 'medcat-trainer-mp97'])
+
+    def test_training_is_never_applied_to_an_evicted_model(self):
+        project = SimpleNamespace(id=4, model_pack=SimpleNamespace(id=95))
+        document = SimpleNamespace(id=1)
+        evicted, cached = object(), object()
+        model_cache.CAT_MAP.put('mp95', cached)
+        self.addCleanup(model_cache.CAT_MAP.clear)
+        trained = []
+        projects, documents = SimpleNamespace(get=lambda id: project), SimpleNamespace(get=lambda id: document)
+        with patch.object(training_queue, 'get_medcat', side_effect=[evicted, cached]), \
+                patch.object(training_queue, 'train_medcat', side_effect=lambda cat, p, d: trained.append(cat)), \
+                patch.object(training_queue.ProjectAnnotateEntities, 'objects', projects), \
+                patch.object(training_queue.Document, 'objects', documents):
+            training_queue.train_submitted_document(project.id, document.id)
+        self.assertEqual(trained, [cached])
+        self.assertEqual(model_cache.CAT_MAP.dirty['mp95'][0], 1)
+
+    def test_replay_resumes_from_checkpoint(self):
+        project = SimpleNamespace(id=2, model_pack=SimpleNamespace(id=98), train_model_on_submit=True,
+                                  validated_documents=SimpleNamespace(
+                                      all=lambda: [SimpleNamespace(id=d) for d in (1, 2, 3)]))
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'checkpoint.txt')
+        with open(checkpoint, 'w') as f:
+            f.write('2,1\n')
+
+        def submit_document(project, document, train_async=False, on_trained=None):
+            training_queue.submit(project, document, on_done=on_trained)
+
+        trained = []
+        with patch.object(training_queue, 'train_submitted_document', side_effect=lambda p, d: trained.append(d)), \
+                patch.object(training_queue.ProjectAnnotateEntities, 'objects',
+                             SimpleNamespace(filter=lambda **kwargs: [project])):
+            training_queue.replay_submissions(submit_document, checkpoint).join(5)
+            self.assertTrue(training_queue.wait_until_idle(project, timeout=5))
+        self.assertEqual(trained, [2, 3])
+        self.assertEqual(training_queue.REPLAY_STATS, {'state': 'complete', 'total': 3, 'done': 2, 'resumed': 1})
+        self.assertFalse(os.path.exists(checkpoint))
+
+
+def _create_export_project(name='export', n_docs=2):
+    """A project with validated documents, each with annotations, meta annotations and a relation."""
+    user, project, document = _create_project(name)
+    task = MetaTask.objects.create(name=f'{name}_task')
+    value = MetaTaskValue.objects.create(name=f'{name}_value')
+    task.values.add(value)
+    project.tasks.add(task)
+    relation = Relation.objects.create(label=f'{name}_relation')
+    project.relations.add(relation)
+    entity = Entity.objects.create(label=f'{name}_C1')
+    for i in range(n_docs):
+        doc = document if i == 0 else Document.objects.create(name=f'{name}_doc{i}', text='', dataset=project.dataset)
+        doc.text = f'kidney failure and fever {i}'
+        doc.save()
+        project.validated_documents.add(doc)
+        anns = [AnnotatedEntity.objects.create(user=user, project=project, document=doc, entity=entity, value=v,
+                                               start_ind=start, end_ind=start + len(v), acc=1, validated=True,
+                                               correct=True)
+                for v, start in (('kidney failure', 0), ('fever', 19))]
+        MetaAnnotation.objects.create(annotated_entity=anns[0], meta_task=task, meta_task_value=value)
+        EntityRelation.objects.create(user=user, project=project, document=doc, relation=relation,
+                                      start_entity=anns[0], end_entity=anns[1], validated=True)
+    return ProjectAnnotateEntities.objects.filter(id=project.id)
+
+
+class MetricsTestCase(TestCase):
+
+    def test_model_loaded_for_report_is_released(self):
+        project = _create_export_project('release', n_docs=1).get()
+        for was_cached in (False, True):
+            with tempfile.TemporaryDirectory() as media_root, \
+                    patch('api.metrics.MEDIA_ROOT', media_root), \
+                    patch('api.metrics.get_cached_medcat', return_value=object() if was_cached else None), \
+                    patch('api.metrics.get_medcat_view', return_value=SimpleNamespace()), \
+                    patch('api.metrics.clear_cached_medcat') as clear_cached_medcat, \
+                    patch.object(ProjectMetrics, 'generate_report', return_value={}):
+                calculate_metrics.now([project.id], f'release_{was_cached}')
+            # only evicted if loaded just for the report, not if cached by annotators / other tasks
+            self.assertEqual(clear_cached_medcat.called, not was_cached)
+
+    def test_enrich_medcat_metrics_in_one_query(self):
+        projects = _create_export_project('metrics', n_docs=3)
+        project = projects[0]
+        metrics = ProjectMetrics(retrieve_project_data(projects), None)
+        doc_ids = list(project.validated_documents.values_list('id', flat=True))
+        # the same span annotated twice is ambiguous, as AnnotatedEntity.objects.get raised for it
+        dup = AnnotatedEntity.objects.filter(document_id=doc_ids[2]).first()
+        dup.pk = None
+        dup.save()
+
+        def example(doc_id, start, end):
+            return {'project id': project.id, 'document id': doc_id, 'start': start, 'end': end}
+        examples = {'tp': {'metrics_C1': [example(doc_id, 0, 14) for doc_id in doc_ids]},
+                    'fp': {'metrics_C1': [example(doc_ids[0], 3, 9) for _ in range(1000)]},
+                    'fn': {'metrics_C1': [example(doc_ids[1], 19, 24)]}}
+        # as a dict join, rather than a query per example
+        with self.assertNumQueries(1):
+            metrics.enrich_medcat_metrics(examples)
+        self.assertEqual([ex['user'] for ex in examples['tp']['metrics_C1']], ['metrics_user', 'metrics_user', None])
+        self.assertEqual({ex['user'] for ex in examples['fp']['metrics_C1']}, {None})
+        self.assertEqual(examples['fn']['metrics_C1'][0]['user'], 'metrics_user')
+
+    @skipUnless(_RUN_BENCHMARKS, 'set MEDCAT_RUN_BENCHMARKS to run benchmarks')
+    def test_enrich_medcat_metrics_benchmark(self):
+        projects = _create_export_project('metrics', n_docs=50)
+        project = projects[0]
+        metrics = ProjectMetrics(retrieve_project_data(projects), None)
+        doc_ids = list(project.validated_documents.values_list('id', flat=True))
+
+        def examples():
+            # a report's worth of examples, each kind a mix of annotated and unannotated spans
+            return {kind: {'metrics_C1': [{'project id': project.id, 'document id': doc_id, 'start': start,
+                                           'end': start + 5} for doc_id in doc_ids for start in (0, 3, 19, 40)]}
+                    for kind in ('tp', 'fp', 'fn')}
+
+        def enrich_per_example(examples):
+            # enrich_medcat_metrics as it was, a query per example
+            for kind in ('tp', 'fp', 'fn'):
+                for ex in (i for e_i in examples[kind].values() for i in e_i):
+                    try:
+                        ann = AnnotatedEntity.objects.get(project_id=ex['project id'], document_id=ex['document id'],
+                                                          start_ind=ex['start'], end_ind=ex['end'])
+                        ex['user'] = ann.user.username
+                    except Exception:
+                        ex['user'] = None
+            return examples
+
+        self.assertEqual(metrics.enrich_medcat_metrics(examples()), enrich_per_example(examples()))
+        _benchmark(f'enrich {3 * 4 * len(doc_ids)} metrics examples',
+                   per_example=lambda: enrich_per_example(examples()),
+                   enrich_medcat_metrics=lambda: metrics.enrich_medcat_metrics(examples()))
+
+    def test_meta_anns_concept_summary(self):
+        rng = np.random.default_rng(0)
+        classes = ['Affirmed', 'Negated', 'Hypothetical']
+        n = 2000
+        truths = rng.choice(classes + [None], n)
+        preds = np.where(rng.random(n) < 0.7, truths, rng.choice(classes + ['Other'], n))
+        ann_df = pd.DataFrame({'cui': rng.choice([f'C{i}' for i in range(50)], n), 'validated': True,
+                               'deleted': False, 'killed': False, 'irrelevant': False, 'Presence': truths})
+        meta_model = SimpleNamespace(name='Presence')
+        # MetaCAT predictions, in order of the annotations with a value for the task
+        meta_results = {'meta_values': {c: i for i, c in enumerate(classes + ['Other'])},
+                        'predictions': [(classes + ['Other']).index(p) for p, t in zip(preds, truths) if t is not None]}
+        cat = SimpleNamespace(_meta_cats=[meta_model],
+                              get_model_card=lambda as_dict: {'MetaCAT models': [
+                                  {'Category Name': 'Presence', 'Classes': {c: i for i, c in enumerate(classes)}}]},
+                              cdb=SimpleNamespace(cui2preferred_name={f'C{i}': f'concept {i}' for i in range(50)}))
+        metrics = ProjectMetrics({'projects': []}, cat)
+        with patch.object(ProjectMetrics, 'annotation_df', return_value=ann_df), \
+                patch.object(ProjectMetrics, '_eval', return_value=meta_results):
+            meta_df = metrics.full_annotation_df()
+            summary = metrics.meta_anns_concept_summary(meta_df)
+
+        self.assertEqual(meta_df['predict_Presence'].fillna('-').tolist(),
+                         [p if t is not None else '-' for p, t in zip(preds, truths)])
+        expected = []
+        for cui in meta_df.cui.unique():
+            # per concept and class filtering, as these were computed before
+            concept_df = meta_df[meta_df['cui'] == cui]
+            class_metrics = {}
+            for meta_value in classes:
+                p, t = concept_df['predict_Presence'] == meta_value, concept_df['Presence'] == meta_value
+                tp, fp, fn = int((p & t).sum()), int((p & ~t).sum()), int((~p & t).sum())
+                class_metrics[meta_value] = {
+                    'total': int(t.sum()), 'f1': float(tp / (tp + 0.5 * (fp + fn)) if (tp + fp + fn) > 0 else 0),
+                    'prec': float(tp / (tp + fp) if (tp + fp) > 0 else 0),
+                    'rec': float(tp / (tp + fn) if (tp + fn) > 0 else 0)}
+            total = sum(m['total'] for m in class_metrics.values())
+            expected.append({'cui': cui, 'concept_name': cat.cdb.cui2preferred_name[cui], 'meta_tasks': {'Presence': {
+                'classes': class_metrics,
+                'macro': {k: float(sum(m[k] for m in class_metrics.values()) / 3) for k in ('f1', 'prec', 'rec')},
+                'micro': {k: float(sum(m[k] * m['total'] for m in class_metrics.values()) / total)
+                          for k in ('f1', 'prec', 'rec')}}}})
+        self.assertEqual(summary, expected)
+
+
+class ExportTestCase(TestCase):
+
+    def test_streamed_export_matches_project_data(self):
+        projects = _create_export_project()
+        expected = json.dumps(retrieve_project_data(projects))
+        streamed = b''.join(download_projects_with_text(projects).streaming_content).decode('utf-8')
+        self.assertEqual(streamed, expected)
+        gzipped = b''.join(download_projects_with_text(projects, gzip=True).streaming_content)
+        self.assertEqual(gzip.decompress(gzipped).decode('utf-8'), expected)
+
+    def test_streamed_export_without_text(self):
+        projects = _create_export_project()
+        response = download_projects_without_text(projects, with_doc_name=True)
+        out = json.loads(b''.join(response.streaming_content))
+        docs = out['projects'][0]['documents']
+        self.assertEqual(len(docs), 2)
+        self.assertNotIn('text', docs[0])
+        self.assertEqual(docs[0]['annotations'][0]['meta_anns']['export_task']['value'], 'export_value')
+        self.assertEqual(b''.join(download_projects_without_text(ProjectAnnotateEntities.objects.none(), False)
+                                  .streaming_content), b'{"projects": []}')
+
+    def test_export_queries_do_not_scale_with_documents(self):
+        counts = []
+        for n_docs in (1, 5):
+            projects = _create_export_project(f'export{n_docs}', n_docs)
+            with CaptureQueriesContext(connection) as ctx:
+                b''.join(download_projects_with_text(projects).streaming_content)
+                b''.join(download_projects_without_text(projects, with_doc_name=True).streaming_content)
+            counts.append(len(ctx.captured_queries))
+        self.assertEqual(counts[0], counts[1])
+        # per export: the project, plus per project its tasks, task values, relation defs, and per chunk of
+        # documents: the documents, annotations, meta annotations and relations
+        projects = ProjectAnnotateEntities.objects.filter(name='export5')
+        with self.assertNumQueries(8):
+            b''.join(download_projects_with_text(projects).streaming_content)
+
+    def test_incremental_export_since_cursor(self):
+        projects = _create_export_project('incremental', 3)
+        cursor = parse_datetime(download_projects_with_text(projects)['X-Export-Cursor'])
+        project = projects.get()
+        docs = list(project.validated_documents.order_by('id'))
+
+        changed = AnnotatedEntity.objects.filter(document=docs[0]).first()
+        changed.correct = False
+        changed.save()
+        deleted = AnnotatedEntity.objects.filter(document=docs[1]).last()
+        deleted_id, relation_id = deleted.id, EntityRelation.objects.get(document=docs[1]).id
+        # also deletes the relation to it
+        deleted.delete()
+        project.validated_documents.remove(docs[2])
+
+        out = json.loads(b''.join(download_projects_with_text(projects, since=cursor).streaming_content))
+        project_out = out['projects'][0]
+        self.assertEqual([d['id'] for d in project_out['documents']], [docs[0].id])
+        self.assertEqual({(t['type'], t['id']) for t in project_out['deleted']},
+                         {('annotation', deleted_id), ('relation', relation_id), ('document', docs[2].id)})
+
+    def test_bulk_deletes_are_tombstoned_in_constant_queries(self):
+        counts = []
+        for n_docs in (1, 5):
+            project = _create_export_project(f'delete{n_docs}', n_docs).get()
+            with CaptureQueriesContext(connection) as ctx:
+                _delete_annotations(AnnotatedEntity.objects.filter(project=project))
+            counts.append(len(ctx.captured_queries))
+            tombstones = ExportTombstone.objects.filter(project_id=project.id)
+            self.assertEqual(tombstones.filter(object_type='annotation').count(), 2 * n_docs)
+            self.assertEqual(tombstones.filter(object_type='relation').count(), n_docs)
+        self.assertEqual(counts[0], counts[1])
+
+    @patch('api.models._TOMBSTONE_RETENTION_DAYS', 30)
+    def test_old_tombstones_are_pruned(self):
+        project = _create_export_project('prune', 1).get()
+        old = ExportTombstone.objects.create(project_id=project.id, document_id=0, object_type='annotation',
+                                             object_id=0)
+        ExportTombstone.objects.filter(id=old.id).update(deleted_at=timezone.now() - timedelta(days=31))
+        AnnotatedEntity.objects.filter(project=project).first().delete()
+        self.assertFalse(ExportTombstone.objects.filter(id=old.id).exists())
+        self.assertTrue(ExportTombstone.objects.filter(project_id=project.id, object_type='annotation').exists())
+
+    def test_columnar_export(self):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        projects = _create_export_project('columnar', 2)
+        response = download_projects_columnar(projects)
+        with zipfile.ZipFile(io.BytesIO(b''.join(response.streaming_content))) as zf:
+            tables = {name.split('.')[0]: pq.read_table(zf.open(name)) for name in zf.namelist()}
+        self.assertEqual(tables['documents'].num_rows, 2)
+        self.assertEqual(tables['annotations'].num_rows, 4)
+        self.assertEqual(tables['annotations'].schema.field('cui').type, pa.dictionary(pa.int32(), pa.string()))
+        self.assertEqual(tables['annotations'].column('cui').to_pylist(), ['columnar_C1'] * 4)
+        self.assertEqual(tables['meta_annotations'].column('value').to_pylist(), ['columnar_value'] * 2)
+        self.assertEqual(tables['relations'].num_rows, 2)
+
+    def test_uploaded_export_and_status_are_removed(self):
+        projects = _create_export_project('upload', n_docs=1)
+        export = retrieve_project_data(projects)
+        client = APIClient()
+        client.force_authenticate(User.objects.create_superuser('upload_admin', password='upload_admin'))
+        with tempfile.TemporaryDirectory() as media_dir, override_settings(MEDIA_ROOT=media_dir), \
+                patch('api.views.MEDIA_ROOT', media_dir), patch('api.data_utils.MEDIA_ROOT', media_dir):
+            response = client.post(f'/api/upload-deployment/?cdb_id={projects[0].concept_db_id}'
+                                   f'&vocab_id={projects[0].vocab_id}', export, format='json')
+            # run as the background task runner would, its async runner needs the task committed
+            task = Task.objects.get(id=response.data['bg_job_id'])
+            args, kwargs = task.params()
+            import_projects_export.now(*args, **kwargs)
+            task.create_completed_task()
+            task.delete()
+            # the uploaded copy of the export, holding document text, is removed once imported
+            self.assertFalse(os.path.exists(os.path.join(media_dir, response.data['export'])))
+
+            imports = client.get('/api/upload-deployment/').data['imports']
+            self.assertEqual([(i['export'], i['state']) for i in imports], [(response.data['export'], 'complete')])
+            # reported once, then its status is removed
+            self.assertEqual(client.get('/api/upload-deployment/').data['imports'], [])
+            self.assertEqual([f for f in os.listdir(media_dir) if f.startswith('deployment_upload')], [])
+
+    def test_import_export_in_background(self):
+        projects = _create_export_project('import', n_docs=3)
+        export = retrieve_project_data(projects)
+        # annotations by a user not in this deployment fail the import of their document only
+        export['projects'][0]['documents'][1]['annotations'][0]['user'] = 'unknown'
+        with tempfile.TemporaryDirectory() as media_dir, override_settings(MEDIA_ROOT=media_dir), \
+                patch('api.data_utils.MEDIA_ROOT', media_dir), \
+                patch.dict(os.environ, {'DATASET_IMPORT_CHUNK_SIZE': '1'}):
+            export_path = os.path.join(media_dir, 'export.json')
+            with open(export_path, 'w') as f:
+                json.dump(export, f)
+            import_projects_export.now(export_path, projects[0].concept_db_id, projects[0].vocab_id)
+            status = import_status(export_path)
+
+        self.assertEqual(status['state'], 'complete')
+        self.assertEqual((status['documents_done'], status['annotations'], status['relations']), (3, 4, 2))
+        self.assertEqual([e['documents'] for e in status['errors']], [['import_doc1']])
+        imported = ProjectAnnotateEntities.objects.get(name='import IMPORTED')
+        self.assertEqual(imported.validated_documents.count(), 3)
+        rels = EntityRelation.objects.filter(project=imported)
+        self.assertEqual([(r.start_entity.value, r.end_entity.value) for r in rels], [('kidney failure', 'fever')] * 2)
+        meta_anns = MetaAnnotation.objects.filter(annotated_entity__project=imported)
+        self.assertEqual([(m.meta_task.name, m.meta_task_value.name) for m in meta_anns],
+                         [('import_task', 'import_value')] * 2)
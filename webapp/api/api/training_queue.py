@@ -0,0 +1,279 @@
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional
+
+from django.db import close_old_connections, connection
+
+from core.settings import MEDIA_ROOT
+
+from .model_cache import CAT_MAP, get_medcat, model_id, model_lock, mark_trained, checkpoint_due, secs_to_checkpoint, \
+    save_model
+from .models import ProjectAnnotateEntities, Document
+from .utils import train_medcat
+
+"""
+Queue of documents to train a project model on, once submitted. Each model has a single trainer thread,
+applying submissions in order, so submitting a document returns immediately and training on the shared,
+cached, CAT is never concurrent. The trainer thread also saves its model once due, see
+model_cache.checkpoint_due, or once requested by save. Training, and saving, hold model_cache.model_lock.
+"""
+
+logger = logging.getLogger(__name__)
+
+ASYNC_TRAINING = os.getenv('MEDCAT_ASYNC_TRAINING', '1').lower() in ('1', 'y', 'true')
+
+
+def train_submitted_document(project_id: int, document_id: int):
+    project = ProjectAnnotateEntities.objects.get(id=project_id)
+    document = Document.objects.get(id=document_id)
+    try:
+        while True:
+            cat = get_medcat(project=project)
+            with model_lock(model_id(project)):
+                # flagged before training, so evicting the model meanwhile saves it once trained. If already
+                # evicted since fetched, training it would be lost, so fetch the model again.
+                if not mark_trained(model_id(project), cat=cat):
+                    continue
+                train_medcat(cat, project, document)
+                break
+    except Exception as e:
+        logger.error('Failed to train model of project %s on document %s: %s', project_id, document_id, e)
+        raise
+    if not ASYNC_TRAINING:
+        _checkpoint(model_id(project))
+
+
+def _checkpoint(model: str, force: bool = False):
+    if force or checkpoint_due(model):
+        try:
+            if not save_model(model):
+                logger.warning('Trained model %s cannot be saved, its model pack has not been unpacked', model)
+        except Exception as e:
+            logger.error('Failed to save trained model %s: %s', model, e)
+
+
+class _Trainer:
+    """Trains one model on submitted documents, in order of first submission, on its own thread."""
+
+    def __init__(self, model: str):
+        self.model = model
+        # (project id, document id) -> (time first submitted, callbacks for once trained). Submitting a queued
+        # document again coalesces into the one job, as training reads the documents annotations when it runs.
+        self.jobs: Dict[tuple, tuple] = OrderedDict()
+        self.running: Optional[tuple] = None
+        self.processed = 0
+        self.failed = 0
+        self.coalesced = 0
+        self.last_lag = 0.0
+        # save the model once the jobs submitted before the request have run
+        self.save_requested = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._run, name=f'medcat-trainer-{model}', daemon=True)
+        self.thread.start()
+
+    def submit(self, project_id: int, document_id: int, on_done: Callable = None):
+        with self.cond:
+            if (project_id, document_id) in self.jobs:
+                self.coalesced += 1
+            else:
+                self.jobs[(project_id, document_id)] = (time.time(), [])
+            if on_done is not None:
+                self.jobs[(project_id, document_id)][1].append(on_done)
+            self.cond.notify_all()
+
+    def request_save(self):
+        with self.cond:
+            self.save_requested = True
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.jobs and not self.save_requested and not checkpoint_due(self.model):
+                    self.cond.wait(secs_to_checkpoint(self.model))
+                if not self.jobs:
+                    job = None
+                    save, self.save_requested = self.save_requested, False
+                else:
+                    job, (submitted, callbacks) = self.jobs.popitem(last=False)
+                    self.running = job
+            if job is None:
+                _checkpoint(self.model, force=save)
+                continue
+            close_old_connections()
+            try:
+                train_submitted_document(*job)
+            except Exception:
+                self.failed += 1
+            finally:
+                for callback in callbacks:
+                    callback()
+                with self.cond:
+                    self.running = None
+                    self.processed += 1
+                    self.last_lag = time.time() - submitted
+                    self.cond.notify_all()
+            _checkpoint(self.model)
+
+    def wait_until_idle(self, timeout: float = None) -> bool:
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.jobs and self.running is None, timeout)
+
+    def stats(self) -> Dict:
+        with self.cond:
+            oldest = next(iter(self.jobs.values()), None)
+            return {
+                'depth': len(self.jobs) + (self.running is not None),
+                'running': self.running is not None,
+                'lag_secs': round(time.time() - oldest[0], 3) if oldest is not None else 0.0,
+                'last_lag_secs': round(self.last_lag, 3),
+                'processed': self.processed,
+                'failed': self.failed,
+                'coalesced': self.coalesced,
+            }
+
+
+_trainers: Dict[str, _Trainer] = {}
+_trainers_lock = threading.Lock()
+
+
+def _trainer(project) -> _Trainer:
+    model = model_id(project)
+    with _trainers_lock:
+        if model not in _trainers:
+            _trainers[model] = _Trainer(model)
+        return _trainers[model]
+
+
+def submit(project, document, on_done: Callable = None):
+    """
+    Queue training the model of project on document.
+    :param on_done: called once training on document has finished, or failed
+    """
+    _trainer(project).submit(project.id, document.id, on_done)
+
+
+def model_trained(project):
+    """Flag the model of project as trained outside of the queue, i.e. by adding a concept, so it is saved once due."""
+    mark_trained(model_id(project))
+    if ASYNC_TRAINING:
+        # the trainer thread saves the model, so never while it trains it
+        trainer = _trainer(project)
+        with trainer.cond:
+            trainer.cond.notify_all()
+    else:
+        _checkpoint(model_id(project))
+
+
+def save(project):
+    """
+    Save the model of project, including its queued training. With ASYNC_TRAINING this is queued, returning
+    immediately, for the trainer thread to save once the documents already submitted are trained.
+    :return: False if the model cannot be saved, i.e. its model pack has not been unpacked
+    """
+    if ASYNC_TRAINING:
+        if model_id(project) not in CAT_MAP.savers:
+            return False
+        _trainer(project).request_save()
+        return True
+    return save_model(model_id(project))
+
+
+def wait_until_idle(project, timeout: float = None) -> bool:
+    """Wait for queued training of the model of project to finish, returning False on timeout."""
+    model = model_id(project)
+    trainer = _trainers.get(model)
+    return trainer is None or trainer.wait_until_idle(timeout)
+
+
+def queue_stats() -> Dict[str, Dict]:
+    """Depth, lag and counts of the training queue of each model."""
+    return {model: trainer.stats() for model, trainer in list(_trainers.items())}
+
+
+# progress of the replay of submitted documents on startup, see replay_submissions
+REPLAY_STATS = {'state': 'idle', 'total': 0, 'done': 0, 'resumed': 0}
+_REPLAY_CHECKPOINT = os.path.join(MEDIA_ROOT, 'resubmit_all_checkpoint.txt')
+
+
+def replay_submissions(submit_document: Callable, checkpoint_path: str = _REPLAY_CHECKPOINT) -> threading.Thread:
+    """
+    Re-submit, in a background thread, every validated document of every annotating project, i.e. for
+    RESUBMIT_ALL_ON_STARTUP. Training goes through the queue of each model, so differing models train in parallel.
+
+    Each trained document is appended to a checkpoint file, so a restart part way through resumes the replay
+    rather than starting over. The file is removed once every document has been trained.
+    :param submit_document: views._submit_document
+    :param checkpoint_path: the checkpoint file
+    :return: the started thread
+    """
+    def _replay():
+        try:
+            done = set()
+            if os.path.exists(checkpoint_path):
+                with open(checkpoint_path) as f:
+                    done = {tuple(int(i) for i in line.split(',')) for line in f if line.strip()}
+                logger.info('Resuming replay of submitted documents, %s already trained', len(done))
+
+            jobs = [(project, doc) for project in ProjectAnnotateEntities.objects.filter(project_status='A')
+                    for doc in project.validated_documents.all()]
+            REPLAY_STATS.update(state='running', total=len(jobs), done=0, resumed=0)
+            remaining = len(jobs)
+            all_queued = False
+            lock = threading.Lock()
+            checkpoint = open(checkpoint_path, 'a')
+
+            def trained(project_id: int, doc_id: int):
+                nonlocal remaining
+                with lock:
+                    if (project_id, doc_id) in done:
+                        return
+                    done.add((project_id, doc_id))
+                    checkpoint.write(f'{project_id},{doc_id}\n')
+                    checkpoint.flush()
+                    REPLAY_STATS['done'] += 1
+                    remaining -= 1
+                    finished = all_queued and remaining == 0
+                if finished:
+                    _replay_finished(checkpoint, checkpoint_path)
+
+            for project, doc in jobs:
+                if (project.id, doc.id) in done:
+                    with lock:
+                        REPLAY_STATS['resumed'] += 1
+                        remaining -= 1
+                    continue
+                try:
+                    if project.train_model_on_submit:
+                        submit_document(project, doc, train_async=True,
+                                        on_trained=lambda p=project.id, d=doc.id: trained(p, d))
+                    else:
+                        submit_document(project, doc)
+                        trained(project.id, doc.id)
+                except Exception as e:
+                    logger.error('Failed to re-submit document %s of project %s: %s', doc.id, project.id, e)
+                    trained(project.id, doc.id)
+            with lock:
+                all_queued = True
+                finished = remaining == 0
+            if finished:
+                _replay_finished(checkpoint, checkpoint_path)
+        except Exception as e:
+            REPLAY_STATS['state'] = 'failed'
+            logger.error('Failed to replay submitted documents: %s', e)
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=_replay, name='medcat-resubmit-all', daemon=True)
+    thread.start()
+    return thread
+
+
+def _replay_finished(checkpoint, checkpoint_path: str):
+    checkpoint.close()
+    os.remove(checkpoint_path)
+    REPLAY_STATS['state'] = 'complete'
+    logger.info('Finished replaying %s submitted documents', REPLAY_STATS['total'])
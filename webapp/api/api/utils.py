@@ -1,54 +1,82 @@
+import bisect
+import itertools
 import json
 import logging
 import os
-from typing import List
+from typing import Iterable, List, Tuple
 
 from background_task import background
 from django.contrib.auth.models import User
 from django.db import transaction
+from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from medcat.cat import CAT
-from medcat.utils.filters import check_filters
 from medcat.utils.helpers import tkns_from_doc
-from medcat.utils.ner.deid import DeIdModel
 
+from . import doc_cache
+from .batch_inference import annotate_documents
+from .medcat_utils import cui_filter
 from .model_cache import get_medcat
 from .models import Entity, AnnotatedEntity, ProjectAnnotateEntities, \
-    MetaAnnotation, MetaTask, Document
+    MetaAnnotation, MetaTask, Document, ExportTombstone
 
 logger = logging.getLogger('trainer')
 
 
+def _delete_annotations(annotations):
+    # a single delete query per table, so tombstoned here rather than per deleted row
+    with transaction.atomic():
+        ExportTombstone.annotations_deleted(annotations)
+        _, deleted = annotations.delete()
+    return deleted
+
+
 def remove_annotations(document, project, partial=False):
     try:
         if partial:
             # Removes only the ones that are not validated
-            AnnotatedEntity.objects.filter(project=project,
-                                           document=document,
-                                           validated=False).delete()
+            _delete_annotations(AnnotatedEntity.objects.filter(project=project,
+                                                               document=document,
+                                                               validated=False))
             logger.debug(f"Unvalidated Annotations removed for:{document.id}")
         else:
             # Removes everything
-            AnnotatedEntity.objects.filter(project=project, document=document).delete()
+            _delete_annotations(AnnotatedEntity.objects.filter(project=project, document=document))
             logger.debug(f"All Annotations removed for:{document.id}")
     except Exception as e:
         logger.debug(f"Something went wrong: {e}")
 
 
+class _IntervalIndex:
+    """Sorted index of (start, end) intervals, answering if a point is strictly inside any of them in O(log n)."""
+
+    def __init__(self, intervals: Iterable[Tuple[int, int]]):
+        intervals = sorted(intervals)
+        self.starts = [start for start, _ in intervals]
+        # max end of the intervals up to, and including, each index
+        self.max_ends = list(itertools.accumulate((end for _, end in intervals), max))
+
+    def inside(self, point: int) -> bool:
+        # of the intervals starting before point, does the one ending last end after it
+        n_before = bisect.bisect_left(self.starts, point)
+        return n_before > 0 and self.max_ends[n_before - 1] > point
+
+
 def add_annotations(spacy_doc, user, project, document, existing_annotations, cat):
     spacy_doc._.ents.sort(key=lambda x: len(x.text), reverse=True)
 
-    tkns_in = []
     ents = []
-    existing_annos_intervals = [(ann.start_ind, ann.end_ind) for ann in existing_annotations]
+    existing_annos_intervals = _IntervalIndex((ann.start_ind, ann.end_ind) for ann in existing_annotations)
     # all MetaTasks and associated values
     # that can be produced are expected to have available models
     try:
-        metatask2obj = {task_name: MetaTask.objects.get(name=task_name)
-                        for task_name in spacy_doc._.ents[0]._.meta_anns.keys()}
-        metataskvals2obj = {task_name: {v.name: v for v in MetaTask.objects.get(name=task_name).values.all()}
-                            for task_name in spacy_doc._.ents[0]._.meta_anns.keys()}
+        task_names = set(spacy_doc._.ents[0]._.meta_anns.keys())
+        metatask2obj = {t.name: t for t in MetaTask.objects.filter(name__in=task_names).prefetch_related('values')}
+        if len(metatask2obj) != len(task_names):
+            raise MetaTask.DoesNotExist(f'MetaTask(s) {task_names - set(metatask2obj)} do not exist')
+        metataskvals2obj = {task_name: {v.name: v for v in task.values.all()}
+                            for task_name, task in metatask2obj.items()}
     except (AttributeError, IndexError):
         # IndexError: ignore if there are no annotations in this doc
         # AttributeError: ignore meta_anns that are not present - i.e. non model pack preds
@@ -58,69 +86,74 @@ def add_annotations(spacy_doc, user, project, document, existing_annotations, ca
         pass
 
     def check_ents(ent):
-        return any((ea[0] < ent.start_char < ea[1]) or
-                   (ea[0] < ent.end_char < ea[1]) for ea in existing_annos_intervals)
+        return existing_annos_intervals.inside(ent.start_char) or existing_annos_intervals.inside(ent.end_char)
 
+    # token indices of the ents added so far, ents are (longest first) added if none of their tokens are taken.
+    tkns_in = bytearray(max((ent.end for ent in spacy_doc._.ents), default=0))
     for ent in spacy_doc._.ents:
-        if not check_ents(ent) and check_filters(ent._.cui, cat.config.linking['filters']):
-            to_add = True
-            for tkn in ent:
-                if tkn in tkns_in:
-                    to_add = False
-            if to_add:
-                for tkn in ent:
-                    tkns_in.append(tkn)
+        if not check_ents(ent) and cat.config.linking.filters.check_filters(ent._.cui):
+            if not any(tkns_in[ent.start:ent.end]):
+                tkns_in[ent.start:ent.end] = b'\x01' * (ent.end - ent.start)
                 ents.append(ent)
 
     logger.debug('Found %s annotations to store', len(ents))
+    if not ents:
+        return
+
+    # fetch, or create, all the Entities needed in one go
+    labels = {ent._.cui for ent in ents}
+    label2entity = Entity.objects.in_bulk(labels, field_name='label')
+    missing_labels = labels - set(label2entity)
+    if missing_labels:
+        Entity.objects.bulk_create([Entity(label=label) for label in missing_labels], ignore_conflicts=True)
+        label2entity.update(Entity.objects.in_bulk(missing_labels, field_name='label'))
+
+    existing_spans = set(AnnotatedEntity.objects.filter(project=project, document=document)
+                         .values_list('start_ind', 'end_ind'))
+    MIN_ACC = cat.config.linking.get('similarity_threshold_trainer', 0.2)
+    new_anns, new_ann_ents = [], []
     for ent in ents:
-        logger.debug('Processing annotation ent %s of %s', ents.index(ent), len(ents))
-        label = ent._.cui
-
-        if not Entity.objects.filter(label=label).exists():
-            # Create the entity
-            entity = Entity()
-            entity.label = label
-            entity.save()
-        else:
-            entity = Entity.objects.get(label=label)
-
-        ann_ent = AnnotatedEntity.objects.filter(project=project,
-                                                  document=document,
-                                                  start_ind=ent.start_char,
-                                                  end_ind=ent.end_char).first()
-        if ann_ent is None:
-            # If this entity doesn't exist already
-            ann_ent = AnnotatedEntity()
-            ann_ent.user = user
-            ann_ent.project = project
-            ann_ent.document = document
-            ann_ent.entity = entity
-            ann_ent.value = ent.text
-            ann_ent.start_ind = ent.start_char
-            ann_ent.end_ind = ent.end_char
-            ann_ent.acc = ent._.context_similarity
-
-            MIN_ACC = cat.config.linking.get('similarity_threshold_trainer', 0.2)
-            if ent._.context_similarity < MIN_ACC:
-                ann_ent.deleted = True
-                ann_ent.validated = True
-
-            ann_ent.save()
-
-            # check the ent._.meta_anns if it exists
-            if hasattr(ent._, 'meta_anns') and len(metatask2obj) > 0 and len(metataskvals2obj) > 0:
-                logger.debug('Found %s meta annos on ent', len(ent._.meta_anns.items()))
-                for meta_ann_task, pred in ent._.meta_anns.items():
-                    meta_anno_obj = MetaAnnotation()
-                    meta_anno_obj.predicted_meta_task_value = metataskvals2obj[meta_ann_task][pred['value']]
-                    meta_anno_obj.meta_task = metatask2obj[meta_ann_task]
-                    meta_anno_obj.annotated_entity = ann_ent
-                    meta_anno_obj.meta_task_value = metataskvals2obj[meta_ann_task][pred['value']]
-                    meta_anno_obj.acc = pred['confidence']
-                    meta_anno_obj.save()
-                    logger.debug('Successfully saved %s', meta_anno_obj)
-
+        # If this entity doesn't exist already
+        if (ent.start_char, ent.end_char) in existing_spans:
+            continue
+        existing_spans.add((ent.start_char, ent.end_char))
+        ann_ent = AnnotatedEntity()
+        ann_ent.user = user
+        ann_ent.project = project
+        ann_ent.document = document
+        ann_ent.entity = label2entity[ent._.cui]
+        ann_ent.value = ent.text
+        ann_ent.start_ind = ent.start_char
+        ann_ent.end_ind = ent.end_char
+        ann_ent.acc = ent._.context_similarity
+
+        if ent._.context_similarity < MIN_ACC:
+            ann_ent.deleted = True
+            ann_ent.validated = True
+        new_anns.append(ann_ent)
+        new_ann_ents.append(ent)
+    AnnotatedEntity.objects.bulk_create(new_anns)
+
+    meta_annos = []
+    # check the ent._.meta_anns if it exists
+    if len(metatask2obj) > 0 and len(metataskvals2obj) > 0:
+        for ann_ent, ent in zip(new_anns, new_ann_ents):
+            if not hasattr(ent._, 'meta_anns'):
+                continue
+            for meta_ann_task, pred in ent._.meta_anns.items():
+                meta_anno_obj = MetaAnnotation()
+                meta_anno_obj.predicted_meta_task_value = metataskvals2obj[meta_ann_task][pred['value']]
+                meta_anno_obj.meta_task = metatask2obj[meta_ann_task]
+                meta_anno_obj.annotated_entity = ann_ent
+                meta_anno_obj.meta_task_value = metataskvals2obj[meta_ann_task][pred['value']]
+                meta_anno_obj.acc = pred['confidence']
+                meta_annos.append(meta_anno_obj)
+        MetaAnnotation.objects.bulk_create(meta_annos)
+    logger.debug('Saved %s annotations, %s meta annotations', len(new_anns), len(meta_annos))
+
+    # bulk_create skips AnnotatedEntity.save, that updates the project last_modified
+    if new_anns:
+        project.save()
 
 
 def get_create_cdb_infos(cdb, concept, cui, cui_info_prop, code_prop, desc_prop, model_clazz):
@@ -141,12 +174,10 @@ def get_create_cdb_infos(cdb, concept, cui, cui_info_prop, code_prop, desc_prop,
 
 
 def _remove_overlap(project, document, start, end):
-    anns = AnnotatedEntity.objects.filter(project=project, document=document)
-
-    for ann in anns:
-        if (start <= ann.start_ind <= end) or (start <= ann.end_ind <= end):
-            logger.debug("Removed %s ", str(ann))
-            ann.delete()
+    overlapping = AnnotatedEntity.objects.filter(project=project, document=document)\
+        .filter(Q(start_ind__gte=start, start_ind__lte=end) | Q(end_ind__gte=start, end_ind__lte=end))
+    deleted = _delete_annotations(overlapping)
+    logger.debug("Removed %s overlapping annotations", deleted.get(AnnotatedEntity._meta.label, 0))
 
 
 def create_annotation(source_val: str, selection_occurrence_index: int, cui: str, user: User,
@@ -200,9 +231,10 @@ def train_medcat(cat, project, document):
     # Get all annotations
     anns = AnnotatedEntity.objects.filter(project=project, document=document, validated=True, killed=False)
     text = document.text
-    spacy_doc = cat(text)
 
     if len(anns) > 0 and text is not None and len(text) > 5:
+        # the Doc from preparing the document, if the model has not changed too much since
+        spacy_doc = doc_cache.get_or_run(cat, document)
         for ann in anns:
             cui = ann.entity.label
             # Indices for this annotation
@@ -220,6 +252,7 @@ def train_medcat(cat, project, document):
                           spacy_entity=spacy_entity,
                           negative=ann.deleted,
                           devalue_others=manually_created)
+        doc_cache.model_trained(cat)
 
     # Completely remove concept names that the user killed
     killed_anns = AnnotatedEntity.objects.filter(project=project, document=document, killed=True)
@@ -241,31 +274,29 @@ def train_medcat(cat, project, document):
 def prep_docs(project_id: List[int], doc_ids: List[int], user_id: int):
     user = User.objects.get(id=user_id)
     project = ProjectAnnotateEntities.objects.get(id=project_id)
-    docs = Document.objects.filter(id__in=doc_ids)
+    docs = list(Document.objects.filter(id__in=doc_ids))
 
     logger.info('Loading CAT object in bg process for project: %s', project.id)
     cat = get_medcat(project=project)
 
-    # Set CAT filters
-    cat.config.linking['filters']['cuis'] = project.cuis
-
-    for doc in docs:
-        logger.info(f'Running MedCAT model for project {project.id}:{project.name} over doc: {doc.id}')
-        if not project.deid_model_annotation:
-            spacy_doc = cat(doc.text)
-        else:
-            deid = DeIdModel(cat)
-            spacy_doc = deid(doc.text)
-        anns = AnnotatedEntity.objects.filter(document=doc).filter(project=project)
-        with transaction.atomic():
-            add_annotations(spacy_doc=spacy_doc,
-                            user=user,
-                            project=project,
-                            document=doc,
-                            cat=cat,
-                            existing_annotations=anns)
-            # add doc to prepared_documents
-        project.prepared_documents.add(doc)
+    # Restrict linking to the project CUIs, for this task only
+    cuis = {cui.strip() for cui in project.cuis.split(',') if cui.strip()} if project.cuis else set()
+    if project.cuis_file:
+        cuis.update(json.load(open(project.cuis_file.path)))
+
+    with cui_filter(cat, cuis):
+        for doc, spacy_doc in zip(docs, annotate_documents(cat, docs)):
+            logger.debug(f'Ran MedCAT model for project {project.id}:{project.name} over doc: {doc.id}')
+            anns = AnnotatedEntity.objects.filter(document=doc).filter(project=project)
+            with transaction.atomic():
+                add_annotations(spacy_doc=spacy_doc,
+                                user=user,
+                                project=project,
+                                document=doc,
+                                cat=cat,
+                                existing_annotations=anns)
+                # add doc to prepared_documents
+            project.prepared_documents.add(doc)
     project.save()
     logger.info('Prepared all docs for project: %s, docs processed: %s',
                 project.id, project.prepared_documents)
@@ -9,23 +9,26 @@ from django.db import transaction
 from django.http import HttpResponseBadRequest, HttpResponseServerError, HttpResponse
 from django.shortcuts import render
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django_filters import rest_framework as drf
 from medcat.utils.helpers import tkns_from_doc
 from rest_framework import viewsets
 from rest_framework.decorators import api_view
 from rest_framework.response import Response
-from medcat.utils.ner.deid import DeIdModel
 
-from .admin import download_projects_with_text, download_projects_without_text, \
-    import_concepts_from_cdb
-from .data_utils import upload_projects_export
-from .medcat_utils import ch2pt_from_pt2ch, get_all_ch, dedupe_preserve_order, snomed_ct_concept_path
+from . import doc_cache, training_queue
+from .admin import download_projects_with_text, download_projects_without_text, download_projects_columnar, \
+    accepts_gzip, import_concepts_from_cdb
+from .batch_inference import annotate_documents
+from .data_utils import import_projects_export, import_status, remove_import_status
+from .medcat_utils import ch2pt_from_pt2ch, get_all_ch, dedupe_preserve_order, snomed_ct_concept_path, cui_filter
 from .metrics import calculate_metrics
-from .model_cache import get_medcat, get_cached_cdb, VOCAB_MAP, clear_cached_medcat, CAT_MAP, CDB_MAP, is_model_loaded
+from .model_cache import get_medcat, get_cached_cdb, clear_cached_medcat, CAT_MAP, CDB_MAP, is_model_loaded, \
+    get_load_state, preload_models, model_id, model_lock, LOAD_STATS
 from .permissions import *
 from .serializers import *
 from .solr_utils import collections_available, search_collection, ensure_concept_searchable
-from .utils import add_annotations, remove_annotations, train_medcat, create_annotation, prep_docs
+from .utils import add_annotations, remove_annotations, create_annotation, prep_docs
 
 # For local testing, put envs
 """
@@ -260,6 +263,7 @@ def prepare_documents(request):
                                                   'but is still set on the project. To fix remove and reset the '
                                                   'cui filter file' % project.cuis_file}, status=500)
     try:
+        docs_to_annotate = []
         for d_id in d_ids:
             document = Document.objects.get(id=d_id)
             if force:
@@ -274,34 +278,33 @@ def prepare_documents(request):
 
             is_validated = document in project.validated_documents.all()
 
-            with transaction.atomic():
-                # If the document is not already annotated, annotate it
-                if (len(anns) == 0 and not is_validated) or update:
-                    # Based on the project id get the right medcat
-                    cat = get_medcat(project=project)
-                    logger.info('loaded medcat model for project: %s', project.id)
-
-                    # Set CAT filters
-                    cat.config.linking['filters']['cuis'] = cuis
-
-                    if not project.deid_model_annotation:
-                        spacy_doc = cat(document.text)
-                    else:
-                        deid = DeIdModel(cat)
-                        spacy_doc = deid(document.text)
-
-                    spacy_doc = cat(document.text)
-
-                    add_annotations(spacy_doc=spacy_doc,
-                                    user=user,
-                                    project=project,
-                                    document=document,
-                                    cat=cat,
-                                    existing_annotations=anns)
-
+            # If the document is not already annotated, annotate it
+            if (len(anns) == 0 and not is_validated) or update:
+                docs_to_annotate.append(document)
+            else:
                 # add doc to prepared_documents
                 project.prepared_documents.add(document)
-                project.save()
+
+        if docs_to_annotate:
+            # Based on the project id get the right medcat
+            cat = get_medcat(project=project)
+            logger.info('loaded medcat model for project: %s', project.id)
+
+            # Restrict linking to the project CUIs, for this request only
+            with cui_filter(cat, cuis):
+                spacy_docs = annotate_documents(cat, docs_to_annotate)
+                for document, spacy_doc in zip(docs_to_annotate, spacy_docs):
+                    with transaction.atomic():
+                        anns = AnnotatedEntity.objects.filter(document=document).filter(project=project)
+                        add_annotations(spacy_doc=spacy_doc,
+                                        user=user,
+                                        project=project,
+                                        document=document,
+                                        cat=cat,
+                                        existing_annotations=anns)
+                        # add doc to prepared_documents
+                        project.prepared_documents.add(document)
+        project.save()
 
     except Exception as e:
         stack = traceback.format_exc()
@@ -419,14 +422,19 @@ def add_concept(request):
         logger.error(err_msg)
         return Response({'err': err_msg}, 400)
 
-    spacy_doc = cat(document.text)
+    spacy_doc = doc_cache.get_or_run(cat, document)
     spacy_entity = None
     if source_val in spacy_doc.text:
         start = spacy_doc.text.index(source_val)
         end = start + len(source_val)
         spacy_entity = tkns_from_doc(spacy_doc=spacy_doc, start=start, end=end)
 
-    cat.add_and_train_concept(cui=cui, name=name, name_status='P', spacy_doc=spacy_doc, spacy_entity=spacy_entity)
+    # never concurrent with the trainer thread of the model training, or saving, it
+    with model_lock(model_id(project)):
+        cat.add_and_train_concept(cui=cui, name=name, name_status='P', spacy_doc=spacy_doc,
+                                  spacy_entity=spacy_entity)
+    doc_cache.model_trained(cat)
+    training_queue.model_trained(project)
 
     id = create_annotation(source_val=source_val,
                            selection_occurrence_index=sel_occur_idx,
@@ -459,18 +467,17 @@ def import_cdb_concepts(request):
     return Response({'message': 'submitted cdb import job.'})
 
 
-def _submit_document(project: ProjectAnnotateEntities, document: Document):
+def _submit_document(project: ProjectAnnotateEntities, document: Document, train_async: bool = False,
+                     on_trained=None):
     if project.train_model_on_submit:
-        try:
-            cat = get_medcat(project=project)
-            train_medcat(cat, project, document)
-        except Exception as e:
-            if project.vocab.id:
-                if len(VOCAB_MAP[project.vocab.id].unigram_table) == 0:
-                    return Exception('Vocab is missing the unigram table. On the vocab instance '
-                                     'use vocab.make_unigram_table() to build')
-            else:
-                raise e
+        if train_async:
+            training_queue.submit(project, document, on_done=on_trained)
+        else:
+            try:
+                training_queue.train_submitted_document(project.id, document.id)
+            except Exception:
+                # logged by train_submitted_document, submission still goes ahead
+                pass
 
     # Add cuis to filter if they did not exist
     cuis = []
@@ -501,7 +508,7 @@ def submit_document(request):
     document = Document.objects.get(id=d_id)
 
     try:
-        _submit_document(project, document)
+        _submit_document(project, document, train_async=training_queue.ASYNC_TRAINING)
     except Exception as e:
         HttpResponseServerError(e.message)
 
@@ -513,10 +520,13 @@ def save_models(request):
     # Get project id
     p_id = request.data['project_id']
     project = ProjectAnnotateEntities.objects.get(id=p_id)
-    cat = get_medcat(project=project)
-
-    cat.cdb.save(project.concept_db.cdb_file.path)
+    get_medcat(project=project)
+    # saved by the trainer thread of the model, once the documents already submitted are trained
+    if not training_queue.save(project):
+        return Response({'message': 'Model cannot be saved, its model pack has not been unpacked'}, 500)
 
+    if training_queue.ASYNC_TRAINING:
+        return Response({'message': 'Models queued for saving'}, 202)
     return Response({'message': 'Models saved'})
 
 
@@ -614,8 +624,8 @@ def annotate_text(request):
     project = ProjectAnnotateEntities.objects.get(id=p_id)
 
     cat = get_medcat(project=project)
-    cat.config.linking['filters']['cuis'] = set(cuis)
-    spacy_doc = cat(message)
+    with cui_filter(cat, cuis):
+        spacy_doc = cat(message)
 
     ents = []
     anno_tkns = []
@@ -653,8 +663,22 @@ def download_annos(request):
     projects = ProjectAnnotateEntities.objects.filter(id__in=p_ids)
 
     with_doc_name = request.GET.get('with_doc_name', False)
-    out = download_projects_with_text(projects) if with_text_flag else \
-        download_projects_without_text(projects, with_doc_name)
+    # the X-Export-Cursor of a previous download, to only download what changed since
+    since = request.GET.get('since')
+    if since is not None:
+        since = parse_datetime(since)
+        if since is None:
+            return HttpResponseBadRequest('since is not a valid export cursor / ISO timestamp')
+        if timezone.is_naive(since):
+            since = timezone.make_aware(since)
+    if request.GET.get('format', 'json') == 'parquet':
+        try:
+            return download_projects_columnar(projects, since)
+        except ValueError as e:
+            return HttpResponseBadRequest(str(e))
+    gzip = accepts_gzip(request)
+    out = download_projects_with_text(projects, gzip, since) if with_text_flag else \
+        download_projects_without_text(projects, with_doc_name, gzip, since)
     return out
 
 
@@ -686,12 +710,30 @@ def search_solr(request):
     return search_collection(cdbs, query)
 
 
-@api_view(http_method_names=['POST'])
+@api_view(http_method_names=['GET', 'POST'])
 def upload_deployment(request):
-    deployment_upload = request.data
-    upload_projects_export(deployment_upload)
-    # logger.info(f'Errors encountered during previous deployment upload\n{errs}')
-    return Response("successfully uploaded", 200)
+    if request.method == 'GET':
+        # progress of the running and completed background imports. Completed imports are reported once, then
+        # their status file and task are removed.
+        def serialize_task(task, state):
+            export_path = json.loads(task.task_params)[0][0]
+            return {'id': task.id, 'export': os.path.basename(export_path), 'task_state': state,
+                    **import_status(export_path)}
+        imports = [serialize_task(t, 'running') for t in Task.objects.filter(queue='project_import')]
+        for task in CompletedTask.objects.filter(queue='project_import'):
+            imports.append(serialize_task(task, 'complete'))
+            remove_import_status(json.loads(task.task_params)[0][0])
+            task.delete()
+        return Response({'imports': imports})
+
+    # imported by a background task, from a copy of the upload, into projects using the given models
+    model_ids = [int(request.GET[param]) if request.GET.get(param) else None
+                 for param in ('cdb_id', 'vocab_id', 'modelpack_id')]
+    export_path = os.path.join(MEDIA_ROOT, f'deployment_upload_{timezone.now().strftime("%Y%m%d%H%M%S%f")}.json')
+    with open(export_path, 'w') as f:
+        json.dump(request.data, f)
+    job = import_projects_export(export_path, *model_ids, remove_export=True)
+    return Response({'bg_job_id': job.id, 'export': os.path.basename(export_path)}, 200)
 
 
 @api_view(http_method_names=['GET', 'DELETE'])
@@ -700,9 +742,13 @@ def cache_model(request, project_id):
         project = ProjectAnnotateEntities.objects.get(id=project_id)
         is_loaded = is_model_loaded(project)
         if request.method == 'GET':
-            if not is_loaded:
+            # ?wait=false starts loading the model in the background and returns its state immediately
+            if request.GET.get('wait', 'true').lower() in ('0', 'n', 'false'):
+                if get_load_state(project)['state'] in ('unloaded', 'failed'):
+                    preload_models([project])
+            elif not is_loaded:
                 get_medcat(project)
-            return Response('success', 200)
+            return Response(get_load_state(project), 200)
         elif request.method == 'DELETE':
             if is_loaded:
                 clear_cached_medcat(project)
@@ -719,10 +765,18 @@ def cache_model(request, project_id):
 @api_view(http_method_names=['GET'])
 def model_loaded(_):
     models_loaded = {}
+    load_states = {}
     for p in ProjectAnnotateEntities.objects.all():
         models_loaded[p.id] = is_model_loaded(p)
+        load_states[p.id] = get_load_state(p)
 
-    return Response({'model_states': models_loaded})
+    return Response({'model_states': models_loaded, 'load_states': load_states,
+                     'load_stats': {name: dict(counts) for name, counts in LOAD_STATS.items()}})
+
+
+@api_view(http_method_names=['GET'])
+def training_queue_status(_):
+    return Response({'queues': training_queue.queue_stats(), 'replay': training_queue.REPLAY_STATS})
 
 
 @api_view(http_method_names=['GET', 'POST'])
@@ -50,6 +50,7 @@ urlpatterns = [
     path('api/concept-db-search-index-created/', api.views.concept_search_index_available),
     path('api/model-loaded/', api.views.model_loaded),
     path('api/cache-model/<int:project_id>/', api.views.cache_model),
+    path('api/training-queue/', api.views.training_queue_status),
     path('api/upload-deployment/', api.views.upload_deployment),
     path('api/model-concept-children/<int:cdb_id>/', api.views.cdb_cui_children),
     path('api/metrics/<int:report_id>/', api.views.view_metrics),
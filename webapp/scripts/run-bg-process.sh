@@ -2,6 +2,8 @@
 
 # env vars that should only be on for app running...
 export RESUBMIT_ALL_ON_STARTUP=0
+# models are preloaded for the app, the background tasks load these on demand
+export MEDCAT_PRELOAD_PROJECTS=
 
 # Collect static files and migrate if needed
 python /home/api/manage.py collectstatic --noinput
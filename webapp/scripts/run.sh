@@ -6,6 +6,8 @@
 # env vars that should only be on for app running...
 TMP_RESUBMIT_ALL_VAR=$RESUBMIT_ALL_ON_STARTUP
 export RESUBMIT_ALL_ON_STARTUP=0
+TMP_PRELOAD_PROJECTS_VAR=$MEDCAT_PRELOAD_PROJECTS
+export MEDCAT_PRELOAD_PROJECTS=
 
 # Collect static files and migrate if needed
 python /home/api/manage.py collectstatic --noinput
@@ -32,5 +34,7 @@ python manage.py shell < /home/scripts/create_group.py
 
 # RESET any Env vars to original stat
 export RESUBMIT_ALL_ON_STARTUP=$TMP_RESUBMIT_ALL_VAR
+export MEDCAT_PRELOAD_PROJECTS=$TMP_PRELOAD_PROJECTS_VAR
 
-uwsgi --http-timeout 360s --http :8000 --master --chdir /home/api/  --module core.wsgi
+# --lazy-apps loads the app in the worker, so threads started in ApiConfig.ready, i.e. model preloading, run there
+uwsgi --http-timeout 360s --http :8000 --master --enable-threads --lazy-apps --chdir /home/api/  --module core.wsgi